@@ -1,18 +1,45 @@
 import argparse
 import asyncio
-import json
+import bisect
+import hashlib
 import logging
+import os
+import re
 import time
+from collections import OrderedDict
 from dataclasses import dataclass
 from typing import Optional, List, Dict, Any
 
-import openai
+import numpy as np
 import pandas as pd
 
-from utils import AsyncLoopWrapper, init_logger
+from agentic_trace import JobGraph, MultiUserTrace, TemplateUsers, TraceFiles
+from utils import (
+    STREAM_OPTIONS,
+    AsyncLoopWrapper,
+    ChunkTimer,
+    LatencySketches,
+    ResultStore,
+    TokenPromptCache,
+    WindowedMetrics,
+    add_metrics_arguments,
+    add_token_prompt_arguments,
+    add_transport_arguments,
+    build_transport,
+    init_logger,
+    load_tokenizer,
+    normalize_base_url,
+    print_chunk_time_summary,
+    print_latency_summary,
+    sketch_path,
+    start_live_metrics,
+)
 
 logger = init_logger(__name__, logging.INFO)
 
+# Words and punctuation marks, each counted as one token of a text-mode head
+HEAD_TOKEN = re.compile(r"\w+|[^\w\s]")
+
 
 @dataclass
 class WorkloadConfig:
@@ -20,7 +47,17 @@ class WorkloadConfig:
     model: List[str]
     user_request_interval: float
     new_user_interval: float
-    trace_file: List[str]
+    # One trace file per user, unless multi_user_trace or template_trace
+    trace_file: Optional[List[str]]
+    # "rounds" or "dag"
+    scheduler: str = "rounds"
+    edge_think_time: float = 0.0
+    multi_user_trace: Optional[str] = None
+    template_trace: Optional[str] = None
+    # Users of template_trace, or at most that many of multi_user_trace
+    num_users: Optional[int] = None
+    template_jitter: float = 0.0
+    seed: int = 0
 
 
 @dataclass
@@ -29,54 +66,157 @@ class UserConfig:
     num_agents: int
     gap_between_requests: int
     trace: Any
+    edge_think_time: float
+    # Shared context id -> tokens
+    contexts: Dict[str, int]
 
     @staticmethod
-    def new_user_config(user_id: int, workload_config: WorkloadConfig, trace) -> "UserConfig":
+    def new_user_config(user_id: int, workload_config: WorkloadConfig, trace,
+                        contexts: Dict[str, int]) -> "UserConfig":
         return UserConfig(
             user_id=user_id,
             num_agents=workload_config.num_agents,
             gap_between_requests=workload_config.user_request_interval,
             trace=trace,
+            edge_think_time=workload_config.edge_think_time,
+            contexts=contexts,
         )
 
 
 class ChatHistory:
+    """
+    Messages of a user's agents, indexed by (agent, round, role) so that the
+    messages of an input_from edge are found in O(1), however long the
+    history grows.
+    """
 
     def __init__(
         self,
     ):
-        self.history = []
-
-    def on_user_query(self, query: str, agentID: int, roundID: int):
-        self.history.append({"role": "user", "name": f"agent{agentID}-{roundID}", "content": query})
-
-    def on_system_response(self, response: str, agentID: int, roundID: int):
-        assert len(self.history) > 0, "Expect user query"
-        self.history.append({"role": "assistant", "name": f"agent{agentID}-{roundID}", "content": response})
+        # (agentID, roundID, role) -> messages, in the order they were added
+        self.history = {}
+        # (agentID, roundID, role) -> prompt tokens of those messages
+        self.num_tokens = {}
+        self.num_messages = 0
+
+    def _add(self, role: str, content: str, agentID: int, roundID: int,
+             num_tokens: int, token_ids: Optional[List[int]]):
+        message = {"role": role, "name": f"agent{agentID}-{roundID}", "content": content}
+        if token_ids is not None:
+            message["token_ids"] = token_ids
+        key = (agentID, roundID, role)
+        self.history.setdefault(key, []).append(message)
+        self.num_tokens[key] = self.num_tokens.get(key, 0) + num_tokens
+        self.num_messages += 1
+
+    def on_user_query(self, query: str, agentID: int, roundID: int, num_tokens: int = 0,
+                      token_ids: Optional[List[int]] = None):
+        self._add("user", query, agentID, roundID, num_tokens, token_ids)
+
+    def on_system_response(self, response: str, agentID: int, roundID: int, num_tokens: int = 0):
+        assert self.num_messages > 0, "Expect user query"
+        self._add("assistant", response, agentID, roundID, num_tokens, None)
 
     def get_messages_for_openai(self, input_from: List, agentID: int, roundID: int):
+        # The messages are shared with the history, not copied
         messages = []
         for i_f in input_from:
-            name = f"agent{i_f[1]}-{i_f[0]}"
             if i_f[2] in ("input", "both"):
-                messages.extend(
-                    [entry for entry in self.history
-                     if entry["role"] == "user" and entry["name"] == name]
-                )
+                messages.extend(self.history.get((i_f[1], i_f[0], "user"), ()))
             if i_f[2] in ("output", "both"):
-                messages.extend(
-                    [entry for entry in self.history
-                     if entry["role"] == "assistant" and entry["name"] == name]
-                )   
-        name = f"agent{agentID}-{roundID}"
-        messages.extend(  
-            [entry for entry in self.history
-             if entry["role"] == "user" and entry["name"] == name]
-        )
+                messages.extend(self.history.get((i_f[1], i_f[0], "assistant"), ()))
+        messages.extend(self.history.get((agentID, roundID, "user"), ()))
         return messages
 
+    def get_segments(self, input_from: List, agentID: int, roundID: int) -> List[tuple]:
+        """
+        (key, tokens) of the parts of the prompt built by
+        get_messages_for_openai, in the same order
+        """
+        keys = []
+        for i_f in input_from:
+            if i_f[2] in ("input", "both"):
+                keys.append((i_f[1], i_f[0], "user"))
+            if i_f[2] in ("output", "both"):
+                keys.append((i_f[1], i_f[0], "assistant"))
+        keys.append((agentID, roundID, "user"))
+        return [(key, self.num_tokens[key]) for key in keys if key in self.num_tokens]
+
     def __len__(self):
-        return len(self.history)
+        return self.num_messages
+
+
+class AgentPrompts:
+    """
+    Sized parts of the agent prompts: the shared contexts (tool definitions,
+    system prompts) that open a request, and the agents' own queries.
+
+    A context message is built once per list of contexts and shared by every
+    request using it, so requests with the same contexts start with the same
+    prefix. With a TokenPromptCache every part is exactly its size in token
+    IDs; the context blocks are cached there, the queries (unique to a user,
+    agent and round) are not. Otherwise the text is the head followed by one
+    " hi" filler per token left, counting every word or punctuation mark of
+    the head as a token, so its size is only approximate.
+    """
+
+    def __init__(self, token_prompts: Optional[TokenPromptCache] = None,
+                 max_context_messages: int = 1024):
+        self.token_prompts = token_prompts
+        self.max_context_messages = max_context_messages
+        # ((context id, tokens), ...) -> context message, least recently used first
+        self.context_messages = OrderedDict()
+
+    def _part(self, head: str, num_tokens: int, cache: bool = True) -> tuple:
+        """Text and token IDs (None without a TokenPromptCache) of a part"""
+        token_ids = None
+        if self.token_prompts is not None:
+            token_ids = self.token_prompts.block(head, num_tokens, cache)
+        fillers = max(num_tokens - len(HEAD_TOKEN.findall(head)), 0)
+        return head + " hi" * fillers, token_ids
+
+    def query(self, user_id: int, agentID: int, roundID: int, num_tokens: int) -> tuple:
+        return self._part(
+            f"User {user_id} agent {agentID} round {roundID}:", num_tokens, cache=False
+        )
+
+    def context_message(self, contexts: tuple) -> dict:
+        message = self.context_messages.get(contexts)
+        if message is not None:
+            self.context_messages.move_to_end(contexts)
+            return message
+        parts = [self._part(f" Context {context_id}:", tokens) for context_id, tokens in contexts]
+        message = {
+            "role": "system",
+            "name": "context",
+            "content": "".join(text for text, _ in parts),
+        }
+        if self.token_prompts is not None:
+            message["token_ids"] = [token for _, token_ids in parts for token in token_ids]
+        self.context_messages[contexts] = message
+        if len(self.context_messages) > self.max_context_messages:
+            self.context_messages.popitem(last=False)
+        return message
+
+
+def parallelism(intervals: List[tuple]) -> tuple:
+    """
+    Average number of requests in flight over the span of the intervals, and
+    the share of that span with two or more in flight
+    """
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    span = events[-1][0] - events[0][0] if events else 0.0
+    if span <= 0:
+        return 0.0, 0.0
+    busy = 0.0
+    parallel = 0.0
+    in_flight = 0
+    for (time_point, delta), (next_time, _) in zip(events, events[1:]):
+        in_flight += delta
+        busy += in_flight * (next_time - time_point)
+        if in_flight >= 2:
+            parallel += next_time - time_point
+    return busy / span, parallel / span
 
 
 @dataclass
@@ -89,62 +229,204 @@ class Response:
     launch_time: float
     finish_time: float
     agentID: int
+    # Encoded arrival time and token count of each chunk, see ChunkTimer
+    chunk_times: str = ""
+    # Base URL the request was routed to, and its wait for an in-flight slot
+    endpoint: str = ""
+    queue_time: float = 0.0
+    # The request failed: no tokens, and an empty body
+    error: bool = False
+
+
+# Per-request result columns, in the order of the output CSV
+RESULT_COLUMNS = {
+    "prompt_tokens": np.int64,
+    "generation_tokens": np.int64,
+    "ttft": np.float64,
+    "generation_time": np.float64,
+    "user_id": np.int64,
+    "round_id": np.int64,
+    "launch_time": np.float64,
+    "finish_time": np.float64,
+    "agentID": np.int64,
+    "input": object,
+    "output": object,
+    "chunk_times": object,
+    "endpoint": object,
+    "queue_time": np.float64,
+    "shared_prefix_tokens": np.int64,
+    "error": np.bool_,
+}
+
+
+class Endpoint:
+    """One serving endpoint, with its transport and in-flight limit"""
+
+    def __init__(self, base_url: str, transport, max_inflight: Optional[int] = None):
+        self.base_url = base_url
+        self.transport = transport
+        self.max_inflight = max_inflight
+        # Requests past the limit wait here, on the client. Created on the
+        # executor loop by the first request, as it binds to the running
+        # loop on older Pythons
+        self.semaphore = None
+        # Requests routed here and not finished, queued ones included
+        self.outstanding = 0
+
+
+# Virtual nodes per endpoint on the consistent-hash ring
+RING_REPLICAS = 100
+
+
+def _ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class EndpointPool:
+    """
+    Endpoints of the agents, one per distinct base URL, and the policy that
+    picks the endpoint of each request.
+
+    With the static policy, agent i always uses base_url[i]. The other
+    policies let the routed agents use any endpoint serving their model:
+    least-outstanding picks the one with the fewest unfinished requests,
+    consistent-hash keeps every user on the same endpoint (so it hits its
+    KV cache) while spreading users evenly. Routing runs on the executor
+    loop, so the counters need no lock.
+    """
+
+    POLICIES = ("static", "least-outstanding", "consistent-hash")
+
+    def __init__(
+        self,
+        base_url: List[str],
+        model: List[str],
+        routing: str = "static",
+        max_inflight: Optional[int] = None,
+        routed_agents: Optional[List[int]] = None,
+        transport_args=None,
+    ):
+        if routing not in self.POLICIES:
+            raise ValueError(f"Unknown routing policy {routing}")
+        self.routing = routing
+        # Agents placed on the same endpoint share one transport (and its
+        # connection pool)
+        self.endpoints = {}
+        for bu in base_url:
+            bu = normalize_base_url(bu)
+            if bu not in self.endpoints:
+                self.endpoints[bu] = Endpoint(bu, build_transport(bu, transport_args), max_inflight)
+
+        # Agent -> endpoints it can use
+        self.replicas = []
+        for agentID, bu in enumerate(base_url):
+            routed = routing != "static" and (routed_agents is None or agentID in routed_agents)
+            if not routed:
+                self.replicas.append([self.endpoints[normalize_base_url(bu)]])
+                continue
+            urls = dict.fromkeys(
+                normalize_base_url(other) for other, other_model in zip(base_url, model)
+                if other_model == model[agentID]
+            )
+            self.replicas.append([self.endpoints[url] for url in urls])
+        self.rings = [self._build_ring(replicas) for replicas in self.replicas]
+
+    @staticmethod
+    def _build_ring(replicas: List[Endpoint]) -> tuple:
+        ring = sorted(
+            (_ring_hash(f"{endpoint.base_url}#{i}"), endpoint)
+            for endpoint in replicas
+            for i in range(RING_REPLICAS)
+        )
+        return [point for point, _ in ring], [endpoint for _, endpoint in ring]
+
+    def route(self, agentID: int, user_id: int) -> Endpoint:
+        replicas = self.replicas[agentID]
+        if len(replicas) == 1 or self.routing == "static":
+            return replicas[0]
+        if self.routing == "least-outstanding":
+            return min(replicas, key=lambda endpoint: endpoint.outstanding)
+        points, endpoints = self.rings[agentID]
+        idx = bisect.bisect(points, _ring_hash(str(user_id))) % len(points)
+        return endpoints[idx]
 
 
 class RequestExecutor:
 
-    def __init__(self, base_url: List[str], model: List[str]):
-        self.client = []
-        for bu in base_url:
-            if not bu.endswith('/v1'):
-                bu = bu.rstrip('/') + '/v1'
-            self.client.append(openai.AsyncOpenAI(
-                api_key="EMPTY",  # Dummy API key for vLLM server
-                base_url=bu
-            ))
+    def __init__(self, base_url: List[str], model: List[str], transport_args=None,
+                 routing: str = "static", max_inflight: Optional[int] = None,
+                 routed_agents: Optional[List[int]] = None,
+                 token_prompts: Optional[TokenPromptCache] = None):
+        """
+        token_prompts: send the prompts as token IDs to the completions API
+        """
+        self.pool = EndpointPool(
+            base_url, model, routing, max_inflight, routed_agents, transport_args
+        )
         self.model = model
+        self.token_prompts = token_prompts
         self.loop = AsyncLoopWrapper.GetOrStartLoop()
         self.request_history = []
 
     async def _async_launch_request(self, messages: List[Dict[str, str]],  max_tokens: int, 
-                                    agentID: int, extra_headers: Optional[Dict[str, str]] = None):
+                                    agentID: int, user_id: int = 0,
+                                    extra_headers: Optional[Dict[str, str]] = None,
+                                    prompt_ids: Optional[List[int]] = None):
         model = self.model[agentID]
+        endpoint = self.pool.route(agentID, user_id)
+        if endpoint.max_inflight and endpoint.semaphore is None:
+            endpoint.semaphore = asyncio.Semaphore(endpoint.max_inflight)
+        endpoint.outstanding += 1
+        submit_time = start_time = time.time()
+        acquired = False
         try:
+            if endpoint.semaphore is not None:
+                await endpoint.semaphore.acquire()
+                acquired = True
+            start_time = time.time()
             logging.info(f"Sending request to model {model} with messages: {messages}")
             
             # Initialize response tracking variables
             words = ""
             tokens_out = 0
             tokens_prefill = 0
-            start_time = time.time()
+            usage = None
             first_token_time = None
-
-            # Make the request
-            response = await self.client[agentID].chat.completions.create(
-                model=model,
-                messages=messages,
-                stream=True,
-                max_tokens=max_tokens,
-                temperature=0.0,
-                stream_options={"include_usage": True},
+            chunk_timer = ChunkTimer()
+
+            if prompt_ids is not None:
+                # Token IDs on the completions API, not tokenized by the server
+                api = "completions"
+                payload = {"model": model, "prompt": prompt_ids}
+            else:
+                api = "chat"
+                payload = {"model": model, "messages": messages}
+
+            # Make the request and process the streaming response
+            async for text, chunk_usage in endpoint.transport.stream(
+                api,
+                dict(
+                    payload,
+                    max_tokens=max_tokens,
+                    temperature=0.0,
+                    stream_options=STREAM_OPTIONS,
+                ),
                 extra_headers=extra_headers,
-            )
-
-            # Process the streaming response
-            async for chunk in response:
-                if not chunk.choices:
-                    continue
+            ):
+                chunk_timer.on_chunk(text, chunk_usage)
+                if chunk_usage is not None:
+                    usage = chunk_usage
                     
                 # Handle content
-                if chunk.choices[0].delta.content is not None:
-                    if first_token_time is None and chunk.choices[0].delta.content != "":
+                if text:
+                    if first_token_time is None:
                         first_token_time = time.time()
-                    words += chunk.choices[0].delta.content
+                    words += text
                 
             # Handle token counts if available
-            if hasattr(chunk, 'usage') and chunk.usage is not None:
-                tokens_out = chunk.usage.completion_tokens
-                tokens_prefill = chunk.usage.prompt_tokens
+            if usage is not None:
+                tokens_out = usage["completion_tokens"]
+                tokens_prefill = usage["prompt_tokens"]
 
             # Calculate timing metrics
             ttft = first_token_time - start_time if first_token_time else 0
@@ -159,12 +441,33 @@ class RequestExecutor:
                 launch_time=start_time,
                 finish_time=time.time(),
                 agentID=agentID,
+                chunk_times=chunk_timer.encode(),
+                endpoint=endpoint.base_url,
+                queue_time=start_time - submit_time,
             )
 
         except Exception as e:
             logging.error(f"Error in _async_launch_request: {str(e)}")
             logging.error(f"Request details - model: {model}, messages: {messages}")
-            raise
+            # Still a finished request, so that its user's rounds and the
+            # requests depending on it go on
+            return Response(
+                body="",
+                ttft=0.0,
+                generation_time=0.0,
+                prompt_tokens=0,
+                generation_tokens=0,
+                launch_time=start_time,
+                finish_time=time.time(),
+                agentID=agentID,
+                endpoint=endpoint.base_url,
+                queue_time=start_time - submit_time,
+                error=True,
+            )
+        finally:
+            endpoint.outstanding -= 1
+            if acquired:
+                endpoint.semaphore.release()
 
     def launch_request(
         self,
@@ -174,22 +477,33 @@ class RequestExecutor:
         agentID: int,
         roundID: int,
         input: str,
+        user_id: int = 0,
         extra_headers=None,
     ):
         """
         finish_callback: Callable[[Response, int], None]
         """
         real_callback = lambda x: finish_callback(x.result(), agentID, roundID, input)
+        # Built on the caller's thread, the only one using the cache in a run
+        prompt_ids = self.token_prompts.prompt(messages) if self.token_prompts is not None else None
         future = asyncio.run_coroutine_threadsafe(
-            self._async_launch_request(messages, max_tokens, agentID, extra_headers), self.loop
+            self._async_launch_request(
+                messages, max_tokens, agentID, user_id, extra_headers, prompt_ids
+            ),
+            self.loop,
         )
         future.add_done_callback(real_callback)
 
 
 class UserSession:
 
-    def __init__(self, user_config: UserConfig):
+    def __init__(self, user_config: UserConfig, store: ResultStore, metrics: WindowedMetrics,
+                 prompts: AgentPrompts):
         self.user_config = user_config
+        # Shared by all the sessions of the manager
+        self.store = store
+        self.metrics = metrics
+        self.prompts = prompts
         self.last_request_time = None
         self.chat_history = ChatHistory()
         self.round_id = 0
@@ -197,60 +511,184 @@ class UserSession:
         self.has_unfinished_request = 0
         self.last_unfinished_log = 0
 
-        self.prompt_lengths = []
-        self.generation_lengths = []
-        self.ttfts = []
-        self.generation_times = []
-        self.launch_times = []
-        self.finish_times = []
-
         self.finished = False
 
-        self.agentIDs = []
-        self.roundIDs = []
-        self.inputs = []
-        self.outputs = []
-
-    def _update_result(self, response: Response):
-        self.prompt_lengths.append(response.prompt_tokens)
-        self.generation_lengths.append(response.generation_tokens)
-        self.ttfts.append(response.ttft)
-        self.generation_times.append(response.generation_time)
-        self.launch_times.append(response.launch_time)
-        self.finish_times.append(response.finish_time)
-        self.agentIDs.append(response.agentID)
-        self.outputs.append(response.body)
-
-    def _launch_new_request(self, timestamp: float, request_executor: RequestExecutor, request_id: int):
-        agentID = self.user_config.trace[self.round_id]['agent_id'][request_id]
-        max_tokens = self.user_config.trace[self.round_id]['output_tokens'][request_id]
-        input_from = self.user_config.trace[self.round_id]['input_from'][request_id]
-
-        self.chat_history.on_user_query("hihihihihi", agentID, self.round_id)
-        messages = self.chat_history.get_messages_for_openai(input_from, agentID, self.round_id)
+        self.graph = JobGraph(user_config.trace, user_config.edge_think_time)
+        # Node -> launch and finish time of its request
+        self.launch_times = {}
+        self.finish_times = {}
+        # State of the dag scheduler, only touched on the executor loop
+        self.request_executor = None
+        self.num_pending_upstream = [len(edges) for edges in self.graph.upstream]
+        self.ready_time = [0.0] * len(self.graph)
+        # Round -> prompt segments of its requests launched so far
+        self.round_segments = {}
+        # (round, agent) -> prompt tokens shared with an earlier request of the round
+        self.shared_prefix_tokens = {}
+
+    def _update_result(self, response: Response, roundID: int, messages):
+        self.store.append(
+            prompt_tokens=response.prompt_tokens,
+            generation_tokens=response.generation_tokens,
+            ttft=response.ttft,
+            generation_time=response.generation_time,
+            user_id=self.user_config.user_id,
+            round_id=roundID,
+            launch_time=response.launch_time,
+            finish_time=response.finish_time,
+            agentID=response.agentID,
+            input=messages,
+            output=response.body,
+            chunk_times=response.chunk_times,
+            endpoint=response.endpoint,
+            queue_time=response.queue_time,
+            shared_prefix_tokens=self.shared_prefix_tokens.get((roundID, response.agentID), 0),
+            error=response.error,
+        )
+        if response.error:
+            self.metrics.on_error()
+            return
+        self.metrics.on_finish(
+            response.prompt_tokens,
+            response.generation_tokens,
+            response.ttft,
+            response.generation_time,
+            response.finish_time - response.launch_time,
+            response.chunk_times,
+        )
+
+    def _build_query(self, round_id: int, request_id: int, agentID: int) -> tuple:
+        """Text, token IDs (None without --token-ids) and tokens of the agent's query"""
+        input_tokens = self.user_config.trace[round_id].get("input_tokens")
+        if input_tokens is not None:
+            num_tokens = input_tokens[request_id]
+            query, token_ids = self.prompts.query(
+                self.user_config.user_id, agentID, round_id, num_tokens
+            )
+            return query, token_ids, num_tokens
+        query = "hihihihihi"
+        if self.prompts.token_prompts is None:
+            return query, None, 0
+        token_ids = self.prompts.token_prompts.encode(query)
+        return query, token_ids, len(token_ids)
+
+    def _contexts(self, round_id: int, request_id: int) -> tuple:
+        """((context id, tokens), ...) of the shared contexts of a request"""
+        shared_context = self.user_config.trace[round_id].get("shared_context")
+        if shared_context is None or shared_context[request_id] is None:
+            return ()
+        context_ids = shared_context[request_id]
+        if not isinstance(context_ids, list):
+            context_ids = [context_ids]
+        return tuple(
+            (str(context_id), self.user_config.contexts[str(context_id)])
+            for context_id in context_ids
+        )
+
+    def _shared_prefix(self, round_id: int, segments: List[tuple]) -> int:
+        """
+        Prompt tokens at the start of segments that an earlier request of the
+        same round also starts with, which a prefix cache could reuse
+        """
+        shared = 0
+        previous = self.round_segments.setdefault(round_id, [])
+        for other in previous:
+            tokens = 0
+            for segment, other_segment in zip(segments, other):
+                if segment != other_segment:
+                    break
+                tokens += segment[1]
+            shared = max(shared, tokens)
+        previous.append(segments)
+        return shared
+
+    def _launch_new_request(self, timestamp: float, request_executor: RequestExecutor,
+                            round_id: int, request_id: int):
+        agentID = self.user_config.trace[round_id]['agent_id'][request_id]
+        max_tokens = self.user_config.trace[round_id]['output_tokens'][request_id]
+        input_from = self.user_config.trace[round_id]['input_from'][request_id]
+
+        query, token_ids, num_tokens = self._build_query(round_id, request_id, agentID)
+        self.chat_history.on_user_query(query, agentID, round_id, num_tokens, token_ids)
+        messages = self.chat_history.get_messages_for_openai(input_from, agentID, round_id)
+        segments = self.chat_history.get_segments(input_from, agentID, round_id)
+        contexts = self._contexts(round_id, request_id)
+        if contexts:
+            messages.insert(0, self.prompts.context_message(contexts))
+            segments = [(("context", context_id), tokens) for context_id, tokens in contexts] + segments
+        self.shared_prefix_tokens[(round_id, agentID)] = self._shared_prefix(round_id, segments)
         request_executor.launch_request(
             messages,
             max_tokens,
             self._on_request_finished,
             agentID,
-            self.round_id,
+            round_id,
             messages.copy(),
+            user_id=self.user_config.user_id,
             extra_headers={"x-user-id": str(self.user_config.user_id)},
         )
         self.has_unfinished_request += 1
+        self.metrics.on_launch()
         self.last_request_time = timestamp
 
     def _on_request_finished(self, response: Response, agentID: int, roundID: int, messages: str):
-        self.chat_history.on_system_response(response.body, agentID, roundID)
+        self.chat_history.on_system_response(
+            response.body, agentID, roundID, response.generation_tokens
+        )
         self.has_unfinished_request -= 1
         logger.debug(
             f"User {self.user_config.user_id} finished one request. "
             f"Prompt tokens: {response.prompt_tokens}, "
             f"generation tokens: {response.generation_tokens}"
         )
-        self._update_result(response)
-        self.roundIDs.append(roundID)
-        self.inputs.append(messages)
+        self._update_result(response, roundID, messages)
+        node = self.graph.node_of[(roundID, agentID)]
+        self.launch_times[node] = response.launch_time - response.queue_time
+        self.finish_times[node] = response.finish_time
+        if self.request_executor is not None:
+            self._on_dag_event(node, "finish")
+
+    def _launch_dag_node(self, node: int):
+        round_id, request_id = self.graph.nodes[node]
+        self._launch_new_request(time.time(), self.request_executor, round_id, request_id)
+        self._on_dag_event(node, "launch")
+
+    def _on_dag_event(self, node: int, event: str):
+        """
+        Launch the requests whose last dependency is this launch or finish of
+        node, once their think time has passed
+        """
+        now = time.time()
+        for child, think_time in self.graph.downstream[node][event]:
+            self.ready_time[child] = max(self.ready_time[child], now + think_time)
+            self.num_pending_upstream[child] -= 1
+            if self.num_pending_upstream[child] > 0:
+                continue
+            delay = self.ready_time[child] - now
+            if delay > 0:
+                self.request_executor.loop.call_later(delay, self._launch_dag_node, child)
+            else:
+                self._launch_dag_node(child)
+
+    def _start_dag(self):
+        # Launching a root can already release the requests that only need
+        # its input, so the roots are listed first
+        roots = [node for node, edges in enumerate(self.graph.upstream) if not edges]
+        for node in roots:
+            self._launch_dag_node(node)
+
+    def step_dag(self, timestamp: float, request_executor: RequestExecutor):
+        """
+        Dag scheduler: every request is launched as soon as the requests it
+        takes input from are done, without waiting for the rest of its round
+        """
+        if self.request_executor is None:
+            self.request_executor = request_executor
+            self.last_request_time = timestamp
+            request_executor.loop.call_soon_threadsafe(self._start_dag)
+            return
+        if len(self.finish_times) == len(self.graph):
+            self.finished = True
 
     def step(self, timestamp: float, request_executor: RequestExecutor):
         num_rounds = len(self.user_config.trace)
@@ -263,7 +701,7 @@ class UserSession:
 
         if self.last_request_time is None:
             for request_id in range(len(self.user_config.trace[self.round_id]['agent_id'])):
-                self._launch_new_request(timestamp, request_executor, request_id)
+                self._launch_new_request(timestamp, request_executor, self.round_id, request_id)
             self.round_id += 1
             return
 
@@ -278,32 +716,40 @@ class UserSession:
                 return
 
             for request_id in range(len(self.user_config.trace[self.round_id]['agent_id'])):
-                self._launch_new_request(timestamp, request_executor, request_id)
+                self._launch_new_request(timestamp, request_executor, self.round_id, request_id)
             self.round_id += 1
             return
 
-    def summary(self) -> pd.DataFrame:
-        df = pd.DataFrame()
-        df["prompt_tokens"] = self.prompt_lengths
-        df["generation_tokens"] = self.generation_lengths
-        df["ttft"] = self.ttfts
-        df["generation_time"] = self.generation_times
-        df["user_id"] = self.user_config.user_id
-        df["round_id"] = self.roundIDs
-        df["launch_time"] = self.launch_times
-        df["finish_time"] = self.finish_times
-        df["agentID"] = self.agentIDs
-        df["input"] = self.inputs
-        df["output"] = self.outputs
-        return df
+    def job_stats(self) -> dict:
+        """Completion time, critical path and parallelism of the finished job"""
+        nodes = [node for node in range(len(self.graph)) if node in self.finish_times]
+        durations = [
+            self.finish_times.get(node, 0.0) - self.launch_times.get(node, 0.0)
+            for node in range(len(self.graph))
+        ]
+        intervals = [(self.launch_times[node], self.finish_times[node]) for node in nodes]
+        start = min((start for start, _ in intervals), default=0.0)
+        end = max((end for _, end in intervals), default=0.0)
+        mean_parallelism, parallel_share = parallelism(intervals)
+        return {
+            "user_id": self.user_config.user_id,
+            "requests": len(nodes),
+            "start_time": start,
+            "finish_time": end,
+            "jct": end - start,
+            "critical_path": self.graph.critical_path(durations),
+            "parallelism": mean_parallelism,
+            "parallel_share": parallel_share,
+        }
 
 
 class UserSessionManager:
 
     def __init__(
-        self, workload_config: WorkloadConfig
+        self, workload_config: WorkloadConfig, prompts: Optional[AgentPrompts] = None
     ):
         self.workload_config = workload_config
+        self.prompts = prompts if prompts is not None else AgentPrompts()
         self.sessions = []
 
         gap_between_requests_per_user = workload_config.user_request_interval
@@ -316,48 +762,57 @@ class UserSessionManager:
 
         self.user_id = 0
         self.last_user_join = 0
-        self.session_summaries = []
         self.start_time = None
 
-        self.traces = []
-        for usr_id, trace_file in enumerate(self.workload_config.trace_file):
-            self.traces.append([])
-            with open(trace_file, "r", encoding="utf-8") as f:
-                for round_id, line in enumerate(f, start=1):
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        record = json.loads(line)
-                    except json.JSONDecodeError as e:
-                        continue
-                    self.traces[usr_id].append(record)
-
+        self.users = self._trace_source(workload_config)
+        self.store = ResultStore(RESULT_COLUMNS)
+        self.metrics = WindowedMetrics()
         self.continue_flag = True
+        # job_stats of every finished session
+        self.jobs = []
+
+    @staticmethod
+    def _trace_source(workload_config: WorkloadConfig):
+        if workload_config.template_trace is not None:
+            return TemplateUsers(
+                workload_config.template_trace, workload_config.num_users,
+                workload_config.template_jitter, workload_config.seed,
+            )
+        if workload_config.multi_user_trace is not None:
+            return MultiUserTrace(workload_config.multi_user_trace, workload_config.num_users)
+        return TraceFiles(workload_config.trace_file)
 
     def _create_user_session(self):
         self.user_id += 1
-        if self.user_id > len(self.traces):
+        if self.user_id > len(self.users):
             return None, False
-        user_config = UserConfig.new_user_config(self.user_id, self.workload_config, self.traces[self.user_id - 1])
-        user_session = UserSession(user_config)
+        # Read when the user joins, so only active users' traces are in memory
+        try:
+            trace, contexts = self.users[self.user_id - 1]
+        except ValueError as e:
+            logger.error(f"Skipping user {self.user_id}: {e}")
+            return None, True
+        user_config = UserConfig.new_user_config(
+            self.user_id, self.workload_config, trace, contexts
+        )
+        user_session = UserSession(user_config, self.store, self.metrics, self.prompts)
         self.sessions.append(user_session)
         return user_session, True
 
     def _remove_finished_sessions(self):
         sessions_to_remove = [s for s in self.sessions if s.finished]
+        self.jobs.extend(s.job_stats() for s in sessions_to_remove)
         if len(sessions_to_remove) > 0:
             logger.info(
                 f"Removing {len(sessions_to_remove)} finished sessions, now "
                 f"active users: {len(self.sessions) - len(sessions_to_remove)}"
             )
-            for session in sessions_to_remove:
-                self.session_summaries.append(session.summary())
         self.sessions = [s for s in self.sessions if not s.finished]
 
     def step(self, timestamp: float, executor: RequestExecutor):
         if self.start_time is None:
             self.start_time = timestamp
+            self.metrics.start(timestamp)
 
         if self.continue_flag:
             if timestamp - self.last_user_join > self.gap_between_users:
@@ -370,7 +825,10 @@ class UserSessionManager:
                     )
 
         for session in self.sessions:
-            session.step(timestamp, executor)
+            if self.workload_config.scheduler == "dag":
+                session.step_dag(timestamp, executor)
+            else:
+                session.step(timestamp, executor)
 
         self._remove_finished_sessions()
 
@@ -379,47 +837,26 @@ class UserSessionManager:
         return True
 
     @staticmethod
-    def ProcessSummary(
-        df: pd.DataFrame,
-        start_time: Optional[float] = None,
-        end_time: Optional[float] = None,
-        pending_queries: int = 0
-    ):
-        if start_time and end_time:
-            launched_queries = len(
-                df.query(f"{start_time} <= launch_time <= {end_time}")
-            )
-            df = df.query(f"{start_time} <= finish_time <= {end_time}")
-        else:
-            launched_queries = len(df)
+    def PrintSummary(summary: dict):
+        """
+        Print a performance summary block, from the fields computed by
+        ProcessSummary or by WindowedMetrics.take_window
+        """
+        start_time = summary["start_time"]
+        end_time = summary["end_time"]
+        total_time = end_time - start_time
 
         logger.debug(
-            f"Launched queries: {launched_queries}, "
-            f"pending queries: {pending_queries}, "
-            f"finished queries: {len(df)}"
+            f"Launched queries: {summary['launched_queries']}, "
+            f"pending queries: {summary['pending_queries']}, "
+            f"finished queries: {summary['finished_queries']}"
         )
 
-        if start_time is None:
-            start_time = df["launch_time"].min()
-        if end_time is None:
-            end_time = df["finish_time"].max()
-        total_time = end_time - start_time
-
-        total_requests = launched_queries + pending_queries
-        _qps = total_requests / total_time
-
-        total_finished_requests = len(df)
-        finished_qps = total_finished_requests / total_time
-
-        total_prompt_tokens = df["prompt_tokens"].sum()
-        total_generation_tokens = df["generation_tokens"].sum()
-        average_prefill_speed = total_prompt_tokens / total_time
-        average_generation_speed = total_generation_tokens / total_time
-        average_generation_speed_per_request = (
-            df["generation_tokens"] / df["generation_time"]
-        ).mean()
-        average_ttft = df["ttft"].mean()
-        logger.info("Calculating performance summary")
+        finished_qps = summary["finished_queries"] / total_time
+        average_prefill_speed = summary["prompt_tokens"] / total_time
+        average_generation_speed = summary["generation_tokens"] / total_time
+        average_generation_speed_per_request = summary["average_generation_speed_per_request"]
+        average_ttft = summary["average_ttft"]
         print("\n")
         print("==================== Performance summary ======================")
         print(
@@ -427,7 +864,10 @@ class UserSessionManager:
             f"\033[32m{finished_qps:.4f} reqs/s\033[0m\n"
         )
 
-        print(f"  \033[33mRequests on-the-fly: {pending_queries}\033[0m\n")
+        print(f"  \033[33mRequests on-the-fly: {summary['pending_queries']}\033[0m\n")
+
+        if summary.get("failed_queries"):
+            print(f"  \033[33mFailed requests: \033[31m{summary['failed_queries']}\033[0m\n")
 
         print(
             "  \033[33mInput tokens per second: "
@@ -447,29 +887,162 @@ class UserSessionManager:
 
         print(f"  \033[33mAverage TTFT: \033[32m{average_ttft:.4f}s\033[0m\n")
 
+        if summary.get("sketches") is not None:
+            print_latency_summary(summary["sketches"])
+
+        if summary.get("chunk_times") is not None:
+            print_chunk_time_summary(summary["chunk_times"], distributions=False)
+
+        if summary.get("shared_prefix_tokens") is not None:
+            shared = summary["shared_prefix_tokens"]
+            print(
+                "  \033[33mPrompt tokens shared within a round: "
+                f"\033[32m{shared} of {summary['prompt_tokens']} "
+                f"({shared / max(summary['prompt_tokens'], 1) * 100:.2f}%)\033[0m\n"
+            )
+
+        if summary.get("endpoints") is not None:
+            for endpoint, row in summary["endpoints"].iterrows():
+                print(
+                    f"  \033[33m{endpoint}: \033[32m{int(row['requests'])} requests, "
+                    f"average TTFT {row['average_ttft']:.4f}s, "
+                    f"average queue time {row['average_queue_time']:.4f}s\033[0m\n"
+                )
+
         print(f"Time range: {start_time} - {end_time} ({total_time:.2f}s)")
 
         print("===============================================================")
         print("\n")
-        return df
+
+    @staticmethod
+    def ProcessSummary(
+        df: pd.DataFrame,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+        pending_queries: int = 0,
+        sketches: Optional[LatencySketches] = None,
+    ):
+        """
+        sketches: latency sketches of the requests, computed from df when
+        not given
+        """
+        if start_time and end_time:
+            launched_queries = int(
+                ((df["launch_time"] >= start_time) & (df["launch_time"] <= end_time)).sum()
+            )
+            df = df[(df["finish_time"] >= start_time) & (df["finish_time"] <= end_time)]
+        else:
+            launched_queries = len(df)
+
+        if start_time is None:
+            start_time = df["launch_time"].min()
+        if end_time is None:
+            end_time = df["finish_time"].max()
+
+        # Failed requests are in the CSV, not in the performance figures
+        failed = (
+            df["error"].astype(bool) if "error" in df.columns
+            else pd.Series(False, index=df.index)
+        )
+        records, df = df, df[~failed]
+
+        logger.info("Calculating performance summary")
+        summary = {
+            "start_time": start_time,
+            "end_time": end_time,
+            "launched_queries": launched_queries,
+            "finished_queries": len(df),
+            "failed_queries": int(failed.sum()),
+            "pending_queries": pending_queries,
+            "prompt_tokens": df["prompt_tokens"].sum(),
+            "generation_tokens": df["generation_tokens"].sum(),
+            "average_ttft": df["ttft"].mean(),
+            "average_generation_speed_per_request": (
+                df["generation_tokens"] / df["generation_time"]
+            ).mean(),
+            "sketches": sketches if sketches is not None else LatencySketches.from_frame(df),
+            "chunk_times": df["chunk_times"] if "chunk_times" in df.columns else None,
+            "shared_prefix_tokens": (
+                df["shared_prefix_tokens"].sum() if "shared_prefix_tokens" in df.columns else None
+            ),
+            "endpoints": (
+                df.groupby("endpoint").agg(
+                    requests=("ttft", "size"),
+                    average_ttft=("ttft", "mean"),
+                    average_queue_time=("queue_time", "mean"),
+                )
+                if "endpoint" in df.columns and df["endpoint"].nunique() > 1
+                else None
+            ),
+        }
+        UserSessionManager.PrintSummary(summary)
+        return records
+
+    @staticmethod
+    def PrintJobSummary(jobs: pd.DataFrame):
+        """
+        Print the completion time, critical path and parallelism of the
+        finished jobs (one per user)
+        """
+        if len(jobs) == 0:
+            return
+        jct = jobs["jct"]
+        critical_path = jobs["critical_path"]
+        print("\n")
+        print("======================== Job summary ==========================")
+        print(f"  \033[33mFinished jobs: \033[32m{len(jobs)}\033[0m\n")
+        print(
+            "  \033[33mJob completion time: "
+            f"\033[32mmean {jct.mean():.4f}s, p50 {jct.quantile(0.5):.4f}s, "
+            f"p99 {jct.quantile(0.99):.4f}s\033[0m\n"
+        )
+        print(
+            "  \033[33mCritical path: "
+            f"\033[32mmean {critical_path.mean():.4f}s, "
+            f"completion time / critical path {(jct / critical_path).mean():.4f}\033[0m\n"
+        )
+        print(
+            "  \033[33mAgents in parallel: "
+            f"\033[32m{jobs['parallelism'].mean():.4f} requests in flight on average, "
+            f"{jobs['parallel_share'].mean() * 100:.2f}% of the time 2 or more\033[0m\n"
+        )
+        print("===============================================================")
+        print("\n")
+
+    def job_summary(self) -> pd.DataFrame:
+        """Stats of the finished jobs"""
+        jobs = pd.DataFrame(self.jobs)
+        UserSessionManager.PrintJobSummary(jobs)
+        return jobs
+
+    def log_window(self, timestamp: float):
+        """Print the summary of the requests finished since the previous call"""
+        window = self.metrics.take_window(timestamp)
+        if window is not None:
+            UserSessionManager.PrintSummary(window)
 
     def summary(self, start_time: float, end_time: float) -> pd.DataFrame:
-        if len(self.session_summaries) == 0 and len(self.sessions) == 0:
+        """Summary computed from the full history of the run"""
+        if len(self.store) == 0:
             return pd.DataFrame()
 
-        df = pd.concat(
-            [s for s in self.session_summaries] + [s.summary() for s in self.sessions]
-        )
-        pending_queries = len([s for s in self.sessions if s.has_unfinished_request])
+        df = self.store.frame()
+        pending_queries = self.metrics.in_flight
         start_time = max(self.start_time, start_time)
         end_time = min(end_time, df["finish_time"].max())
 
         df = UserSessionManager.ProcessSummary(
-            df, start_time, end_time, pending_queries
+            df, start_time, end_time, pending_queries, self.metrics.sketches
         )
         return df
 
 
+def jobs_path(output: str) -> str:
+    """Path of the per-job stats saved next to the output CSV"""
+    root, _ = os.path.splitext(output)
+    return root + ".jobs.csv"
+
+
 def parse_arguments() -> WorkloadConfig:
     parser = argparse.ArgumentParser(description="Parse benchmark configurations.")
     parser.add_argument("--num-agents", required=True, type=int)
@@ -489,12 +1062,44 @@ def parse_arguments() -> WorkloadConfig:
         required=True,
         help="Base URL of the serving engine endpoint",
     )
-    parser.add_argument(
+    traces = parser.add_mutually_exclusive_group(required=True)
+    traces.add_argument(
         "--trace-file",
         type=str,
         nargs="+",
-        required=True,
-        help="The trace file to load the workload from",
+        help="The trace file to load the workload from, one per user",
+    )
+    traces.add_argument(
+        "--multi-user-trace",
+        type=str,
+        help="A single trace whose records carry a \"user\" key; each "
+        "user's records are read when it joins",
+    )
+    traces.add_argument(
+        "--template-trace",
+        type=str,
+        help="A single-user trace that --num-users users are instantiated from",
+    )
+    parser.add_argument(
+        "--num-users",
+        type=int,
+        default=None,
+        help="Users instantiated from --template-trace, or the first users "
+        "of --multi-user-trace to run (default: all of them)",
+    )
+    parser.add_argument(
+        "--template-jitter",
+        type=float,
+        default=0.2,
+        help="Log-space standard deviation of the random factor each "
+        "--template-trace user scales its input and output tokens by; 0 gives "
+        "every user the template as is (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed of the --template-trace users (default: %(default)s)",
     )
     parser.add_argument(
         "--output",
@@ -509,7 +1114,53 @@ def parse_arguments() -> WorkloadConfig:
         default=30,
         help="The time between two summary loggings in seconds",
     )
+    parser.add_argument(
+        "--scheduler",
+        choices=["rounds", "dag"],
+        default="rounds",
+        help="rounds: launch a round once the previous one is done and "
+        "--user-request-interval has passed. dag: launch every request as "
+        "soon as the requests of its input_from are done (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--edge-think-time",
+        type=float,
+        default=0.0,
+        help="Seconds between a dependency being done and the request using "
+        "it, unless its input_from entry has a 4th element (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--routing",
+        choices=EndpointPool.POLICIES,
+        default="static",
+        help="static: agent i always uses --base-url i. least-outstanding / "
+        "consistent-hash: routed agents may use any base URL given for the "
+        "same model, the one with the fewest unfinished requests or the one "
+        "the user id hashes to (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--routed-agents",
+        nargs="+",
+        type=int,
+        default=None,
+        help="Agents that can move between endpoints with --routing; the "
+        "others stay on their own --base-url (default: all)",
+    )
+    parser.add_argument(
+        "--max-inflight-per-endpoint",
+        type=int,
+        default=None,
+        help="Maximum requests in flight per endpoint, the next ones wait on "
+        "the client (default: unlimited)",
+    )
+    add_transport_arguments(parser)
+    add_metrics_arguments(parser)
+    add_token_prompt_arguments(parser)
     args = parser.parse_args()
+    if args.template_trace is not None and args.num_users is None:
+        parser.error("--template-trace needs --num-users")
+    if args.num_users is not None and args.trace_file is not None:
+        parser.error("--num-users needs --multi-user-trace or --template-trace")
     return args, parser
 
 
@@ -529,8 +1180,20 @@ def main():
         assert len(args.base_url) == 1
         base_url = args.base_url * args.num_agents
 
+    token_prompts = None
+    if args.token_ids:
+        if args.tokenizer is None and len(set(model)) > 1:
+            parser.error("--token-ids with several models needs --tokenizer")
+        token_prompts = TokenPromptCache(load_tokenizer(args.tokenizer or model[0]))
+
     executor = RequestExecutor(
-        base_url=base_url, model=model
+        base_url=base_url,
+        model=model,
+        transport_args=args,
+        routing=args.routing,
+        max_inflight=args.max_inflight_per_endpoint,
+        routed_agents=args.routed_agents,
+        token_prompts=token_prompts,
     )
 
     workload_config = WorkloadConfig(
@@ -539,11 +1202,23 @@ def main():
         user_request_interval=args.user_request_interval,
         new_user_interval=args.new_user_interval,
         trace_file=args.trace_file,
+        scheduler=args.scheduler,
+        edge_think_time=args.edge_think_time,
+        multi_user_trace=args.multi_user_trace,
+        template_trace=args.template_trace,
+        num_users=args.num_users,
+        template_jitter=args.template_jitter,
+        seed=args.seed,
     )
 
     manager = UserSessionManager(
-        workload_config
+        workload_config, AgentPrompts(token_prompts)
     )
+    live = start_live_metrics(args, executor.loop)
+    if live is not None:
+        live.active_sessions = lambda: len(manager.sessions)
+        manager.metrics.live = live
+        logger.info(f"Serving metrics on port {args.metrics_port}")
 
     start_time = time.time()
     last_summary_time = start_time
@@ -553,8 +1228,8 @@ def main():
             time.sleep(step_interval)
 
             if time.time() - last_summary_time > args.log_interval:
-                manager.summary(last_summary_time, time.time())
                 last_summary_time = time.time()
+                manager.log_window(last_summary_time)
 
             if not continue_flag:
                 break
@@ -567,6 +1242,10 @@ def main():
     logger.info(f"Finished benchmarking, dumping summary to {args.output}")
     summary = manager.summary(0, time.time())
     summary.to_csv(args.output, index=False)
+    manager.metrics.sketches.save(sketch_path(args.output))
+    jobs = manager.job_summary()
+    if len(jobs) > 0:
+        jobs.to_csv(jobs_path(args.output), index=False)
 
 
 if __name__ == "__main__":
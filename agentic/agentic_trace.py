@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Sources of the per-user traces of agentic-qa.py, read lazily as users join.
+
+A user's trace is a list of round records (see the README) plus the token
+sizes of the shared contexts it uses. Three sources are supported:
+
+- ``TraceFiles``: one JSONL file per user (``--trace-file``).
+- ``MultiUserTrace``: a single JSONL file whose round records carry a
+  ``"user"`` key (``--multi-user-trace``). Only the byte offsets of every
+  user's lines are kept in memory; a user's records are parsed when it joins.
+  Lines without a user that only hold ``"contexts"`` apply to every user.
+- ``TemplateUsers``: ``--num-users`` users instantiated from one template
+  trace (``--template-trace``), with their token counts randomized per user.
+
+A trace is checked when it is read: every shared context it uses must have
+a size, and its input_from dependencies must not form a cycle (see JobGraph).
+
+Per-user files can be merged into a multi-user trace with:
+
+    python3 agentic_trace.py --output users.jsonl user1.jsonl user2.jsonl ...
+"""
+
+import argparse
+import json
+import logging
+import re
+from array import array
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from utils import init_logger
+
+logger = init_logger(__name__, logging.INFO)
+
+USER_PATTERN = re.compile(rb'"user"\s*:\s*("(?:[^"\\]|\\.)*"|-?\d+)')
+
+
+def _add_contexts(contexts: Dict[str, int], record: dict):
+    for context_id, tokens in record.get("contexts", {}).items():
+        contexts[str(context_id)] = int(tokens)
+
+
+def check_contexts(name: str, trace: List[dict], contexts: Dict[str, int]):
+    """Raise if a request uses a shared context whose size is not given"""
+    for record in trace:
+        for context_ids in record.get("shared_context") or []:
+            if context_ids is None:
+                continue
+            if not isinstance(context_ids, list):
+                context_ids = [context_ids]
+            for context_id in context_ids:
+                if str(context_id) not in contexts:
+                    raise ValueError(
+                        f"{name}: shared context {context_id} is not in any "
+                        "\"contexts\" of the trace"
+                    )
+
+
+class JobGraph:
+    """
+    Data dependencies between the requests of a user's trace.
+
+    A node is one request, identified by its (round, agent). Every
+    [round, agent, kind] entry of a request's input_from is an edge from that
+    upstream request: an "output" or "both" edge is satisfied once the
+    upstream request finishes, an "input" edge once it is launched (its query
+    then exists). An optional fourth element is the think time of the edge in
+    seconds, default_think_time otherwise.
+    """
+
+    def __init__(self, trace: List[dict], default_think_time: float = 0.0):
+        # Node -> (round, request index in the round)
+        self.nodes = []
+        self.node_of = {}
+        for round_id, record in enumerate(trace):
+            for request_id, agentID in enumerate(record["agent_id"]):
+                self.node_of[(round_id, agentID)] = len(self.nodes)
+                self.nodes.append((round_id, request_id))
+
+        # Node -> [(upstream node, event, think time)], event is "launch" or "finish"
+        self.upstream = [[] for _ in self.nodes]
+        # Upstream node -> event -> [(node, think time)]
+        self.downstream = [{"launch": [], "finish": []} for _ in self.nodes]
+        for node, (round_id, request_id) in enumerate(self.nodes):
+            for i_f in trace[round_id]["input_from"][request_id]:
+                upstream = self.node_of.get((i_f[0], i_f[1]))
+                if upstream is None:
+                    # Reported by check_dependencies when the trace is loaded
+                    continue
+                event = "launch" if i_f[2] == "input" else "finish"
+                think_time = i_f[3] if len(i_f) > 3 else default_think_time
+                self.upstream[node].append((upstream, event, think_time))
+                self.downstream[upstream][event].append((node, think_time))
+        self.order = self._topological_order()
+
+    def _topological_order(self) -> List[int]:
+        num_upstream = [len(edges) for edges in self.upstream]
+        order = [node for node, count in enumerate(num_upstream) if count == 0]
+        for node in order:
+            for event in ("launch", "finish"):
+                for child, _ in self.downstream[node][event]:
+                    num_upstream[child] -= 1
+                    if num_upstream[child] == 0:
+                        order.append(child)
+        if len(order) != len(self.nodes):
+            raise ValueError("the input_from dependencies of the trace have a cycle")
+        return order
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def critical_path(self, durations: List[float]) -> float:
+        """
+        Length (s) of the longest dependency chain with the given request
+        durations and the think times: the shortest possible job completion
+        time with those latencies
+        """
+        finish = [0.0] * len(self.nodes)
+        for node in self.order:
+            start = 0.0
+            for upstream, event, think_time in self.upstream[node]:
+                ready = finish[upstream]
+                if event == "launch":
+                    ready -= durations[upstream]
+                start = max(start, ready + think_time)
+            finish[node] = start + durations[node]
+        return max(finish, default=0.0)
+
+
+def check_dependencies(name: str, trace: List[dict]):
+    """
+    Raise if the input_from dependencies of the trace have a cycle, and warn
+    about the ones on requests that are not in the trace
+    """
+    try:
+        graph = JobGraph(trace)
+    except ValueError as e:
+        raise ValueError(f"{name}: {e}") from None
+    for round_id, record in enumerate(trace):
+        for input_from in record["input_from"]:
+            for i_f in input_from:
+                if (i_f[0], i_f[1]) not in graph.node_of:
+                    logger.warning(
+                        f"{name}: round {round_id} depends on missing agent {i_f[1]} "
+                        f"of round {i_f[0]}"
+                    )
+
+
+def load_trace(trace_file: str) -> Tuple[List[dict], Dict[str, int]]:
+    """Round records and shared context sizes of a single-user trace file"""
+    trace = []
+    contexts = {}
+    with open(trace_file, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            _add_contexts(contexts, record)
+            if "agent_id" in record:
+                trace.append(record)
+    check_contexts(trace_file, trace, contexts)
+    check_dependencies(trace_file, trace)
+    return trace, contexts
+
+
+class TraceFiles:
+    """One trace file per user, each read when its user joins"""
+
+    def __init__(self, trace_files: List[str]):
+        self.trace_files = trace_files
+
+    def __len__(self) -> int:
+        return len(self.trace_files)
+
+    def __getitem__(self, idx: int) -> Tuple[List[dict], Dict[str, int]]:
+        return load_trace(self.trace_files[idx])
+
+
+class MultiUserTrace:
+    """
+    Users of a multi-user JSONL trace, in the order of their first line.
+    """
+
+    def __init__(self, trace_path: str, max_users: int = None):
+        self.trace_path = trace_path
+        # User key -> byte offsets of its lines
+        self.offsets = {}
+        self.global_contexts = {}
+        with open(trace_path, "rb") as f:
+            offset = 0
+            for line_num, line in enumerate(f, 1):
+                line_offset = offset
+                offset += len(line)
+                if not line.strip():
+                    continue
+                # Parsing every line dominates the scan, so only the user key
+                # is extracted when it can be
+                match = USER_PATTERN.search(line)
+                if match is not None:
+                    user = match.group(1).decode()
+                else:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        logger.warning(f"Failed to parse line {line_num}: {e}")
+                        continue
+                    if "user" not in record:
+                        _add_contexts(self.global_contexts, record)
+                        continue
+                    user = json.dumps(record["user"])
+                if user not in self.offsets:
+                    if max_users is not None and len(self.offsets) >= max_users:
+                        continue
+                    self.offsets[user] = array("q")
+                self.offsets[user].append(line_offset)
+        self.users = list(self.offsets)
+        logger.info(f"Indexed {len(self.users)} users of {trace_path}")
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def __getitem__(self, idx: int) -> Tuple[List[dict], Dict[str, int]]:
+        trace = []
+        contexts = dict(self.global_contexts)
+        with open(self.trace_path, "rb") as f:
+            for offset in self.offsets[self.users[idx]]:
+                f.seek(offset)
+                record = json.loads(f.readline())
+                _add_contexts(contexts, record)
+                if "agent_id" in record:
+                    trace.append(record)
+        name = f"{self.trace_path} user {self.users[idx]}"
+        check_contexts(name, trace, contexts)
+        check_dependencies(name, trace)
+        return trace, contexts
+
+
+class TemplateUsers:
+    """
+    Users instantiated from a template trace. Every user gets the template's
+    rounds and dependencies, with its input_tokens and output_tokens
+    multiplied by random factors (lognormal with mean 1 and log-space
+    standard deviation jitter), drawn from a generator seeded by (seed, user)
+    so that any user can be rebuilt on its own. Shared context sizes are kept,
+    so users still share their contexts.
+    """
+
+    def __init__(self, template_file: str, num_users: int, jitter: float = 0.0, seed: int = 0):
+        self.template, self.contexts = load_trace(template_file)
+        self.num_users = num_users
+        self.jitter = jitter
+        self.seed = seed
+
+    def __len__(self) -> int:
+        return self.num_users
+
+    def _jittered(self, values: List[int], rng: np.random.Generator) -> List[int]:
+        factors = rng.lognormal(-self.jitter ** 2 / 2, self.jitter, len(values))
+        return [max(1, int(round(value * factor))) for value, factor in zip(values, factors)]
+
+    def __getitem__(self, idx: int) -> Tuple[List[dict], Dict[str, int]]:
+        if self.jitter <= 0:
+            return self.template, self.contexts
+        rng = np.random.default_rng([self.seed, idx])
+        trace = []
+        for record in self.template:
+            record = dict(record)
+            for field in ("input_tokens", "output_tokens"):
+                if record.get(field) is not None:
+                    record[field] = self._jittered(record[field], rng)
+            trace.append(record)
+        return trace, self.contexts
+
+
+def merge(trace_files: List[str], output: str):
+    """Write per-user trace files as one multi-user trace, user i from file i"""
+    with open(output, "w", encoding="utf-8") as out:
+        for user, trace_file in enumerate(trace_files, start=1):
+            trace, contexts = load_trace(trace_file)
+            if contexts:
+                out.write(json.dumps({"user": user, "contexts": contexts}) + "\n")
+            for record in trace:
+                out.write(json.dumps(dict(record, user=user)) + "\n")
+    logger.info(f"Merged {len(trace_files)} traces into {output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge per-user agentic traces into one multi-user trace.")
+    parser.add_argument("trace_files", nargs="+", help="Per-user traces (JSONL), user i from file i")
+    parser.add_argument("--output", required=True, help="Multi-user trace to write (JSONL)")
+    args = parser.parse_args()
+    merge(args.trace_files, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of ChatHistory.get_messages_for_openai in agentic-qa.py.
+
+Fills the history of one user with --num-agents agents over a growing number
+of rounds, then times the assembly of the messages of a request of the last
+round with --fan-in input_from edges to random earlier requests. With the
+indexed history the cost per request stays flat as the rounds grow; the
+linear scan it replaced is timed alongside for reference (and checked to
+return the same messages).
+
+    python3 bench_chat_history.py --rounds 10 100 1000 5000
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import time
+
+spec = importlib.util.spec_from_file_location(
+    "agentic_qa", os.path.join(os.path.dirname(os.path.abspath(__file__)), "agentic-qa.py")
+)
+agentic_qa = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(agentic_qa)
+
+
+def linear_messages(history: list, input_from: list, agentID: int, roundID: int) -> list:
+    """Message assembly by scanning the whole history for every edge"""
+    messages = []
+    for i_f in input_from:
+        name = f"agent{i_f[1]}-{i_f[0]}"
+        if i_f[2] in ("input", "both"):
+            messages.extend(
+                [entry for entry in history if entry["role"] == "user" and entry["name"] == name]
+            )
+        if i_f[2] in ("output", "both"):
+            messages.extend(
+                [entry for entry in history if entry["role"] == "assistant" and entry["name"] == name]
+            )
+    name = f"agent{agentID}-{roundID}"
+    messages.extend([entry for entry in history if entry["role"] == "user" and entry["name"] == name])
+    return messages
+
+
+def time_per_call(func, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the agentic chat history.")
+    parser.add_argument("--rounds", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--num-agents", type=int, default=8)
+    parser.add_argument("--fan-in", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    print(f"{'rounds':>8} {'messages':>10} {'indexed (us)':>14} {'linear scan (us)':>18}")
+    for num_rounds in args.rounds:
+        chat_history = agentic_qa.ChatHistory()
+        flat_history = []
+        for round_id in range(num_rounds):
+            for agent in range(args.num_agents):
+                chat_history.on_user_query("hihihihihi", agent, round_id)
+                chat_history.on_system_response("answer", agent, round_id)
+                flat_history.append({"role": "user", "name": f"agent{agent}-{round_id}",
+                                     "content": "hihihihihi"})
+                flat_history.append({"role": "assistant", "name": f"agent{agent}-{round_id}",
+                                     "content": "answer"})
+
+        last_round = num_rounds - 1
+        input_from = [
+            [rng.randrange(max(last_round, 1)), rng.randrange(args.num_agents),
+             rng.choice(["input", "output", "both"])]
+            for _ in range(args.fan_in)
+        ]
+        indexed = chat_history.get_messages_for_openai(input_from, 0, last_round)
+        assert indexed == linear_messages(flat_history, input_from, 0, last_round)
+
+        indexed_time = time_per_call(
+            lambda: chat_history.get_messages_for_openai(input_from, 0, last_round), args.repeat
+        )
+        linear_time = time_per_call(
+            lambda: linear_messages(flat_history, input_from, 0, last_round),
+            max(1, args.repeat // num_rounds),
+        )
+        print(f"{num_rounds:>8} {len(chat_history):>10} {indexed_time * 1e6:>14.2f} "
+              f"{linear_time * 1e6:>18.2f}")
+
+
+if __name__ == "__main__":
+    main()
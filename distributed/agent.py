@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+agent.py – load generator agent for multi-host benchmarks
+=========================================================
+
+Runs on every load generator host. It exposes a small HTTP API through which
+``coordinator.py`` measures the host's clock offset, starts one benchmark
+script (``multi-round-qa.py`` or ``sharegpt-qa.py``) with the arguments of
+its shard, polls it, and streams or downloads its per-request records:
+
+    GET  /time                  -> {"time": <epoch seconds>}
+    POST /jobs                  -> {"job_id": ...}, body {"benchmark", "args"}
+    GET  /jobs/<id>             -> {"state", "returncode"}
+    GET  /jobs/<id>/log         -> last lines of the benchmark output
+    GET  /jobs/<id>/records     -> the benchmark's per-request CSV
+    GET  /jobs/<id>/records?offset=<n>
+                                -> the per-request records streamed since byte
+                                   n, as CSV lines (the header from offset 0),
+                                   with the next offset in X-Next-Offset
+    GET  /jobs/<id>/sketch      -> the benchmark's latency sketches (JSON)
+
+Only the benchmark scripts of this repository can be started.
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The benchmarks' shared helpers, see sync_utils.py
+sys.path.insert(0, os.path.join(REPO_ROOT, "synthetic-multi-round-qa"))
+
+from utils import init_logger, records_path, sketch_path  # noqa: E402
+
+logger = init_logger(__name__, logging.INFO)
+
+
+BENCHMARKS = {
+    "synthetic": os.path.join(REPO_ROOT, "synthetic-multi-round-qa", "multi-round-qa.py"),
+    "sharegpt": os.path.join(REPO_ROOT, "sharegpt", "sharegpt-qa.py"),
+}
+
+
+class Job:
+    def __init__(self, benchmark: str, args: list, workdir: str):
+        self.job_id = uuid.uuid4().hex[:12]
+        self.output = os.path.join(workdir, f"{self.job_id}.csv")
+        self.log_path = os.path.join(workdir, f"{self.job_id}.log")
+        self.records = records_path(self.output)
+        command = [sys.executable, BENCHMARKS[benchmark]] + args + [
+            "--output", self.output, "--stream-records"
+        ]
+        logger.info(f"Starting job {self.job_id}: {' '.join(command)}")
+        # The benchmark writes through its own copy of the descriptor, so the
+        # agent's is closed as soon as the process has started
+        with open(self.log_path, "wb") as log_file:
+            self.process = subprocess.Popen(
+                command, cwd=workdir, stdout=log_file, stderr=subprocess.STDOUT
+            )
+
+    def status(self) -> dict:
+        returncode = self.process.poll()
+        if returncode is None:
+            state = "running"
+        elif returncode == 0 and os.path.exists(self.output):
+            state = "finished"
+        else:
+            state = "failed"
+        return {"job_id": self.job_id, "state": state, "returncode": returncode}
+
+    def log_tail(self, num_lines: int = 50) -> str:
+        with open(self.log_path, "r", errors="replace") as f:
+            return "".join(f.readlines()[-num_lines:])
+
+    def streamed_records(self, offset: int) -> bytes:
+        """Complete lines of the streamed records from byte offset on"""
+        if not os.path.exists(self.records):
+            return b""
+        with open(self.records, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        # The benchmark may be halfway through writing the last line
+        return data[: data.rfind(b"\n") + 1]
+
+
+class AgentHandler(BaseHTTPRequestHandler):
+    # Set by serve()
+    jobs = {}
+    workdir = "."
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, payload: dict, status: int = 200):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _get_job(self, job_id: str):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            self._send_json({"error": f"unknown job {job_id}"}, 404)
+        return job
+
+    def do_GET(self):
+        path, _, query = self.path.partition("?")
+        parts = [p for p in path.split("/") if p]
+        params = urllib.parse.parse_qs(query)
+        if parts == ["time"]:
+            self._send_json({"time": time.time()})
+            return
+        if len(parts) < 2 or parts[0] != "jobs":
+            self._send_json({"error": f"unknown path {self.path}"}, 404)
+            return
+        job = self._get_job(parts[1])
+        if job is None:
+            return
+        if len(parts) == 2:
+            self._send_json(job.status())
+        elif parts[2] == "log":
+            self._send_json({"log": job.log_tail()})
+        elif parts[2] == "records" and "offset" in params:
+            offset = int(params["offset"][0])
+            data = job.streamed_records(offset)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/csv")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("X-Next-Offset", str(offset + len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif parts[2] in ("records", "sketch"):
+            if job.status()["state"] != "finished":
+                self._send_json({"error": "job has not finished"}, 409)
+                return
+            if parts[2] == "records":
+                path, content_type = job.output, "text/csv"
+            else:
+                path, content_type = sketch_path(job.output), "application/json"
+            if not os.path.exists(path):
+                self._send_json({"error": f"job has no {parts[2]}"}, 404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(os.path.getsize(path)))
+            self.end_headers()
+            with open(path, "rb") as f:
+                shutil.copyfileobj(f, self.wfile)
+        else:
+            self._send_json({"error": f"unknown path {self.path}"}, 404)
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            self._send_json({"error": f"unknown path {self.path}"}, 404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        benchmark = request.get("benchmark")
+        if benchmark not in BENCHMARKS:
+            self._send_json({"error": f"unknown benchmark {benchmark}"}, 400)
+            return
+        job = Job(benchmark, [str(a) for a in request.get("args", [])], self.workdir)
+        with self.lock:
+            self.jobs[job.job_id] = job
+        self._send_json(job.status())
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Agent that runs benchmark shards for coordinator.py.")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8100,
+                        help="Port to listen on (default: %(default)s)")
+    parser.add_argument("--workdir", default=".",
+                        help="Working directory of the benchmark runs, where "
+                             "their CSVs and logs are written (default: %(default)s)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+    AgentHandler.workdir = os.path.abspath(args.workdir)
+    server = ThreadingHTTPServer((args.host, args.port), AgentHandler)
+    logger.info(f"Agent listening on http://{args.host}:{args.port}, "
+                f"workdir {AgentHandler.workdir}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Agent stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+coordinator.py – drive one benchmark from several load generator hosts
+======================================================================
+
+Starts ``multi-round-qa.py`` or ``sharegpt-qa.py`` through the ``agent.py``
+running on each load generator host. Every agent runs one shard of the global
+workload (``--num-shards`` / ``--shard-index``: disjoint user ids and its share
+of the QPS and ramp-up, or its slice of the ShareGPT arrival schedule), and
+all of them start at the same instant, corrected for each host's clock offset.
+While they run, the per-request records they stream are polled; when they
+are done their records are fetched, moved onto the coordinator's clock,
+merged into one CSV and summarized, and their latency sketches are merged
+into one saved next to it. The records an agent streamed before its job
+failed, its host became unreachable or the coordinator was interrupted are
+merged as well.
+
+Example (everything after ``--`` is passed to the benchmark script):
+
+    python3 coordinator.py --agents host1:8100 host2:8100 --benchmark synthetic \\
+        --output merged.csv -- --num-users 320 --num-rounds 20 --qps 15 ...
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from typing import List, Optional
+
+import pandas as pd
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The benchmarks' shared helpers, see sync_utils.py
+sys.path.insert(0, os.path.join(REPO_ROOT, "synthetic-multi-round-qa"))
+
+from utils import LatencySketches, init_logger, print_latency_summary, sketch_path  # noqa: E402
+
+logger = init_logger(__name__, logging.INFO)
+
+SUMMARY_SCRIPT = os.path.join(REPO_ROOT, "synthetic-multi-round-qa", "multi-round-qa.py")
+TIME_COLUMNS = ["launch_time", "finish_time", "scheduled_time"]
+
+
+class AgentClient:
+    def __init__(self, address: str):
+        if not address.startswith("http"):
+            address = "http://" + address
+        self.url = address.rstrip("/")
+        self.clock_offset = 0.0
+        self.job_id: Optional[str] = None
+        # "running", "finished" or "failed"
+        self.state = "running"
+        # Complete CSV lines of the records streamed so far
+        self.streamed = bytearray()
+
+    def _request(self, path: str, payload: Optional[dict] = None, timeout: float = 10) -> bytes:
+        data = json.dumps(payload).encode() if payload is not None else None
+        request = urllib.request.Request(
+            self.url + path, data=data, headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.read()
+
+    def _get_json(self, path: str) -> dict:
+        return json.loads(self._request(path))
+
+    def measure_clock_offset(self, num_samples: int = 5) -> float:
+        """Offset of the agent's clock from ours, from the lowest-RTT probe"""
+        best_rtt = None
+        for _ in range(num_samples):
+            sent = time.time()
+            remote = self._get_json("/time")["time"]
+            received = time.time()
+            if best_rtt is None or received - sent < best_rtt:
+                best_rtt = received - sent
+                self.clock_offset = remote - (sent + received) / 2
+        logger.info(f"Agent {self.url}: clock offset {self.clock_offset * 1000:.2f}ms, "
+                    f"RTT {best_rtt * 1000:.2f}ms")
+        return self.clock_offset
+
+    def start_job(self, benchmark: str, args: List[str]):
+        status = json.loads(self._request("/jobs", {"benchmark": benchmark, "args": args}))
+        self.job_id = status["job_id"]
+        logger.info(f"Agent {self.url}: started job {self.job_id}")
+
+    def status(self) -> dict:
+        return self._get_json(f"/jobs/{self.job_id}")
+
+    def log_tail(self) -> str:
+        return self._get_json(f"/jobs/{self.job_id}/log")["log"]
+
+    def _on_our_clock(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Move the agent's timestamps onto the coordinator's clock"""
+        for column in TIME_COLUMNS:
+            if column in df.columns:
+                df[column] = df[column] - self.clock_offset
+        return df
+
+    def records(self) -> pd.DataFrame:
+        data = self._request(f"/jobs/{self.job_id}/records", timeout=300)
+        return self._on_our_clock(pd.read_csv(io.BytesIO(data)))
+
+    def poll_records(self):
+        """Fetch the records the job streamed since the previous poll"""
+        self.streamed += self._request(
+            f"/jobs/{self.job_id}/records?offset={len(self.streamed)}", timeout=60
+        )
+
+    def streamed_records(self) -> Optional[pd.DataFrame]:
+        """The records streamed so far, None if there are none"""
+        if self.streamed.count(b"\n") < 2:
+            return None
+        return self._on_our_clock(pd.read_csv(io.BytesIO(bytes(self.streamed))))
+
+    def sketches(self) -> LatencySketches:
+        return LatencySketches.from_dict(json.loads(self._request(f"/jobs/{self.job_id}/sketch")))
+
+
+def parse_args():
+    argv = sys.argv[1:]
+    benchmark_args = []
+    if "--" in argv:
+        split = argv.index("--")
+        argv, benchmark_args = argv[:split], argv[split + 1:]
+
+    parser = argparse.ArgumentParser(
+        description="Run one benchmark from several load generator hosts. "
+                    "Arguments after '--' are passed to the benchmark script.")
+    parser.add_argument("--agents", nargs="+", required=True,
+                        help="host:port of the agent.py on each load generator host")
+    parser.add_argument("--benchmark", choices=["synthetic", "sharegpt"], required=True,
+                        help="Benchmark script to run on the agents")
+    parser.add_argument("--start-delay", type=float, default=30,
+                        help="Seconds between submitting the jobs and the synchronized "
+                             "start; must cover the scripts' warm-up (default: %(default)s)")
+    parser.add_argument("--poll-interval", type=float, default=5,
+                        help="Seconds between two job status polls (default: %(default)s)")
+    parser.add_argument("--output", default="summary.csv",
+                        help="Merged output CSV (default: %(default)s)")
+    args = parser.parse_args(argv)
+    return args, benchmark_args
+
+
+def wait_for_jobs(agents: List[AgentClient], poll_interval: float):
+    """
+    Poll the agents' streamed records until all jobs are done, leaving the
+    outcome of each in its state
+    """
+    pending = list(agents)
+    while len(pending) > 0:
+        time.sleep(poll_interval)
+        num_pending = len(pending)
+        for agent in list(pending):
+            try:
+                state = agent.status()
+                # The final poll gets the records of the job's last moments
+                agent.poll_records()
+            except OSError as e:
+                logger.error(f"Agent {agent.url}: unreachable ({e}), keeping the "
+                             f"records it streamed so far")
+                agent.state = "failed"
+                pending.remove(agent)
+                continue
+            if state["state"] == "running":
+                continue
+            pending.remove(agent)
+            agent.state = state["state"]
+            if agent.state == "finished":
+                logger.info(f"Agent {agent.url}: job finished")
+            else:
+                logger.error(f"Agent {agent.url}: job failed with return code "
+                             f"{state['returncode']}:\n{agent.log_tail()}")
+        if len(pending) < num_pending:
+            logger.info(f"{len(agents) - len(pending)}/{len(agents)} jobs done")
+
+
+def collect_results(agent: AgentClient):
+    """
+    (records, latency sketches) of an agent: the job's output when it
+    finished, otherwise the records it streamed (None if there are none)
+    """
+    if agent.state == "finished":
+        try:
+            return agent.records(), agent.sketches()
+        except OSError as e:
+            logger.error(f"Agent {agent.url}: failed to fetch the results ({e})")
+    elif agent.state == "running":
+        # Interrupted: pick up what was streamed since the last poll
+        try:
+            agent.poll_records()
+        except OSError as e:
+            logger.error(f"Agent {agent.url}: unreachable ({e})")
+    df = agent.streamed_records()
+    if df is None:
+        return None, None
+    logger.warning(f"Agent {agent.url}: merging the {len(df)} records its "
+                   f"{agent.state} job streamed")
+    return df, LatencySketches.from_frame(df)
+
+
+def main():
+    args, benchmark_args = parse_args()
+    agents = [AgentClient(address) for address in args.agents]
+    for agent in agents:
+        agent.measure_clock_offset()
+
+    start_at = time.time() + args.start_delay
+    for shard_index, agent in enumerate(agents):
+        agent.start_job(args.benchmark, benchmark_args + [
+            "--num-shards", str(len(agents)),
+            "--shard-index", str(shard_index),
+            "--start-at", repr(start_at + agent.clock_offset),
+        ])
+    logger.info(f"Benchmark starts in {start_at - time.time():.2f} secs on {len(agents)} agents")
+
+    try:
+        wait_for_jobs(agents, args.poll_interval)
+    except KeyboardInterrupt:
+        logger.info("Interrupted, the agents' jobs keep running; merging the "
+                    "records streamed so far")
+
+    frames = []
+    sketches = LatencySketches()
+    for agent in agents:
+        df, agent_sketches = collect_results(agent)
+        if df is None:
+            continue
+        df["agent"] = agent.url
+        frames.append(df)
+        sketches.merge(agent_sketches)
+    if len(frames) == 0:
+        logger.error("No agent returned records, nothing to merge")
+        sys.exit(1)
+    merged = pd.concat(frames).sort_values("launch_time").reset_index(drop=True)
+    merged.to_csv(args.output, index=False)
+    sketches.save(sketch_path(args.output))
+    logger.info(f"Merged {len(merged)} records from {len(frames)} agents into {args.output}")
+    logger.info("Latency percentiles of the merged sketches:")
+    print_latency_summary(sketches)
+
+    subprocess.run([sys.executable, SUMMARY_SCRIPT, "--process-summary", args.output],
+                   cwd=os.path.dirname(SUMMARY_SCRIPT), check=False)
+    if any(agent.state != "finished" for agent in agents):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
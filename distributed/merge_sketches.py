@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+merge_sketches.py – merge the latency sketches of several runs
+==============================================================
+
+Every benchmark saves the latency sketches of its run next to its output CSV
+(``<output>.sketch.json``). Merging them is exact, so the percentiles of, say,
+several runs or hosts can be reported without their per-request records:
+
+    python3 merge_sketches.py run1.sketch.json run2.sketch.json --output all.sketch.json
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The benchmarks' shared helpers, see sync_utils.py
+sys.path.insert(0, os.path.join(REPO_ROOT, "synthetic-multi-round-qa"))
+
+from utils import LatencySketches, init_logger, print_latency_summary  # noqa: E402
+
+logger = init_logger(__name__, logging.INFO)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Merge latency sketches and print their percentiles.")
+    parser.add_argument("sketches", nargs="+",
+                        help="Sketch files saved by the benchmarks (*.sketch.json)")
+    parser.add_argument("--output", default=None,
+                        help="Where to save the merged sketches (default: not saved)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    merged = LatencySketches()
+    for path in args.sketches:
+        merged.merge(LatencySketches.load(path))
+    logger.info(f"Merged {len(args.sketches)} sketches, "
+                f"{merged['ttft'].count} requests")
+    print_latency_summary(merged)
+    if args.output is not None:
+        merged.save(args.output)
+        logger.info(f"Merged sketches saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+mock_server.py – stand-in OpenAI-compatible streaming server
+=============================================================
+
+Answers /v1/completions and /v1/chat/completions with a fixed time to first
+token and inter-token latency, so the load generators (and the coordinator /
+agent setup) can be exercised on one box without a GPU. Every request
+generates exactly ``max_tokens`` tokens of " hi"; the prompt token count is
+its number of whitespace-separated words (or the length of a token-id list).
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The benchmarks' shared helpers, see sync_utils.py
+sys.path.insert(0, os.path.join(REPO_ROOT, "synthetic-multi-round-qa"))
+
+from utils import init_logger  # noqa: E402
+
+logger = init_logger(__name__, logging.INFO)
+
+
+class MockEngine:
+    def __init__(self, ttft: float, itl: float, default_max_tokens: int, tokens_per_chunk: int = 1):
+        self.ttft = ttft
+        self.itl = itl
+        self.tokens_per_chunk = tokens_per_chunk
+        self.default_max_tokens = default_max_tokens
+        self.num_requests = 0
+
+    @staticmethod
+    def _count_prompt_tokens(request: dict, chat: bool) -> int:
+        if chat:
+            return sum(len(str(m.get("content", "")).split()) for m in request.get("messages", []))
+        prompt = request.get("prompt", "")
+        if isinstance(prompt, list):
+            return len(prompt)
+        return len(str(prompt).split())
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, value = line.decode().split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                await self._dispatch(method, path, body, writer)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, path: str, body: bytes, writer: asyncio.StreamWriter):
+        path = path.split("?", 1)[0].rstrip("/")
+        if method == "GET" and path.endswith("/models"):
+            payload = {"object": "list", "data": [{"id": "mock", "object": "model"}]}
+            self._write_json(writer, payload)
+        elif method == "POST" and path.endswith("/completions"):
+            await self._complete(json.loads(body or b"{}"), path.endswith("chat/completions"), writer)
+        else:
+            writer.write(b"HTTP/1.1 404 Not Found\r\ncontent-length: 0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    def _write_json(writer: asyncio.StreamWriter, payload: dict):
+        data = json.dumps(payload).encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\ncontent-type: application/json\r\n"
+            b"content-length: %d\r\n\r\n%s" % (len(data), data)
+        )
+
+    async def _complete(self, request: dict, chat: bool, writer: asyncio.StreamWriter):
+        self.num_requests += 1
+        max_tokens = int(request.get("max_tokens") or self.default_max_tokens)
+        prompt_tokens = self._count_prompt_tokens(request, chat)
+        object_type = "chat.completion.chunk" if chat else "text_completion"
+        stream_options = request.get("stream_options") or {}
+        continuous_usage = stream_options.get("continuous_usage_stats", False)
+
+        def usage(completion_tokens):
+            return {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+
+        def choice(text):
+            if chat:
+                return {"index": 0, "delta": {"content": text}, "finish_reason": None}
+            return {"index": 0, "text": text, "finish_reason": None}
+
+        if not request.get("stream", False):
+            await asyncio.sleep(self.ttft + self.itl * max(0, max_tokens - 1))
+            text = " hi" * max_tokens
+            if chat:
+                message = {"role": "assistant", "content": text}
+                choices = [{"index": 0, "message": message, "finish_reason": "length"}]
+            else:
+                choices = [{"index": 0, "text": text, "finish_reason": "length"}]
+            self._write_json(writer, {
+                "id": "mock", "object": object_type.replace(".chunk", ""),
+                "created": int(time.time()), "model": request.get("model"),
+                "choices": choices, "usage": usage(max_tokens),
+            })
+            return
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\ncontent-type: text/event-stream\r\n"
+            b"transfer-encoding: chunked\r\n\r\n"
+        )
+
+        async def send(data: bytes):
+            event = b"data: " + data + b"\n\n"
+            writer.write(b"%x\r\n%s\r\n" % (len(event), event))
+            await writer.drain()
+
+        created = int(time.time())
+        await asyncio.sleep(self.ttft)
+        generated = 0
+        while generated < max_tokens:
+            # The first chunk carries one token, later ones tokens_per_chunk
+            num_tokens = 1 if generated == 0 else min(self.tokens_per_chunk, max_tokens - generated)
+            if generated > 0:
+                await asyncio.sleep(self.itl * num_tokens)
+            generated += num_tokens
+            chunk = {
+                "id": "mock", "object": object_type, "created": created,
+                "model": request.get("model"), "choices": [choice(" hi" * num_tokens)],
+            }
+            if continuous_usage:
+                chunk["usage"] = usage(generated)
+            await send(json.dumps(chunk).encode())
+        if stream_options.get("include_usage", False):
+            chunk = {
+                "id": "mock", "object": object_type, "created": created,
+                "model": request.get("model"), "choices": [], "usage": usage(max_tokens),
+            }
+            await send(json.dumps(chunk).encode())
+        await send(b"[DONE]")
+        writer.write(b"0\r\n\r\n")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Stand-in OpenAI-compatible server with fixed latencies.")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="Port to listen on (default: %(default)s)")
+    parser.add_argument("--ttft", type=float, default=0.05,
+                        help="Time to first token in seconds (default: %(default)s)")
+    parser.add_argument("--itl", type=float, default=0.01,
+                        help="Inter-token latency in seconds (default: %(default)s)")
+    parser.add_argument("--tokens-per-chunk", type=int, default=1,
+                        help="Tokens sent together in each chunk after the first, "
+                             "like a server that coalesces its output (default: %(default)s)")
+    parser.add_argument("--default-max-tokens", type=int, default=16,
+                        help="Tokens generated when max_tokens is not set "
+                             "(default: %(default)s)")
+    return parser.parse_args()
+
+
+async def serve(args: argparse.Namespace):
+    engine = MockEngine(args.ttft, args.itl, args.default_max_tokens, args.tokens_per_chunk)
+    server = await asyncio.start_server(engine.handle, args.host, args.port)
+    logger.info(f"Mock server listening on http://{args.host}:{args.port}/v1 "
+                f"(ttft={args.ttft}s, itl={args.itl}s)")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    args = parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        logger.info("Mock server stopped")
+
+
+if __name__ == "__main__":
+    main()
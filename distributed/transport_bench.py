@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+transport_bench.py – client-side cost of the request transports
+===============================================================
+
+Sends the same streaming workload through each transport (the openai SDK
+client and the pooled raw-HTTP client) at a fixed concurrency and reports, side
+by side, the client CPU time per request and the latency added on top of what
+the server produces. Run it against ``mock_server.py`` so the server-side
+latency is known exactly:
+
+    python3 mock_server.py --port 8000 --ttft 0.05 --itl 0.01 &
+    python3 transport_bench.py --base-url http://127.0.0.1:8000 \\
+        --server-ttft 0.05 --server-itl 0.01 --concurrency 512
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The benchmarks' shared helpers, see sync_utils.py
+sys.path.insert(0, os.path.join(REPO_ROOT, "synthetic-multi-round-qa"))
+
+from utils import add_transport_arguments, build_transport, init_logger  # noqa: E402
+
+logger = init_logger(__name__, logging.INFO)
+
+
+async def run_transport(args: argparse.Namespace, transport_name: str) -> dict:
+    args.transport = transport_name
+    transport = build_transport(args.base_url, args)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    ttfts = np.zeros(args.num_requests)
+    latencies = np.zeros(args.num_requests)
+    payload = {
+        "model": args.model,
+        "prompt": "hi " * args.prompt_len,
+        "max_tokens": args.max_tokens,
+        "temperature": 0.0,
+        "stream_options": {"include_usage": True},
+    }
+
+    async def one_request(idx: int):
+        async with semaphore:
+            start = time.perf_counter()
+            first_token = None
+            async for text, _ in transport.stream("completions", payload):
+                if text and first_token is None:
+                    first_token = time.perf_counter()
+            ttfts[idx] = first_token - start
+            latencies[idx] = time.perf_counter() - start
+
+    # Open the connections before measuring
+    await asyncio.gather(*[one_request(i) for i in range(min(args.concurrency, args.num_requests))])
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    await asyncio.gather(*[one_request(i) for i in range(args.num_requests)])
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() - cpu_start
+    # AsyncOpenAI.close() and httpx.AsyncClient.aclose() both release the pool
+    close = getattr(transport.client, "aclose", None) or transport.client.close
+    await close()
+
+    server_latency = args.server_ttft + args.server_itl * (args.max_tokens - 1)
+    return {
+        "transport": transport_name,
+        "cpu_ms_per_request": cpu_time / args.num_requests * 1000,
+        "cpu_utilization": cpu_time / wall_time,
+        "requests_per_s": args.num_requests / wall_time,
+        "added_ttft_p50_ms": (np.percentile(ttfts, 50) - args.server_ttft) * 1000,
+        "added_ttft_p99_ms": (np.percentile(ttfts, 99) - args.server_ttft) * 1000,
+        "added_latency_p50_ms": (np.percentile(latencies, 50) - server_latency) * 1000,
+        "added_latency_p99_ms": (np.percentile(latencies, 99) - server_latency) * 1000,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Compare the client-side cost of the request transports.")
+    parser.add_argument("--base-url", required=True,
+                        help="Base URL of the server, ideally mock_server.py")
+    parser.add_argument("--model", default="mock",
+                        help="Model name (default: %(default)s)")
+    parser.add_argument("--transports", nargs="+", default=["openai", "http"],
+                        choices=["openai", "http"],
+                        help="Transports to compare (default: %(default)s)")
+    parser.add_argument("--num-requests", type=int, default=2000,
+                        help="Measured requests per transport (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=256,
+                        help="Requests in flight (default: %(default)s)")
+    parser.add_argument("--max-tokens", type=int, default=64,
+                        help="Streamed tokens per request (default: %(default)s)")
+    parser.add_argument("--prompt-len", type=int, default=16,
+                        help="Prompt length in words (default: %(default)s)")
+    parser.add_argument("--server-ttft", type=float, default=0.0,
+                        help="TTFT the server produces, subtracted from the "
+                             "measured one (default: %(default)s)")
+    parser.add_argument("--server-itl", type=float, default=0.0,
+                        help="Inter-token latency the server produces "
+                             "(default: %(default)s)")
+    add_transport_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = []
+    for transport_name in args.transports:
+        logger.info(f"Benchmarking the {transport_name} transport")
+        results.append(asyncio.run(run_transport(args, transport_name)))
+
+    print("\n")
+    print(f"{'':24}" + "".join(f"{r['transport']:>12}" for r in results))
+    for key in results[0]:
+        if key == "transport":
+            continue
+        print(f"{key:24}" + "".join(f"{r[key]:>12.3f}" for r in results))
+    print("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+convert_openai_logs.py – anonymized Mooncake traces from OpenAI request logs
+===========================================================================
+
+Turns a JSONL log of OpenAI-format requests into a Mooncake-format trace that
+``mooncake-qa.py`` can replay, without any prompt text in it. Each prompt is
+tokenized with the served model's tokenizer (chat template included when it
+has one) and cut into ``--block-size`` token blocks. A block is identified by a
+hash chained over every block before it, so two prompts get the same id for
+their k-th block exactly when their first k blocks are equal, as in the
+published Mooncake traces. The hashes never leave the converter: they are
+numbered in order of first appearance, so the trace only holds small
+integers. Several logs converted together share the same numbering.
+
+A log line is either a request body or an object wrapping one:
+
+    {"timestamp": 1718000000.25, "messages": [...], "max_tokens": 128}
+    {"timestamp": "2024-06-10T06:13:20.250Z", "request": {"messages": [...]},
+     "response": {"usage": {"completion_tokens": 97}}}
+
+The output length is the response's ``completion_tokens`` when logged,
+otherwise ``max_tokens``. Completions requests (``prompt``) work as well.
+Tokenizing and hashing run in a process pool over batches of lines, so logs
+of any size are streamed with bounded memory.
+
+    python3 convert_openai_logs.py trace.jsonl requests-*.jsonl \\
+        --tokenizer meta-llama/Llama-3.1-8B-Instruct
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+from datetime import datetime
+from itertools import islice
+from typing import List, Optional, Tuple, Union
+
+from text_blocks import DEFAULT_BLOCK_SIZE
+from utils import chained_block_hashes, init_logger, load_tokenizer
+
+logger = init_logger(__name__, logging.INFO)
+
+# Lines handed to the pool at once, per worker
+BATCH_LINES_PER_WORKER = 1024
+
+# State of each worker process, set by _init_worker
+_tokenizer = None
+_block_size = DEFAULT_BLOCK_SIZE
+_timestamp_field = "timestamp"
+_timestamp_scale = 1000.0
+
+
+def _init_worker(tokenizer_name: str, block_size: int, timestamp_field: str,
+                 timestamp_scale: float):
+    global _tokenizer, _block_size, _timestamp_field, _timestamp_scale
+    _tokenizer = load_tokenizer(tokenizer_name)
+    _block_size = block_size
+    _timestamp_field = timestamp_field
+    _timestamp_scale = timestamp_scale
+
+
+def _text(content) -> str:
+    """Text of a message content, which may be a list of content parts"""
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content or ""
+
+
+def _prompt_tokens(body: dict) -> List[int]:
+    if "messages" in body:
+        messages = [
+            {"role": message.get("role", "user"), "content": _text(message.get("content"))}
+            for message in body["messages"]
+        ]
+        if getattr(_tokenizer, "chat_template", None):
+            return list(_tokenizer.apply_chat_template(
+                messages, tokenize=True, add_generation_prompt=True))
+        prompt = "\n".join(f"{msg['role'].upper()}: {msg['content']}" for msg in messages)
+        return _tokenizer.encode(prompt + "\nASSISTANT:")
+    prompt = body["prompt"]
+    if isinstance(prompt, list) and len(prompt) > 0 and isinstance(prompt[0], int):
+        return prompt
+    if isinstance(prompt, list):
+        prompt = "".join(prompt)
+    return _tokenizer.encode(prompt)
+
+
+def _output_length(record: dict, body: dict) -> Optional[int]:
+    for usage in (record.get("response", {}).get("usage"), record.get("usage")):
+        if usage and usage.get("completion_tokens") is not None:
+            return int(usage["completion_tokens"])
+    for field in ("max_completion_tokens", "max_tokens"):
+        if body.get(field) is not None:
+            return int(body[field])
+    return None
+
+
+def _timestamp_ms(value: Union[int, float, str]) -> float:
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp() * 1000
+    return float(value) * _timestamp_scale
+
+
+def convert_line(line: bytes) -> Tuple[Optional[tuple], Optional[str]]:
+    """
+    (timestamp_ms, input_length, output_length, block hashes) of one log line,
+    or the reason it was skipped
+    """
+    if not line.strip():
+        return None, None
+    try:
+        record = json.loads(line)
+        body = record.get("request") or record.get("body") or record
+        if "messages" not in body and "prompt" not in body:
+            return None, "no messages or prompt"
+        if record.get(_timestamp_field) is None:
+            return None, f"no {_timestamp_field}"
+        output_length = _output_length(record, body)
+        if output_length is None:
+            return None, "no completion_tokens or max_tokens"
+        token_ids = _prompt_tokens(body)
+        return (
+            _timestamp_ms(record[_timestamp_field]),
+            len(token_ids),
+            output_length,
+            chained_block_hashes(token_ids, _block_size),
+        ), None
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def _shift_timestamps(path: str, offset: int):
+    """Add offset to every timestamp of the trace at path"""
+    shifted = path + ".tmp"
+    with open(path) as src, open(shifted, "w") as dst:
+        for line in src:
+            record = json.loads(line)
+            record["timestamp"] += offset
+            dst.write(json.dumps(record) + "\n")
+    os.replace(shifted, path)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Convert OpenAI-format request logs to an anonymized Mooncake trace.")
+    parser.add_argument("output_file", help="Mooncake-format trace to write (JSONL)")
+    parser.add_argument("log_files", nargs="+",
+                        help="Request logs (JSONL), converted in this order")
+    parser.add_argument("--tokenizer", type=str, required=True,
+                        help="Tokenizer of the served model (needs transformers)")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE,
+                        help="Tokens per hash block (default: %(default)s)")
+    parser.add_argument("--timestamp-field", type=str, default="timestamp",
+                        help="Field holding the request time (default: %(default)s)")
+    parser.add_argument("--timestamp-unit", choices=["s", "ms"], default="s",
+                        help="Unit of numeric timestamps (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Tokenizer processes (default: one per CPU)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    timestamp_scale = 1000.0 if args.timestamp_unit == "s" else 1.0
+    # Block hash -> trace hash id, numbered by first appearance
+    hash_ids = {}
+    start_ms = None
+    min_timestamp = 0
+    converted = 0
+    skipped = 0
+    batch_size = BATCH_LINES_PER_WORKER * args.workers
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(
+        args.workers,
+        initializer=_init_worker,
+        initargs=(args.tokenizer, args.block_size, args.timestamp_field, timestamp_scale),
+    ) as pool, open(args.output_file, "w") as output:
+        for log_file in args.log_files:
+            with open(log_file, "rb") as log:
+                line_num = 0
+                while True:
+                    batch = list(islice(log, batch_size))
+                    if not batch:
+                        break
+                    results = pool.map(convert_line, batch, chunksize=64)
+                    for result, error in results:
+                        line_num += 1
+                        if error is not None:
+                            logger.warning(f"Skipping {log_file}:{line_num}: {error}")
+                            skipped += 1
+                        if result is None:
+                            continue
+                        timestamp_ms, input_length, output_length, hashes = result
+                        if start_ms is None:
+                            start_ms = timestamp_ms
+                        timestamp = int(round(timestamp_ms - start_ms))
+                        min_timestamp = min(min_timestamp, timestamp)
+                        record = {
+                            "timestamp": timestamp,
+                            "input_length": input_length,
+                            "output_length": output_length,
+                            "hash_ids": [hash_ids.setdefault(h, len(hash_ids)) for h in hashes],
+                        }
+                        output.write(json.dumps(record) + "\n")
+                        converted += 1
+                    logger.info(f"Converted {converted} requests ({skipped} skipped)")
+
+    # Timestamps are relative to the first line; an unordered log can have
+    # requests before it
+    if min_timestamp < 0:
+        _shift_timestamps(args.output_file, -min_timestamp)
+
+    logger.info(
+        f"Wrote {converted} requests over {len(hash_ids)} distinct blocks to "
+        f"{args.output_file} in {time.perf_counter() - start:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,36 @@
 import argparse
 import asyncio
-import json
 import logging
 import time
+from collections import deque
 from dataclasses import dataclass
-from typing import Optional
-import openai
+from typing import List, Optional
+import numpy as np
 import pandas as pd
-from utils import AsyncLoopWrapper, init_logger
+from utils import (
+    STREAM_OPTIONS,
+    AsyncLoopWrapper,
+    ChunkTimer,
+    LatencySketches,
+    ResultStore,
+    WindowedMetrics,
+    TokenPromptCache,
+    add_metrics_arguments,
+    add_token_prompt_arguments,
+    add_transport_arguments,
+    build_token_prompts,
+    build_transport,
+    init_logger,
+    load_tokenizer,
+    print_chunk_time_summary,
+    print_latency_summary,
+    sketch_path,
+    start_live_metrics,
+)
+from mooncake_trace import ConversationLinker, MooncakeTrace
+from text_blocks import DEFAULT_BLOCK_SIZE, TextBlockStore
 
 logger = init_logger(__name__, logging.INFO)
-import json
-
-def load_mooncake_data(filepath: str) -> list[dict]:
-    data = []
-    with open(filepath, "r") as file:
-        for line_num, line in enumerate(file, 1):
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                record = json.loads(line)
-                required_fields = {"hash_ids", "timestamp", "output_length"}
-                if not required_fields.issubset(record):
-                    logger.warning(f"Line {line_num} missing required fields.")
-                    continue
-                data.append(record)
-            except json.JSONDecodeError as e:
-                logger.warning(f"Failed to parse line {line_num}: {e}")
-    return data
-
-# Load the Mooncake data
-mooncake_data = load_mooncake_data("conversation_trace.jsonl")
 
 @dataclass
 class WorkloadConfig:
@@ -53,6 +52,9 @@ class WorkloadConfig:
     slowdown_factor: float = 1.0
     # prefill only
     prefill_only: bool = True
+    # How the server is kept from stopping before output_length when
+    # decoding, see EOS_SUPPRESSION
+    eos_suppression: str = "ignore_eos"
 
 
 @dataclass
@@ -71,6 +73,8 @@ class UserConfig:
     enable_user_id: bool
     # prefill only
     prefill_only: bool = True
+    # EOS suppression when decoding
+    eos_suppression: str = "ignore_eos"
 
     @staticmethod
     def new_user_config(user_id: int, workload_config: WorkloadConfig) -> "UserConfig":
@@ -82,6 +86,7 @@ class UserConfig:
             num_rounds=workload_config.num_rounds,
             enable_user_id=workload_config.enable_user_id,
             prefill_only=workload_config.prefill_only,
+            eos_suppression=workload_config.eos_suppression,
         )
 
 
@@ -91,12 +96,14 @@ class ChatHistory:
     ):
         self.history = []
 
-    def on_user_query(self, query: str):
-        if len(self.history) == 0:
-            self.history.append({"role": "user", "content": query})
-        else:
+    def on_user_query(self, query: str, token_ids: Optional[List[int]] = None):
+        """token_ids: the query as token IDs, for TokenPromptCache"""
+        if len(self.history) > 0:
             assert self.history[-1]["role"] == "assistant", "Expect system response"
-            self.history.append({"role": "user", "content": query})
+        message = {"role": "user", "content": query}
+        if token_ids is not None:
+            message["token_ids"] = token_ids
+        self.history.append(message)
 
     def on_system_response(self, response: str):
         assert len(self.history) > 0, "Expect user query"
@@ -119,47 +126,100 @@ class Response:
     generation_tokens: int
     launch_time: float
     finish_time: float
+    # Encoded arrival time and token count of each chunk, see ChunkTimer
+    chunk_times: str = ""
+    # The request failed: no tokens, and an empty body
+    error: bool = False
+
+
+# Per-request result columns, in the order of the output CSV
+RESULT_COLUMNS = {
+    "prompt_tokens": np.int64,
+    "generation_tokens": np.int64,
+    "ttft": np.float64,
+    "generation_time": np.float64,
+    "user_id": np.int64,
+    "question_id": np.int64,
+    "launch_time": np.float64,
+    "finish_time": np.float64,
+    "chunk_times": object,
+    # When the trace asked for the request, launch_time - scheduled_time is
+    # the replay drift
+    "scheduled_time": np.float64,
+    # max_tokens of the request, generation_tokens should match it
+    "requested_tokens": np.int64,
+    "error": np.bool_,
+}
+
+# Sampling parameters (vLLM/SGLang extensions) that make the server generate
+# exactly max_tokens tokens
+EOS_SUPPRESSION = {
+    "ignore_eos": lambda max_tokens: {"ignore_eos": True},
+    "min_tokens": lambda max_tokens: {"min_tokens": max_tokens},
+    "both": lambda max_tokens: {"ignore_eos": True, "min_tokens": max_tokens},
+    "none": lambda max_tokens: None,
+}
+
+# Requests launched within this many seconds of their trace time count as
+# replayed on time
+ON_TIME_TOLERANCE = 0.01
 
 
 class RequestExecutor:
-    def __init__(self, base_url: str, model: str):
-        # Ensure base_url ends with /v1
-        if not base_url.endswith('/v1'):
-            base_url = base_url.rstrip('/') + '/v1'
-        
-        # For vLLM server, we don't need an API key, but the client requires one
-        self.client = openai.AsyncOpenAI(
-            api_key="EMPTY",  # Dummy API key for vLLM server
-            base_url=base_url
-        )
+    def __init__(
+        self,
+        base_url: str,
+        model: str,
+        transport_args=None,
+        token_prompts: Optional[TokenPromptCache] = None,
+    ):
+        """
+        token_prompts: send the prompts as token IDs to the completions API
+        """
+        self.transport = build_transport(base_url, transport_args)
         self.model = model
-        logging.info(f"Initialized OpenAI client with base_url={base_url} and model={model}")
+        self.token_prompts = token_prompts
+        logging.info(f"Initialized {type(self.transport).__name__} with base_url={base_url} and model={model}")
         self.loop = AsyncLoopWrapper.GetOrStartLoop()
         self.request_history = []
 
-    async def _async_launch_request(self, messages, max_tokens, extra_headers=None):
+    async def _async_launch_request(
+        self, messages, max_tokens, extra_headers=None, extra_body=None
+    ):
         start_time = time.time()
         first_token_time = None
+        chunk_timer = ChunkTimer()
         words = ""
-        response = await self.client.chat.completions.create(
-            messages=messages,
-            model=self.model,
-            temperature=0,
-            stream=True,
-            max_tokens=max_tokens,
-            stream_options={"include_usage": True},
+        usage = None
+        if self.token_prompts is not None:
+            # Token IDs on the completions API, not tokenized by the server
+            endpoint = "completions"
+            payload = {"prompt": self.token_prompts.prompt(messages)}
+        else:
+            endpoint = "chat"
+            payload = {"messages": messages}
+        response = self.transport.stream(
+            endpoint,
+            dict(
+                payload,
+                model=self.model,
+                temperature=0,
+                max_tokens=max_tokens,
+                stream_options=STREAM_OPTIONS,
+            ),
             extra_headers=extra_headers,
+            extra_body=extra_body,
         )
-        async for tok in response:
-            if not tok.choices:
-                continue
-            chunk_message = tok.choices[0].delta.content
+        async for chunk_message, chunk_usage in response:
+            chunk_timer.on_chunk(chunk_message, chunk_usage)
+            if chunk_usage is not None:
+                usage = chunk_usage
             if chunk_message is not None:
                 if first_token_time is None and chunk_message != "":
                     first_token_time = time.time()
                 words += chunk_message
-        tokens_out = tok.usage.completion_tokens
-        tokens_prefill = tok.usage.prompt_tokens
+        tokens_out = usage["completion_tokens"]
+        tokens_prefill = usage["prompt_tokens"]
         return Response(
             body=words,
             ttft=first_token_time - start_time,
@@ -168,6 +228,7 @@ class RequestExecutor:
             generation_tokens=tokens_out,
             launch_time=start_time,
             finish_time=time.time(),
+            chunk_times=chunk_timer.encode(),
         )
 
     def launch_request(
@@ -176,14 +237,37 @@ class RequestExecutor:
         max_tokens: int,
         finish_callback,
         extra_headers=None,
+        extra_body=None,
     ):
         """
         finish_callback: Callable[[Response], None]
+        extra_body: extra fields of the request body
         """
         messages = chat_history.get_messages_for_openai()
-        real_callback = lambda x: finish_callback(x.result())
+        launch_time = time.time()
+
+        def real_callback(future):
+            try:
+                response = future.result()
+            except Exception as e:
+                # Still a finished request, so that its session and the
+                # replay go on
+                logger.error(f"Request failed: {e!r}")
+                response = Response(
+                    body="",
+                    ttft=0.0,
+                    generation_time=0.0,
+                    prompt_tokens=0,
+                    generation_tokens=0,
+                    launch_time=launch_time,
+                    finish_time=time.time(),
+                    error=True,
+                )
+            finish_callback(response)
+
         future = asyncio.run_coroutine_threadsafe(
-            self._async_launch_request(messages, max_tokens, extra_headers), self.loop
+            self._async_launch_request(messages, max_tokens, extra_headers, extra_body),
+            self.loop,
         )
         future.add_done_callback(real_callback)
 
@@ -191,34 +275,67 @@ class RequestExecutor:
 class UserSession:
     def __init__(
         self,
-        mooncake_id,
         user_config: UserConfig,
+        store: ResultStore,
+        metrics: WindowedMetrics,
+        text_blocks: TextBlockStore,
+        num_turns: int = 1,
     ):
         self.user_config = user_config
-        self.mooncake_id = mooncake_id
+        # Shared by all the sessions of the manager
+        self.store = store
+        self.metrics = metrics
+        self.text_blocks = text_blocks
+        # Trace records of the conversation replayed by this session
+        self.num_turns = num_turns
+        self.finished_turns = 0
+        # Set by the manager with --multi-turn
+        self.conversation = None
+        # Turns due while the previous one is in flight:
+        # (record, shared blocks, scheduled time, executor)
+        self.pending_turns = deque()
         self.last_request_time = None
         self.chat_history = ChatHistory()
+        # Tokens of the trace's conversation in the chat history: the
+        # input_length of the latest turn and the answers since
+        self.history_tokens = 0
         self.question_id = 0
         self.has_unfinished_request = False
         self.last_unfinished_log = 0
-        self.prompt_lengths = []
-        self.generation_lengths = []
-        self.ttfts = []
-        self.generation_times = []
-        self.launch_times = []
-        self.finish_times = []
-        self.question_ids = []
         self.finished = False
         self.prefill_only = user_config.prefill_only
+        self.inflight_scheduled_time = None
+        self.inflight_requested_tokens = None
+        # Called with the session once its request completes
+        self.finish_listener = None
 
     def _update_result(self, response: Response):
-        self.prompt_lengths.append(response.prompt_tokens)
-        self.generation_lengths.append(response.generation_tokens)
-        self.ttfts.append(response.ttft)
-        self.generation_times.append(response.generation_time)
-        self.launch_times.append(response.launch_time)
-        self.finish_times.append(response.finish_time)
-        self.question_ids.append(self.question_id - 1)
+        self.store.append(
+            prompt_tokens=response.prompt_tokens,
+            generation_tokens=response.generation_tokens,
+            ttft=response.ttft,
+            generation_time=response.generation_time,
+            user_id=self.user_config.user_id,
+            question_id=self.question_id - 1,
+            launch_time=response.launch_time,
+            finish_time=response.finish_time,
+            chunk_times=response.chunk_times,
+            scheduled_time=self.inflight_scheduled_time,
+            requested_tokens=self.inflight_requested_tokens,
+            error=response.error,
+        )
+        if response.error:
+            self.metrics.on_error()
+            return
+        self.metrics.on_finish(
+            response.prompt_tokens,
+            response.generation_tokens,
+            response.ttft,
+            response.generation_time,
+            response.finish_time - response.launch_time,
+            response.chunk_times,
+            launch_skew=response.launch_time - self.inflight_scheduled_time,
+        )
 
     def _build_system_prompt(self):
         def gen_dummy_text(length):
@@ -233,35 +350,90 @@ class UserSession:
         )
         return system_prompt
 
-    def _launch_new_request(self, timestamp: float, request_executor: RequestExecutor):
-        hash_ids = mooncake_data[self.mooncake_id]["hash_ids"]
-        prompt = ""
-        for hash_id in hash_ids:
-            prompt += f"{hash_id}" + " ".join(["hi"] * 512)
-        prompt += "Can you tell me a detailed story in 1000 words?"
+    def add_turn(
+        self,
+        record: dict,
+        shared_blocks: int,
+        timestamp: float,
+        request_executor: RequestExecutor,
+        scheduled_time: float,
+    ):
+        """
+        Send the next turn of the conversation, or queue it until the
+        previous one is answered
+        """
+        if self.has_unfinished_request:
+            self.pending_turns.append((record, shared_blocks, scheduled_time, request_executor))
+            return
+        self._launch_new_request(
+            record, shared_blocks, timestamp, request_executor, scheduled_time
+        )
+
+    def _launch_new_request(
+        self,
+        record: dict,
+        shared_blocks: int,
+        timestamp: float,
+        request_executor: RequestExecutor,
+        scheduled_time: Optional[float] = None,
+    ):
+        """
+        shared_blocks: leading hash blocks the record shares with the previous
+        turn, whose prompt and answer are in the chat history
+        scheduled_time: when the trace asked for the request, defaults to
+        timestamp
+        """
+        input_length = record.get("input_length")
+        hash_ids = record["hash_ids"]
+        # The trace's input_length of a follow-up counts the whole
+        # conversation, so the new message is only the rest of it. The
+        # history can be longer than the record (e.g. a longer answer than
+        # the trace's), the message then keeps one token
+        end = self.text_blocks.prompt_length(hash_ids, input_length)
+        start = min(self.history_tokens, end - 1) if shared_blocks > 0 else 0
+        prompt = self.text_blocks.prompt(hash_ids, input_length, start)
+        if len(self.chat_history) == 0:
+            prompt += " Can you tell me a detailed story in 1000 words?"
+        token_ids = None
+        if request_executor.token_prompts is not None:
+            # Exactly the blocks of the record, without the question
+            token_ids = self.text_blocks.token_ids(
+                hash_ids, request_executor.token_prompts, input_length, start
+            )
+        self.history_tokens = end
         logger.debug(
             f"User {self.user_config.user_id} issues request {self.question_id}, "
             f"prompt: {prompt}"
         )
-        self.chat_history.on_user_query(prompt)
+        self.chat_history.on_user_query(prompt, token_ids)
         logger.debug(
             f"User {self.user_config.user_id} issues request {self.question_id}"
         )
         if self.prefill_only:
             max_tokens = 1 # simulate prefill only
+            extra_body = None
         else:
-            max_tokens = mooncake_data[self.mooncake_id]["output_length"]
+            max_tokens = record["output_length"]
+            extra_body = EOS_SUPPRESSION[self.user_config.eos_suppression](max_tokens)
         request_executor.launch_request(
             self.chat_history,
             max_tokens,
             self._on_request_finished,
             extra_headers={"x-user-id": str(self.user_config.user_id)},
+            extra_body=extra_body,
         )
         self.has_unfinished_request = True
+        self.inflight_requested_tokens = max_tokens
+        self.inflight_scheduled_time = (
+            scheduled_time if scheduled_time is not None else timestamp
+        )
+        self.metrics.on_launch()
+        self.question_id += 1
         self.last_request_time = timestamp
 
     def _on_request_finished(self, response: Response):
         self.chat_history.on_system_response(response.body)
+        self.history_tokens += response.generation_tokens
         self.has_unfinished_request = False
         logger.debug(
             f"User {self.user_config.user_id} finished one request. "
@@ -269,124 +441,118 @@ class UserSession:
             f"generation tokens: {response.generation_tokens}"
         )
         self._update_result(response)
-
-    def step(self, timestamp: float, request_executor: RequestExecutor):
-        if self.question_id >= 1 and not self.has_unfinished_request:
+        self.finished_turns += 1
+        if len(self.pending_turns) > 0:
+            record, shared_blocks, scheduled_time, executor = self.pending_turns.popleft()
+            self._launch_new_request(
+                record, shared_blocks, time.time(), executor, scheduled_time
+            )
+        elif self.finished_turns >= self.num_turns:
             self.finished = True
-            return
-        if self.last_request_time is None:
-            self._launch_new_request(timestamp, request_executor)
-            return
-
-    def summary(self) -> pd.DataFrame:
-        df = pd.DataFrame()
-        df["prompt_tokens"] = self.prompt_lengths
-        df["generation_tokens"] = self.generation_lengths
-        df["ttft"] = self.ttfts
-        df["generation_time"] = self.generation_times
-        df["user_id"] = self.user_config.user_id
-        df["question_id"] = self.question_ids
-        df["launch_time"] = self.launch_times
-        df["finish_time"] = self.finish_times
-        return df
+            if self.finish_listener is not None:
+                self.finish_listener(self)
 
 
 class UserSessionManager:
     def __init__(
         self,
         workload_config: WorkloadConfig,
+        trace: MooncakeTrace,
+        text_blocks: TextBlockStore,
+        linker: Optional[ConversationLinker] = None,
         init_user_id=0,
         time=0,
     ):
+        """
+        linker: replays the conversations it found as multi-turn sessions,
+        one session per record when None
+        """
         self.initial_time = time
         self.workload_config = workload_config
-        self.sessions = []
+        self.trace = trace
+        self.text_blocks = text_blocks
+        self.linker = linker
+        # Active sessions by user id, and by conversation with a linker
+        self.sessions = {}
+        self.conversations = {}
         self.user_id = init_user_id
-        self.last_user_join = 0
-        self.session_summaries = []
+        self.store = ResultStore(RESULT_COLUMNS, capacity=len(trace))
+        self.metrics = WindowedMetrics()
         self.start_time = None
-        self.mooncake_request_to_send = 0
 
-    def _create_user_session(self, mooncake_id):
-        self.user_id += 1
-        user_config = UserConfig.new_user_config(self.user_id, self.workload_config)
-        user_session = UserSession(mooncake_id, user_config)
-        self.sessions.append(user_session)
-        return user_session
-
-    def _remove_finished_sessions(self):
-        sessions_to_remove = [s for s in self.sessions if s.finished]
-        if len(sessions_to_remove) > 0:
-            logger.info(
-                f"Removing {len(sessions_to_remove)} finished sessions, now "
-                f"active users: {len(self.sessions) - len(sessions_to_remove)}"
-            )
-            for session in sessions_to_remove:
-                self.session_summaries.append(session.summary())
-        self.sessions = [s for s in self.sessions if not s.finished]
-
-    def step(self, timestamp: float, executor: RequestExecutor):
-        
-        if self.start_time is None:
-            self.start_time = timestamp
-        if (len(mooncake_data) > self.mooncake_request_to_send):
-            if (
-                timestamp - self.initial_time
-                >= (mooncake_data[self.mooncake_request_to_send]["timestamp"] / 1000)
-                * self.workload_config.slowdown_factor
-            ):
-                self._create_user_session(self.mooncake_request_to_send)
-                self.last_user_join = timestamp
-                logger.info(
-                    f"Joined a new user {self.user_id}, "
-                    f"now active users: {len(self.sessions)}, "
-                    f"Slowdown factor: {self.workload_config.slowdown_factor}"
-                )
-                self.mooncake_request_to_send += 1
-        for session in self.sessions:
-            session.step(timestamp, executor)
-        self._remove_finished_sessions()
+    def start(self, timestamp: float):
+        self.start_time = timestamp
+        self.metrics.start(timestamp)
 
-    @staticmethod
-    def ProcessSummary(
-        df: pd.DataFrame,
-        start_time: Optional[float] = None,
-        end_time: Optional[float] = None,
-        pending_queries: int = 0,
-        qps: Optional[int] = None,
-    ):
-        if start_time and end_time:
-            launched_queries = len(
-                df.query(f"{start_time} <= launch_time <= {end_time}")
-            )
-            df = df.query(f"{start_time} <= finish_time <= {end_time}")
+    def scheduled_time(self, idx: int) -> float:
+        """Time at which the idx-th trace record is due, after the slowdown"""
+        return (
+            self.initial_time
+            + self.trace.timestamp(idx) / 1000 * self.workload_config.slowdown_factor
+        )
+
+    def dispatch(
+        self, idx: int, timestamp: float, scheduled_time: float, executor: RequestExecutor
+    ) -> "UserSession":
+        """Send the idx-th trace record, from a new session unless it follows up one"""
+        record = self.trace[idx]
+        if self.linker is None:
+            session = self._create_user_session(1)
+            session.add_turn(record, 0, timestamp, executor, scheduled_time)
+            return session
+
+        conversation = int(self.linker.conversation[idx])
+        if self.linker.turn[idx] == 0:
+            session = self._create_user_session(int(self.linker.num_turns[conversation]))
+            session.conversation = conversation
+            self.conversations[conversation] = session
         else:
-            launched_queries = len(df)
+            session = self.conversations[conversation]
+        session.add_turn(
+            record, int(self.linker.shared_blocks[idx]), timestamp, executor, scheduled_time
+        )
+        return session
+
+    def _create_user_session(self, num_turns: int) -> "UserSession":
+        self.user_id += 1
+        user_config = UserConfig.new_user_config(self.user_id, self.workload_config)
+        session = UserSession(
+            user_config, self.store, self.metrics, self.text_blocks, num_turns
+        )
+        session.finish_listener = self.finish_session
+        self.sessions[self.user_id] = session
         logger.debug(
-            f"Launched queries: {launched_queries}, "
-            f"pending queries: {pending_queries}, "
-            f"finished queries: {len(df)}"
+            f"Joined a new user {self.user_id}, "
+            f"now active users: {len(self.sessions)}"
         )
+        return session
+
+    def finish_session(self, session: "UserSession"):
+        self.sessions.pop(session.user_config.user_id, None)
+        if self.linker is not None:
+            self.conversations.pop(session.conversation, None)
+
+    @staticmethod
+    def PrintSummary(summary: dict, qps: Optional[float] = None):
+        """
+        Print a performance summary block, from the fields computed by
+        ProcessSummary or by WindowedMetrics.take_window
+        """
         if qps is None:
             qps = 0.0
-        if start_time is None:
-            start_time = df["launch_time"].min()
-        if end_time is None:
-            end_time = df["finish_time"].max()
+        start_time = summary["start_time"]
+        end_time = summary["end_time"]
         total_time = end_time - start_time
-        total_requests = launched_queries + pending_queries
-        _qps = total_requests / total_time
-        total_finished_requests = len(df)
-        finished_qps = total_finished_requests / total_time
-        total_prompt_tokens = df["prompt_tokens"].sum()
-        total_generation_tokens = df["generation_tokens"].sum()
-        average_prefill_speed = total_prompt_tokens / total_time
-        average_generation_speed = total_generation_tokens / total_time
-        average_generation_speed_per_request = (
-            df["generation_tokens"] / df["generation_time"]
-        ).mean()
-        average_ttft = df["ttft"].mean()
-        logger.info("Calculating performance summary")
+        logger.debug(
+            f"Launched queries: {summary['launched_queries']}, "
+            f"pending queries: {summary['pending_queries']}, "
+            f"finished queries: {summary['finished_queries']}"
+        )
+        finished_qps = summary["finished_queries"] / total_time
+        average_prefill_speed = summary["prompt_tokens"] / total_time
+        average_generation_speed = summary["generation_tokens"] / total_time
+        average_generation_speed_per_request = summary["average_generation_speed_per_request"]
+        average_ttft = summary["average_ttft"]
         print("\n")
         print("==================== Performance summary ======================")
         print(f"  \033[33mQPS: \033[32m{qps:.4f} reqs/s\033[0m\n")
@@ -394,7 +560,9 @@ class UserSessionManager:
             f"  \033[33mProcessing speed: "
             f"\033[32m{finished_qps:.4f} reqs/s\033[0m\n"
         )
-        print(f"  \033[33mRequests on-the-fly: {pending_queries}\033[0m\n")
+        print(f"  \033[33mRequests on-the-fly: {summary['pending_queries']}\033[0m\n")
+        if summary.get("failed_queries"):
+            print(f"  \033[33mFailed requests: \033[31m{summary['failed_queries']}\033[0m\n")
         print(
             "  \033[33mInput tokens per second: "
             f"\033[32m{average_prefill_speed:.4f} tokens/s\033[0m\n"
@@ -409,27 +577,194 @@ class UserSessionManager:
             "tokens/req/s\033[0m\n"
         )
         print(f"  \033[33mAverage TTFT: \033[32m{average_ttft:.4f}s\033[0m\n")
+        if summary.get("launch_skew") is not None:
+            launch_skew = ", ".join(
+                f"{name} {value * 1000:.2f}ms" for name, value in summary["launch_skew"].items()
+            )
+            print(
+                "  \033[33mLaunch drift (actual - trace time): "
+                f"\033[32m{launch_skew}\033[0m\n"
+            )
+        if summary.get("on_time_ratio") is not None:
+            print(
+                f"  \033[33mReplay fidelity: \033[32m{summary['on_time_ratio'] * 100:.2f}% "
+                f"of requests within {ON_TIME_TOLERANCE * 1000:.0f}ms of their trace time\033[0m\n"
+            )
+        if summary.get("output_fidelity") is not None:
+            fidelity = summary["output_fidelity"]
+            print(
+                "  \033[33mOutput tokens delivered / requested: "
+                f"\033[32m{fidelity['delivered_ratio'] * 100:.2f}%, "
+                f"{fidelity['exact'] * 100:.2f}% of requests exact, "
+                f"{fidelity['short'] * 100:.2f}% short, "
+                f"{fidelity['failed'] * 100:.2f}% failed\033[0m\n"
+            )
+        if summary.get("sketches") is not None:
+            print_latency_summary(summary["sketches"])
+        if summary.get("chunk_times") is not None:
+            print_chunk_time_summary(summary["chunk_times"], distributions=False)
         print(f"Time range: {start_time} - {end_time} ({total_time:.2f}s)")
         print("===============================================================")
         print("\n")
-        return df
+
+    @staticmethod
+    def ProcessSummary(
+        df: pd.DataFrame,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+        pending_queries: int = 0,
+        qps: Optional[int] = None,
+        sketches: Optional[LatencySketches] = None,
+    ):
+        """
+        sketches: latency sketches of the requests, computed from df when
+        not given
+        """
+        if start_time and end_time:
+            launched_queries = int(
+                ((df["launch_time"] >= start_time) & (df["launch_time"] <= end_time)).sum()
+            )
+            df = df[(df["finish_time"] >= start_time) & (df["finish_time"] <= end_time)]
+        else:
+            launched_queries = len(df)
+        if start_time is None:
+            start_time = df["launch_time"].min()
+        if end_time is None:
+            end_time = df["finish_time"].max()
+        # Failed requests are in the CSV and the replay fidelity, not in the
+        # performance figures
+        failed = (
+            df["error"].astype(bool) if "error" in df.columns
+            else pd.Series(False, index=df.index)
+        )
+        records, df = df, df[~failed]
+        logger.info("Calculating performance summary")
+        summary = {
+            "start_time": start_time,
+            "end_time": end_time,
+            "launched_queries": launched_queries,
+            "finished_queries": len(df),
+            "failed_queries": int(failed.sum()),
+            "pending_queries": pending_queries,
+            "prompt_tokens": df["prompt_tokens"].sum(),
+            "generation_tokens": df["generation_tokens"].sum(),
+            "average_ttft": df["ttft"].mean(),
+            "average_generation_speed_per_request": (
+                df["generation_tokens"] / df["generation_time"]
+            ).mean(),
+            "launch_skew": None,
+            "on_time_ratio": None,
+            "output_fidelity": None,
+            "sketches": sketches if sketches is not None else LatencySketches.from_frame(df),
+            "chunk_times": df["chunk_times"] if "chunk_times" in df.columns else None,
+        }
+        if "scheduled_time" in records.columns and len(records) > 0:
+            launch_skew = records["launch_time"] - records["scheduled_time"]
+            summary["launch_skew"] = {
+                "p50": launch_skew.quantile(0.5),
+                "p99": launch_skew.quantile(0.99),
+                "max": launch_skew.max(),
+            }
+            summary["on_time_ratio"] = (launch_skew <= ON_TIME_TOLERANCE).mean()
+        if "requested_tokens" in records.columns and len(records) > 0:
+            # How far the delivered decode load is from the trace's
+            requested = records["requested_tokens"]
+            delivered = records["generation_tokens"]
+            summary["output_fidelity"] = {
+                "delivered_ratio": delivered.sum() / max(requested.sum(), 1),
+                "exact": ((delivered == requested) & ~failed).mean(),
+                "short": ((delivered < requested) & ~failed).mean(),
+                "failed": failed.mean(),
+            }
+        UserSessionManager.PrintSummary(summary, qps)
+        return records
+
+    def log_window(self, timestamp: float):
+        """Print the summary of the requests finished since the previous call"""
+        window = self.metrics.take_window(timestamp)
+        if window is not None:
+            UserSessionManager.PrintSummary(window, self.workload_config.qps)
 
     def summary(self, start_time: float, end_time: float) -> pd.DataFrame:
-        if len(self.session_summaries) == 0 and len(self.sessions) == 0:
+        """Summary computed from the full history of the run"""
+        if len(self.store) == 0:
             return pd.DataFrame()
-        df = pd.concat(
-            [s for s in self.session_summaries] + [s.summary() for s in self.sessions]
-        )
-        pending_queries = len([s for s in self.sessions if s.has_unfinished_request])
+        df = self.store.frame()
+        pending_queries = self.metrics.in_flight
         start_time = max(self.start_time, start_time)
         end_time = min(end_time, df["finish_time"].max())
         qps = self.workload_config.qps
         df = UserSessionManager.ProcessSummary(
-            df, start_time, end_time, pending_queries, qps
+            df, start_time, end_time, pending_queries, qps, self.metrics.sketches
         )
         return df
 
 
+class TraceDispatcher:
+    """
+    Launches the trace records at their (slowed down) timestamps.
+
+    A single timer on the executor's event loop is armed for the next record.
+    When it fires, every record whose time has passed goes out, so a burst
+    above the timer resolution is caught up at once instead of drifting
+    further behind the trace.
+    """
+
+    def __init__(self, manager: UserSessionManager, executor: RequestExecutor):
+        self.manager = manager
+        self.executor = executor
+        self.loop = executor.loop
+        # Index of the next trace record to launch
+        self.next_record = 0
+        self.timer = None
+        self.stopped = False
+
+    def _run_in_loop(self, func, *args):
+        async def _call():
+            func(*args)
+
+        asyncio.run_coroutine_threadsafe(_call(), self.loop).result()
+
+    def start(self, timestamp: float):
+        self._run_in_loop(self._start, timestamp)
+
+    def stop(self):
+        """Stop launching new requests; in-flight ones keep running"""
+        self._run_in_loop(self._stop)
+
+    @property
+    def finished(self) -> bool:
+        """Whether every record of the trace has been launched"""
+        return self.next_record >= len(self.manager.trace)
+
+    def _start(self, timestamp: float):
+        self.manager.start(timestamp)
+        self._arm()
+
+    def _stop(self):
+        self.stopped = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _arm(self):
+        if self.stopped or self.finished:
+            return
+        due = self.manager.scheduled_time(self.next_record)
+        self.timer = self.loop.call_later(max(0.0, due - time.time()), self._on_timer)
+
+    def _on_timer(self):
+        self.timer = None
+        now = time.time()
+        while not self.finished:
+            due = self.manager.scheduled_time(self.next_record)
+            if due > now:
+                break
+            self.manager.dispatch(self.next_record, now, due, self.executor)
+            self.next_record += 1
+        self._arm()
+
+
 def warmup_engine(executor):
     logger.info("Warming up the engine")
     for i in range(10):
@@ -481,6 +816,24 @@ def parse_arguments() -> WorkloadConfig:
         required=False,
         help="The time to run the simulation in seconds",
     )
+    parser.add_argument(
+        "--trace-file",
+        type=str,
+        default="conversation_trace.jsonl",
+        help="The Mooncake trace to replay (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--multi-turn",
+        action="store_true",
+        help="Link the records sharing a prompt prefix into conversations and "
+        "replay each one as a multi-turn session with its chat history",
+    )
+    parser.add_argument(
+        "--block-size",
+        type=int,
+        default=DEFAULT_BLOCK_SIZE,
+        help="Tokens per hash block of the trace (default: %(default)s)",
+    )
     parser.add_argument(
         "--output",
         type=str,
@@ -503,6 +856,9 @@ def parse_arguments() -> WorkloadConfig:
         help="The time between two summary loggings in seconds",
     )
 
+    add_transport_arguments(parser)
+    add_token_prompt_arguments(parser)
+    add_metrics_arguments(parser)
     parser.add_argument(
         "--verbose", action="store_true", help="Whether to enable verbose logging"
     )
@@ -518,6 +874,20 @@ def parse_arguments() -> WorkloadConfig:
         default=True,
         help="Whether to only prefill the request without sending it",
     )
+    parser.add_argument(
+        "--decode",
+        dest="prefill_only",
+        action="store_false",
+        help="Generate the output_length tokens of every trace record instead "
+        "of prefilling only",
+    )
+    parser.add_argument(
+        "--eos-suppression",
+        choices=sorted(EOS_SUPPRESSION),
+        default="ignore_eos",
+        help="With --decode, how the server is kept from stopping at EOS "
+        "before output_length tokens (default: %(default)s)",
+    )
     args = parser.parse_args()
     return args
 
@@ -549,8 +919,27 @@ def main():
         global logger
         logger = init_logger(__name__, level=logging.DEBUG)
     step_interval = 0.1
+    trace = MooncakeTrace(args.trace_file)
+    logger.info(f"Replaying {len(trace)} requests of {args.trace_file}")
+    linker = None
+    if args.multi_turn:
+        linker = ConversationLinker(trace)
+        logger.info(
+            f"Linked the trace into {len(linker)} conversations, "
+            f"{(linker.num_turns > 1).sum()} of them multi-turn "
+            f"(up to {linker.num_turns.max()} turns)"
+        )
+    token_prompts = build_token_prompts(args)
+    # The text blocks are only worth calibrating when they are sent
+    tokenizer = None
+    if args.tokenizer and token_prompts is None:
+        tokenizer = load_tokenizer(args.tokenizer)
+    text_blocks = TextBlockStore(args.block_size, tokenizer)
     executor = RequestExecutor(
-        base_url=args.base_url, api_key="EMPTY", model=args.model
+        base_url=args.base_url,
+        model=args.model,
+        transport_args=args,
+        token_prompts=token_prompts,
     )
     warmup_engine(executor)
     workload_config = WorkloadConfig(
@@ -563,31 +952,45 @@ def main():
         enable_user_id=args.request_with_user_id,
         slowdown_factor=args.slowdown_factor,
         prefill_only=args.prefill_only,
+        eos_suppression=args.eos_suppression,
     )
     start_time = time.time()
     manager = UserSessionManager(
         workload_config,
+        trace,
+        text_blocks,
+        linker,
         init_user_id=args.init_user_id,
         time=start_time,
     )
-    num_steps = 0
+    live = start_live_metrics(args, executor.loop, workload_config.qps)
+    if live is not None:
+        live.active_sessions = lambda: len(manager.sessions)
+        manager.metrics.live = live
+        logger.info(f"Serving metrics on port {args.metrics_port}")
+    dispatcher = TraceDispatcher(manager, executor)
+    dispatcher.start(start_time)
     last_summary_time = start_time
     try:
         while True:
-            num_steps += 1
-            manager.step(time.time(), executor)
             time.sleep(step_interval)
             if time.time() - last_summary_time > args.log_interval:
-                manager.summary(last_summary_time, time.time())
                 last_summary_time = time.time()
+                manager.log_window(last_summary_time)
             if args.time is not None and time.time() - start_time > args.time:
                 break
+            if dispatcher.finished and manager.metrics.in_flight == 0:
+                logger.info("Replayed the whole trace")
+                break
     except KeyboardInterrupt:
         logger.info("Interrupted, waiting for the final result")
+    dispatcher.stop()
+    logger.info(f"Launched {dispatcher.next_record} of the {len(trace)} trace records")
     AsyncLoopWrapper.StopLoop()
     logger.info(f"Finished benchmarking, dumping summary to {args.output}")
     summary = manager.summary(0, time.time())
     summary.to_csv(args.output, index=False)
+    manager.metrics.sketches.save(sketch_path(args.output))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,189 @@
+"""
+Lazy reader of Mooncake traces (conversation_trace.jsonl and friends).
+
+Only a byte-offset index of the trace is kept in memory: the offset of every
+valid record, sorted by timestamp, and the timestamps themselves (16 bytes per
+row). Records are parsed one at a time when the benchmark dispatches them.
+The index is cached next to the trace (``<trace>.index.npz``) so that later
+runs over the same file start without scanning it.
+"""
+
+import json
+import logging
+import os
+import re
+from array import array
+from typing import Iterator, Tuple
+
+import numpy as np
+
+from utils import init_logger
+
+logger = init_logger(__name__, logging.INFO)
+
+REQUIRED_FIELDS = ("hash_ids", "timestamp", "output_length")
+REQUIRED_KEYS = tuple(f'"{field}"'.encode() for field in REQUIRED_FIELDS)
+TIMESTAMP_PATTERN = re.compile(rb'"timestamp"\s*:\s*(-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)')
+
+# Bump when the layout of the cached index changes
+INDEX_VERSION = 1
+
+
+def index_path(trace_path: str) -> str:
+    return trace_path + ".index.npz"
+
+
+def build_index(trace_path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Scan the trace once and return the byte offsets and timestamps (ms) of its
+    valid records, in timestamp order
+    """
+    offsets = array("q")
+    timestamps = array("d")
+    with open(trace_path, "rb") as file:
+        offset = 0
+        for line_num, line in enumerate(file, 1):
+            line_offset = offset
+            offset += len(line)
+            if not line.strip():
+                continue
+            # Parsing every record in full dominates the scan, so only the
+            # timestamp is extracted when the line has all the fields
+            match = TIMESTAMP_PATTERN.search(line)
+            if match is not None and all(key in line for key in REQUIRED_KEYS):
+                timestamp = float(match.group(1))
+            else:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    logger.warning(f"Failed to parse line {line_num}: {e}")
+                    continue
+                if not all(field in record for field in REQUIRED_FIELDS):
+                    logger.warning(f"Line {line_num} missing required fields.")
+                    continue
+                timestamp = float(record["timestamp"])
+            offsets.append(line_offset)
+            timestamps.append(timestamp)
+
+    offsets = np.frombuffer(offsets, dtype=np.int64)
+    timestamps = np.frombuffer(timestamps, dtype=np.float64)
+    # Traces are normally sorted already, keep the file order among equal
+    # timestamps otherwise
+    order = np.argsort(timestamps, kind="stable")
+    return offsets[order], timestamps[order]
+
+
+class MooncakeTrace:
+    """
+    Records of a Mooncake trace in timestamp order, read from the file on
+    demand.
+    """
+
+    def __init__(self, trace_path: str, use_cache: bool = True):
+        self.trace_path = trace_path
+        self.offsets, self.timestamps = self._load_index(use_cache)
+        self._file = open(trace_path, "rb")
+
+    def _load_index(self, use_cache: bool) -> Tuple[np.ndarray, np.ndarray]:
+        stat = os.stat(self.trace_path)
+        # Identifies the trace the index was built from
+        source = np.array([INDEX_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        cache = index_path(self.trace_path)
+        if use_cache and os.path.exists(cache):
+            try:
+                with np.load(cache) as index:
+                    if np.array_equal(index["source"], source):
+                        return index["offsets"], index["timestamps"]
+                logger.info(f"{self.trace_path} changed, rebuilding its index")
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Ignoring the unreadable index {cache}: {e}")
+
+        offsets, timestamps = build_index(self.trace_path)
+        logger.info(f"Indexed {len(offsets)} records of {self.trace_path}")
+        if use_cache:
+            try:
+                with open(cache, "wb") as file:
+                    np.savez(file, source=source, offsets=offsets, timestamps=timestamps)
+            except OSError as e:
+                logger.warning(f"Cannot cache the trace index in {cache}: {e}")
+        return offsets, timestamps
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, idx: int) -> dict:
+        """
+        Parse the idx-th record in timestamp order
+        """
+        self._file.seek(self.offsets[idx])
+        return json.loads(self._file.readline())
+
+    def __iter__(self) -> Iterator[dict]:
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def timestamp(self, idx: int) -> float:
+        """
+        Timestamp (ms) of the idx-th record, without reading it
+        """
+        return float(self.timestamps[idx])
+
+    def close(self):
+        self._file.close()
+
+
+class ConversationLinker:
+    """
+    Groups the records of a trace into multi-turn conversations.
+
+    Mooncake hash ids are prefix-chained: the id of a block depends on every
+    block before it, so two prompts share their first k blocks exactly when
+    their k-th ids are equal. A record continues the conversation whose
+    latest turn shares the longest prefix with it, as long as that prefix
+    covers every full block of the latest turn (its last block is partial
+    and changes once the answer is appended). Other records start a new
+    conversation.
+    """
+
+    def __init__(self, trace: MooncakeTrace, min_shared_blocks: int = 1):
+        num_records = len(trace)
+        # Conversation and turn of each record, and the number of leading
+        # blocks it shares with the previous turn
+        self.conversation = np.zeros(num_records, dtype=np.int64)
+        self.turn = np.zeros(num_records, dtype=np.int64)
+        self.shared_blocks = np.zeros(num_records, dtype=np.int64)
+        num_turns = array("q")
+        # Number of blocks of the latest turn of each conversation
+        tail_blocks = array("q")
+        # Hash id -> (conversation, position) of the latest record using it
+        owners = {}
+
+        for idx, record in enumerate(trace):
+            hash_ids = record["hash_ids"]
+            conversation = None
+            # A follow-up adds at least one block to the shared prefix
+            for pos in range(len(hash_ids) - 2, min_shared_blocks - 2, -1):
+                owner = owners.get(hash_ids[pos])
+                if owner is None or owner[1] != pos:
+                    continue
+                if pos + 1 >= tail_blocks[owner[0]] - 1:
+                    conversation = owner[0]
+                    self.shared_blocks[idx] = pos + 1
+                    break
+
+            if conversation is None:
+                conversation = len(num_turns)
+                num_turns.append(0)
+                tail_blocks.append(0)
+            self.conversation[idx] = conversation
+            self.turn[idx] = num_turns[conversation]
+            num_turns[conversation] += 1
+            tail_blocks[conversation] = len(hash_ids)
+            for pos, hash_id in enumerate(hash_ids):
+                owners[hash_id] = (conversation, pos)
+
+        self.num_turns = np.frombuffer(num_turns, dtype=np.int64)
+
+    def __len__(self) -> int:
+        """Number of conversations"""
+        return len(self.num_turns)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+mrc_analyzer.py – prefix-cache miss ratio curve of a Mooncake trace
+===================================================================
+
+Computes, in one pass over a Mooncake-format trace, the hit ratio an LRU KV
+cache would get for every capacity at once, and the prefill tokens it would
+save. Each ``hash_id`` is one cached block of ``--block-size`` tokens.
+
+The LRU stack distance of every block access (the number of distinct blocks
+used since the previous access to it) is computed with a Fenwick tree over the
+access times, in O(log n) per access. An access hits in a cache of C blocks
+exactly when its stack distance is below C. Prefix caches (vLLM, LMCache)
+only reuse the leading blocks of a prompt up to the first miss, so a block
+saves its prefill when the largest stack distance of the blocks up to it is
+below C.
+
+    python3 mrc_analyzer.py conversation_trace.jsonl --kv-bytes-per-token 131072
+"""
+
+import argparse
+import logging
+import time
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from mooncake_trace import MooncakeTrace
+from text_blocks import DEFAULT_BLOCK_SIZE
+from utils import init_logger
+
+logger = init_logger(__name__, logging.INFO)
+
+
+class StackDistanceCounter:
+    """
+    LRU stack distances of a stream of block accesses.
+
+    Every block has a mark at the time of its last access in a Fenwick tree,
+    so the distinct blocks accessed since then are the marks after it. Times
+    are renumbered when they run out, which keeps the tree at about twice the
+    number of distinct blocks.
+    """
+
+    def __init__(self, size: int = 1024):
+        self.size = size
+        self.tree = [0] * (size + 1)
+        # Block -> time (1-based) of its last access
+        self.last_access = {}
+        self.now = 0
+
+    def _compact(self):
+        blocks = sorted(self.last_access, key=self.last_access.get)
+        self.size = max(self.size, 2 * len(blocks))
+        self.tree = [0] * (self.size + 1)
+        for pos, block in enumerate(blocks, 1):
+            self.last_access[block] = pos
+            self.tree[pos] = 1
+        # Build the tree in place, O(n)
+        for pos in range(1, self.size + 1):
+            parent = pos + (pos & -pos)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[pos]
+        self.now = len(blocks)
+
+    def access(self, block) -> Optional[int]:
+        """
+        Stack distance of an access to block, None on its first access
+        """
+        if self.now == self.size:
+            self._compact()
+        tree = self.tree
+        size = self.size
+        last = self.last_access.get(block)
+        if last is None:
+            distance = None
+        else:
+            # Marks after the previous access; the tree walks are inlined as
+            # they dominate the run time
+            distance = len(self.last_access)
+            pos = last
+            while pos > 0:
+                distance -= tree[pos]
+                pos -= pos & -pos
+            pos = last
+            while pos <= size:
+                tree[pos] -= 1
+                pos += pos & -pos
+        self.now += 1
+        self.last_access[block] = self.now
+        pos = self.now
+        while pos <= size:
+            tree[pos] += 1
+            pos += pos & -pos
+        return distance
+
+    @property
+    def distinct_blocks(self) -> int:
+        return len(self.last_access)
+
+
+def _count(histogram: List[int], index: int, value: int):
+    if index >= len(histogram):
+        histogram.extend([0] * (index + 1 - len(histogram)))
+    histogram[index] += value
+
+
+def analyze(trace: MooncakeTrace, block_size: int) -> dict:
+    """
+    Histograms of the stack distances of all the block accesses of the trace,
+    and of the prefill tokens per prefix stack distance
+    """
+    counter = StackDistanceCounter()
+    block_hist = []
+    token_hist = []
+    accesses = 0
+    total_tokens = 0
+    for record in trace:
+        hash_ids = record["hash_ids"]
+        input_length = record.get("input_length", block_size * len(hash_ids))
+        # Largest stack distance among the blocks so far, None once one of
+        # them was never seen: the prefix cache cannot go past it
+        prefix_distance = 0
+        for i, hash_id in enumerate(hash_ids):
+            distance = counter.access(hash_id)
+            tokens = min(block_size, input_length - block_size * i)
+            if tokens <= 0:
+                tokens = 0
+            accesses += 1
+            total_tokens += tokens
+            if distance is None:
+                prefix_distance = None
+                continue
+            _count(block_hist, distance, 1)
+            if prefix_distance is not None:
+                prefix_distance = max(prefix_distance, distance)
+                _count(token_hist, prefix_distance, tokens)
+    return {
+        "requests": len(trace),
+        "accesses": accesses,
+        "total_tokens": total_tokens,
+        "distinct_blocks": counter.distinct_blocks,
+        "block_hist": np.array(block_hist, dtype=np.int64),
+        "token_hist": np.array(token_hist, dtype=np.int64),
+    }
+
+
+def default_capacities(distinct_blocks: int) -> List[int]:
+    """Powers of two up to the capacity that holds every block"""
+    capacities = []
+    capacity = 1
+    while capacity < distinct_blocks:
+        capacities.append(capacity)
+        capacity *= 2
+    capacities.append(max(distinct_blocks, 1))
+    return capacities
+
+
+def miss_ratio_curve(result: dict, capacities: List[int], block_size: int,
+                     kv_bytes_per_token: Optional[int] = None) -> pd.DataFrame:
+    """Hit ratios and saved prefill tokens of an LRU cache of each capacity (blocks)"""
+    # Hits of a cache of C blocks: the accesses with a stack distance below C
+    block_hits = np.concatenate([[0], np.cumsum(result["block_hist"])])
+    saved_tokens = np.concatenate([[0], np.cumsum(result["token_hist"])])
+    rows = []
+    for capacity in capacities:
+        hits = block_hits[min(capacity, len(block_hits) - 1)]
+        saved = saved_tokens[min(capacity, len(saved_tokens) - 1)]
+        row = {
+            "capacity_blocks": capacity,
+            "capacity_tokens": capacity * block_size,
+        }
+        if kv_bytes_per_token is not None:
+            row["capacity_gb"] = capacity * block_size * kv_bytes_per_token / 1e9
+        row.update({
+            "block_hit_ratio": hits / max(result["accesses"], 1),
+            "miss_ratio": 1 - hits / max(result["accesses"], 1),
+            "prefix_hit_ratio": saved / max(result["total_tokens"], 1),
+            "prefill_tokens_saved": int(saved),
+            "saved_tokens_per_request": saved / max(result["requests"], 1),
+        })
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Miss ratio curve of an LRU prefix cache on a Mooncake trace.")
+    parser.add_argument("trace_file", help="Mooncake-format trace (JSONL)")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE,
+                        help="Tokens per hash block (default: %(default)s)")
+    parser.add_argument("--capacities", type=int, nargs="+", default=None,
+                        help="Cache capacities to report, in blocks "
+                             "(default: powers of two up to every block)")
+    parser.add_argument("--kv-bytes-per-token", type=int, default=None,
+                        help="KV cache bytes per token of the model, adds the "
+                             "capacity in GB (e.g. 131072 for Llama-3.1-8B in fp16)")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Also write the table to this CSV file")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    trace = MooncakeTrace(args.trace_file)
+
+    start = time.perf_counter()
+    result = analyze(trace, args.block_size)
+    logger.info(
+        f"Analyzed {result['requests']} requests, {result['accesses']} block accesses "
+        f"over {result['distinct_blocks']} distinct blocks in "
+        f"{time.perf_counter() - start:.2f}s"
+    )
+
+    capacities = args.capacities or default_capacities(result["distinct_blocks"])
+    table = miss_ratio_curve(result, capacities, args.block_size, args.kv_bytes_per_token)
+
+    print("\n")
+    print(table.to_string(index=False, float_format=lambda value: f"{value:.4f}"))
+    print(
+        f"\nPrefill tokens: {result['total_tokens']}, compulsory misses: "
+        f"{result['distinct_blocks']} of {result['accesses']} block accesses"
+    )
+    print("\n")
+    if args.output:
+        table.to_csv(args.output, index=False)
+        logger.info(f"Miss ratio curve written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Prompt text of Mooncake trace records, built from cached hash blocks.
+
+Every ``hash_id`` of a trace stands for one block of ``block_size`` tokens;
+two requests sharing a hash id share that block of their prompt. The text of
+a block is generated once and kept in a bounded LRU cache, and a prompt is
+the concatenation of the cached texts of its blocks. With a tokenizer, the
+blocks are calibrated to exactly ``block_size`` tokens each, so the prefix
+shared by two prompts covers the same token blocks as in the trace.
+"""
+
+import logging
+from collections import OrderedDict
+from typing import List, Optional
+
+from utils import TokenPromptCache, init_logger
+
+logger = init_logger(__name__, logging.INFO)
+
+# Block size of the published Mooncake traces, in tokens
+DEFAULT_BLOCK_SIZE = 512
+
+
+class TextBlockStore:
+    """
+    Cache of the text of each hash block.
+
+    A block is " <hash_id>" followed by " hi" fillers. Every block starts with
+    a space, so no token spans two blocks and the blocks tokenize the same way
+    whatever their neighbours are.
+    """
+
+    def __init__(
+        self,
+        block_size: int = DEFAULT_BLOCK_SIZE,
+        tokenizer=None,
+        max_blocks: int = 100_000,
+    ):
+        self.block_size = block_size
+        self.tokenizer = tokenizer
+        self.max_blocks = max_blocks
+        # (hash_id, num_tokens) -> text, least recently used first
+        self.blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _num_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def _make_block(self, hash_id: int, num_tokens: int) -> str:
+        head = f" {hash_id}"
+        # Without a tokenizer, assume the hash id and each filler are one token
+        fillers = max(0, num_tokens - 1)
+        if self.tokenizer is None:
+            return head + " hi" * fillers
+        for _ in range(4):
+            text = head + " hi" * fillers
+            error = num_tokens - self._num_tokens(text)
+            if error == 0:
+                return text
+            fillers = max(0, fillers + error)
+        logger.warning(
+            f"Block {hash_id} is {self._num_tokens(text)} tokens instead of {num_tokens}"
+        )
+        return text
+
+    def block(self, hash_id: int, num_tokens: Optional[int] = None) -> str:
+        """Text of a block of num_tokens tokens (default block_size)"""
+        if num_tokens is None:
+            num_tokens = self.block_size
+        key = (hash_id, num_tokens)
+        text = self.blocks.get(key)
+        if text is not None:
+            self.hits += 1
+            self.blocks.move_to_end(key)
+            return text
+        self.misses += 1
+        text = self._make_block(hash_id, num_tokens)
+        self.blocks[key] = text
+        if len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+        return text
+
+    def _block_sizes(self, hash_ids: List[int], input_length: Optional[int]) -> List[int]:
+        sizes = [self.block_size] * len(hash_ids)
+        if input_length is not None and len(hash_ids) > 0:
+            remainder = input_length - self.block_size * (len(hash_ids) - 1)
+            if 0 < remainder < self.block_size:
+                sizes[-1] = remainder
+        return sizes
+
+    def prompt_length(self, hash_ids: List[int], input_length: Optional[int] = None) -> int:
+        """Tokens of the prompt of the given blocks"""
+        return sum(self._block_sizes(hash_ids, input_length))
+
+    def _pieces(self, hash_ids: List[int], input_length: Optional[int], start: int):
+        """(hash_id, tokens) of the blocks from token start on"""
+        pieces = []
+        offset = 0
+        for hash_id, size in zip(hash_ids, self._block_sizes(hash_ids, input_length)):
+            if offset + size > start:
+                pieces.append((hash_id, offset + size - max(offset, start)))
+            offset += size
+        return pieces
+
+    def prompt(
+        self, hash_ids: List[int], input_length: Optional[int] = None, start: int = 0
+    ) -> str:
+        """
+        Prompt made of the given blocks. When input_length (tokens) is given,
+        the last block is cut to the remainder, as in the trace. The first
+        start tokens are left out (they are already in the chat history), so
+        the block they end in is cut to the rest of it.
+        """
+        return "".join(
+            self.block(hash_id, size)
+            for hash_id, size in self._pieces(hash_ids, input_length, start)
+        )
+
+    def token_ids(
+        self,
+        hash_ids: List[int],
+        token_prompts: TokenPromptCache,
+        input_length: Optional[int] = None,
+        start: int = 0,
+    ) -> List[int]:
+        """
+        Same prompt as token IDs, exactly block_size IDs per block. A prompt
+        starting at token 0 counts the BOS token TokenPromptCache.prompt puts
+        first in its first block, so it stays input_length tokens long and its
+        blocks line up with the server's
+        """
+        if start == 0:
+            start = len(token_prompts.prefix)
+        token_ids = []
+        for hash_id, size in self._pieces(hash_ids, input_length, start):
+            token_ids.extend(token_prompts.block(f" {hash_id}", size))
+        return token_ids
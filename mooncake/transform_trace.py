@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+transform_trace.py – shorter Mooncake traces with the same cache behaviour
+=========================================================================
+
+Writes a new Mooncake-format trace from an existing one, in three steps:
+
+1. ``--max-gap``: every idle gap between two consecutive requests longer than
+   this is cut to it, which drops the quiet periods of the trace without
+   touching its bursts.
+2. ``--sample-ratio``: keeps this share of the prefix families, the
+   conversations (as linked by ``ConversationLinker``) that start with the
+   same block. A family is kept or dropped as a whole, so every request still
+   shares its prefixes with the same other requests and the trace keeps its
+   reuse ratios. Families are sampled systematically over their size, so the
+   kept ones have the same mix of large and small families. A family far
+   larger than the others (one system prompt shared by most of the trace)
+   would make the kept share all or nothing, so its conversations are
+   sampled one by one instead.
+3. ``--target-qps`` or ``--duration``: rescales the timestamps to this mean
+   request rate or total length.
+
+It then prints the statistics of the original and transformed traces side by
+side: request rate and burstiness, input/output length percentiles, and the
+block and prefix reuse an unbounded cache would see.
+
+    python3 transform_trace.py conversation_trace.jsonl short_trace.jsonl \\
+        --max-gap 10 --sample-ratio 0.2 --duration 600
+"""
+
+import argparse
+import json
+import logging
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from mooncake_trace import ConversationLinker, MooncakeTrace
+from mrc_analyzer import analyze
+from text_blocks import DEFAULT_BLOCK_SIZE
+from utils import init_logger
+
+logger = init_logger(__name__, logging.INFO)
+
+# A family with more requests than this many times the mean kept family is
+# sampled by conversation
+OVERSIZED_FAMILY = 2.0
+# Relative gap between the kept share of the requests and --sample-ratio
+# above which a warning is logged
+SAMPLE_RATIO_TOLERANCE = 0.2
+
+
+def compress_gaps(timestamps: np.ndarray, max_gap: float) -> np.ndarray:
+    """Timestamps with every gap longer than max_gap cut to max_gap"""
+    if len(timestamps) == 0:
+        return timestamps
+    gaps = np.minimum(np.diff(timestamps), max_gap)
+    return timestamps[0] + np.concatenate([[0], np.cumsum(gaps)])
+
+
+def sample_families(linker: ConversationLinker, first_blocks: np.ndarray,
+                    ratio: float, seed: int) -> np.ndarray:
+    """
+    Mask of the records of the sampled prefix families.
+
+    A family is the conversations whose first turn starts with the same block
+    (typically the same system prompt). A family with more than
+    OVERSIZED_FAMILY times the requests of a mean kept family is split into
+    its conversations. The resulting units are sorted by their number of
+    requests (ties in random order) and every 1/ratio-th one is kept, from a
+    random offset.
+    """
+    rng = np.random.default_rng(seed)
+    # Conversations are numbered in the order of their first turn
+    _, conversation_family = np.unique(first_blocks[linker.turn == 0], return_inverse=True)
+    family_sizes = np.bincount(conversation_family[linker.conversation])
+    mean_kept_size = len(linker.conversation) / max(len(family_sizes) * ratio, 1)
+    oversized = family_sizes > OVERSIZED_FAMILY * mean_kept_size
+    if oversized.any():
+        logger.info(
+            f"Sampling the conversations of {oversized.sum()} prefix families of more "
+            f"than {OVERSIZED_FAMILY * mean_kept_size:.0f} requests one by one"
+        )
+    num_conversations = len(conversation_family)
+    conversation_unit = np.where(
+        oversized[conversation_family],
+        len(family_sizes) + np.arange(num_conversations),
+        conversation_family,
+    )
+    _, conversation_unit = np.unique(conversation_unit, return_inverse=True)
+    unit = conversation_unit[linker.conversation]
+    sizes = np.bincount(unit)
+    num_units = len(sizes)
+    shuffled = rng.permutation(num_units)
+    order = shuffled[np.argsort(sizes[shuffled], kind="stable")]
+    # Rank i is kept when floor((i + offset) * ratio) steps up
+    steps = np.floor((np.arange(num_units + 1) + rng.random()) * ratio)
+    kept = np.zeros(num_units, dtype=bool)
+    kept[order[np.diff(steps) > 0]] = True
+    return kept[unit]
+
+
+def rescale(timestamps: np.ndarray, target_qps: Optional[float] = None,
+            duration: Optional[float] = None) -> np.ndarray:
+    """Timestamps (ms) rescaled to a mean rate (req/s) or total length (s)"""
+    if len(timestamps) < 2:
+        return timestamps
+    span = timestamps[-1] - timestamps[0]
+    if span <= 0:
+        return timestamps
+    if target_qps is not None:
+        duration = (len(timestamps) - 1) / target_qps
+    if duration is None:
+        return timestamps
+    return timestamps[0] + (timestamps - timestamps[0]) * (duration * 1000 / span)
+
+
+def trace_stats(trace: MooncakeTrace, block_size: int) -> Tuple[dict, dict]:
+    """
+    Statistics of a trace that matter to a cache benchmark, and the input
+    length, output length and first block of each record
+    """
+    input_lengths = []
+    output_lengths = []
+    first_blocks = []
+    for record in trace:
+        hash_ids = record["hash_ids"]
+        input_lengths.append(record.get("input_length", block_size * len(hash_ids)))
+        output_lengths.append(record["output_length"])
+        first_blocks.append(hash_ids[0] if len(hash_ids) > 0 else -1)
+    input_lengths = np.array(input_lengths, dtype=np.int64)
+    output_lengths = np.array(output_lengths, dtype=np.int64)
+    columns = {
+        "input_length": input_lengths,
+        "output_length": output_lengths,
+        "first_block": np.array(first_blocks, dtype=np.int64),
+    }
+
+    timestamps = trace.timestamps
+    duration = (timestamps[-1] - timestamps[0]) / 1000 if len(trace) > 1 else 0.0
+    gaps = np.diff(timestamps)
+    linker = ConversationLinker(trace)
+    reuse = analyze(trace, block_size)
+
+    stats = {
+        "requests": len(trace),
+        "conversations": len(linker),
+        "turns_per_conversation": len(trace) / max(len(linker), 1),
+        "duration_s": duration,
+        "mean_qps": (len(trace) - 1) / duration if duration > 0 else float("nan"),
+        "interarrival_cv": gaps.std() / gaps.mean() if len(gaps) > 0 and gaps.mean() > 0
+        else float("nan"),
+    }
+    for name, values in (("input_length", input_lengths), ("output_length", output_lengths)):
+        stats[f"{name}_mean"] = values.mean() if len(values) > 0 else float("nan")
+        for q in (50, 90, 99):
+            stats[f"{name}_p{q}"] = np.percentile(values, q) if len(values) > 0 else float("nan")
+    stats["block_reuse_ratio"] = reuse["block_hist"].sum() / max(reuse["accesses"], 1)
+    stats["prefix_hit_ratio"] = reuse["token_hist"].sum() / max(reuse["total_tokens"], 1)
+    return stats, columns
+
+
+def ks_distance(a: np.ndarray, b: np.ndarray) -> float:
+    """Largest gap between the empirical CDFs of two samples"""
+    if len(a) == 0 or len(b) == 0:
+        return float("nan")
+    values = np.union1d(a, b)
+    cdf_a = np.searchsorted(np.sort(a), values, side="right") / len(a)
+    cdf_b = np.searchsorted(np.sort(b), values, side="right") / len(b)
+    return float(np.abs(cdf_a - cdf_b).max())
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Compress, subsample and rescale a Mooncake trace.")
+    parser.add_argument("trace_file", help="Mooncake-format trace (JSONL)")
+    parser.add_argument("output_file", help="Transformed trace to write (JSONL)")
+    parser.add_argument("--max-gap", type=float, default=None,
+                        help="Cut every idle gap between requests to this many seconds")
+    parser.add_argument("--sample-ratio", type=float, default=1.0,
+                        help="Share of the prefix families (conversations whose "
+                             "first turn starts with the same block) to keep, "
+                             "each kept or dropped whole; a family far larger than "
+                             "the others is sampled by conversation (default: %(default)s)")
+    rate = parser.add_mutually_exclusive_group()
+    rate.add_argument("--target-qps", type=float, default=None,
+                      help="Rescale the timestamps to this mean request rate")
+    rate.add_argument("--duration", type=float, default=None,
+                      help="Rescale the timestamps to this total length in seconds")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE,
+                        help="Tokens per hash block (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed of the sampling (default: %(default)s)")
+    parser.add_argument("--report", type=str, default=None,
+                        help="Also write the statistics to this CSV file")
+    args = parser.parse_args()
+    if not 0 < args.sample_ratio <= 1:
+        parser.error("--sample-ratio must be in (0, 1]")
+    return args
+
+
+def main():
+    args = parse_args()
+    trace = MooncakeTrace(args.trace_file)
+    start = time.perf_counter()
+    original, original_columns = trace_stats(trace, args.block_size)
+
+    timestamps = trace.timestamps
+    if args.max_gap is not None:
+        timestamps = compress_gaps(timestamps, args.max_gap * 1000)
+    keep = np.ones(len(trace), dtype=bool)
+    if args.sample_ratio < 1:
+        linker = ConversationLinker(trace)
+        keep = sample_families(linker, original_columns["first_block"], args.sample_ratio,
+                               args.seed)
+        kept_share = keep.mean() if len(keep) > 0 else 0.0
+        if abs(kept_share - args.sample_ratio) > SAMPLE_RATIO_TOLERANCE * args.sample_ratio:
+            logger.warning(
+                f"Kept {kept_share * 100:.2f}% of the requests for --sample-ratio "
+                f"{args.sample_ratio}: the prefix families are too uneven to sample closer"
+            )
+    indices = np.flatnonzero(keep)
+    timestamps = rescale(timestamps[indices], args.target_qps, args.duration)
+    timestamps = timestamps - (timestamps[0] if len(timestamps) > 0 else 0)
+
+    with open(args.output_file, "w") as file:
+        for idx, timestamp in zip(indices, timestamps):
+            record = trace[idx]
+            record["timestamp"] = int(round(timestamp))
+            file.write(json.dumps(record) + "\n")
+    trace.close()
+    logger.info(f"Wrote {len(indices)} of {len(trace)} requests to {args.output_file}")
+
+    transformed_trace = MooncakeTrace(args.output_file)
+    transformed, transformed_columns = trace_stats(transformed_trace, args.block_size)
+    transformed_trace.close()
+    logger.info(f"Transformed the trace in {time.perf_counter() - start:.2f}s")
+
+    report = pd.DataFrame({"original": original, "transformed": transformed})
+    for name in ("input_length", "output_length"):
+        report.loc[f"{name}_ks_distance"] = [
+            0.0, ks_distance(original_columns[name], transformed_columns[name])]
+
+    print("\n")
+    print(report.to_string(float_format=lambda value: f"{value:.4f}"))
+    print("\n")
+    if args.report:
+        report.to_csv(args.report, index_label="statistic")
+        logger.info(f"Statistics written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
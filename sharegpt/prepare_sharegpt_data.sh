@@ -4,9 +4,10 @@
 LIMIT=1000
 MIN_ROUNDS=5
 START_ROUND=3
+TRACE=0
 
 # Parse command line arguments.
-while getopts "l:m:s:" opt; do
+while getopts "l:m:s:t" opt; do
   case $opt in
     l)
       LIMIT="$OPTARG"
@@ -17,8 +18,11 @@ while getopts "l:m:s:" opt; do
     s)
       START_ROUND="$OPTARG"
       ;;
+    t)
+      TRACE=1
+      ;;
     *)
-      echo "Usage: $0 [-l limit] [-m min_rounds] [-s start_round]"
+      echo "Usage: $0 [-l limit] [-m min_rounds] [-s start_round] [-t]"
       exit 1
       ;;
   esac
@@ -35,6 +39,10 @@ python3 data_preprocessing.py --parse 1
 python3 concat_input.py --limit "$LIMIT"
 python3 prepare_run_dataset.py --min_rounds "$MIN_ROUNDS" --start_round "$START_ROUND"
 python3 prepare_warmup_dataset.py --min_rounds "$MIN_ROUNDS" --round_number "$ROUND_NUMBER"
+# Optionally keep the conversations as a Mooncake-format trace.
+if [ "$TRACE" -eq 1 ]; then
+  python3 sharegpt_to_mooncake.py --input modified_file.json --output sharegpt_trace.jsonl
+fi
 
 # List of files to delete.
 files=(
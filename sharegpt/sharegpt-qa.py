@@ -4,8 +4,12 @@ sharegpt_benchmark.py – streamlined ShareGPT replay tool
 =======================================================
 
 Replays prompts from a ShareGPT‑style JSON file against an OpenAI‑compatible
-HTTP endpoint at a fixed QPS, records latency metrics, and writes a CSV report
+HTTP endpoint at a target QPS, records latency metrics, and writes a CSV report
 **sorted by launch_time** so downstream analyses have deterministic ordering.
+
+Arrivals follow a pluggable process (deterministic, Poisson, gamma or a
+replayed inter‑arrival file). The full schedule is computed up front and
+dispatched from timers on the asyncio loop.
 """
 
 import argparse
@@ -13,14 +17,31 @@ import asyncio
 import json
 import logging
 import time
+from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from typing import List, Optional
 import random
-import openai
+import numpy as np
 import pandas as pd
 import os
 
-from utils import AsyncLoopWrapper, init_logger
+from utils import (
+    STREAM_OPTIONS,
+    AsyncLoopWrapper,
+    ChunkTimer,
+    LatencySketches,
+    LiveMetrics,
+    RecordSpool,
+    add_metrics_arguments,
+    add_record_stream_arguments,
+    add_transport_arguments,
+    build_transport,
+    chunk_time_stats,
+    init_logger,
+    records_path,
+    sketch_path,
+    start_live_metrics,
+)
 
 logger = init_logger(__name__, logging.INFO)
 
@@ -47,14 +68,116 @@ def parse_args() -> argparse.Namespace:
                         help="Seconds between progress logs (default: %(default)s)")
     parser.add_argument("--time", type=int,
                         help="Maximum time to run the benchmark in seconds")
+    parser.add_argument("--arrival", choices=sorted(ARRIVAL_PROCESSES),
+                        default="deterministic",
+                        help="Request arrival process (default: %(default)s)")
+    parser.add_argument("--burstiness", type=float, default=1.0,
+                        help="Gamma shape factor for --arrival gamma: 1 is "
+                             "Poisson, <1 is burstier, >1 is smoother "
+                             "(default: %(default)s)")
+    parser.add_argument("--arrival-file",
+                        help="File with one inter-arrival gap in seconds per "
+                             "line, for --arrival replay (cycled if shorter "
+                             "than the prompt list)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the arrival process (default: %(default)s)")
+    parser.add_argument("--num-shards", type=int, default=1,
+                        help="Number of load generator hosts sharing the "
+                             "prompt list (default: %(default)s)")
+    parser.add_argument("--shard-index", type=int, default=0,
+                        help="Index of this host's shard: it replays every "
+                             "num-shards-th prompt at its global arrival time "
+                             "(default: %(default)s)")
+    parser.add_argument("--start-at", type=float,
+                        help="Wall-clock time (epoch seconds) to start at, "
+                             "used to synchronize several hosts")
+    add_transport_arguments(parser)
+    add_metrics_arguments(parser)
+    add_record_stream_arguments(parser)
     parser.add_argument("--verbose", action="store_true",
                         help="Enable DEBUG logging")
     return parser.parse_args()
 
+# ---------------------------------------------------------------------------
+# Arrival processes
+# ---------------------------------------------------------------------------
+
+class ArrivalProcess(ABC):
+    """Generates the inter-arrival gaps (in seconds) of the request stream."""
+
+    def __init__(self, qps: float):
+        self.qps = qps
+
+    @abstractmethod
+    def inter_arrivals(self, num_requests: int, rng: np.random.Generator) -> np.ndarray:
+        """Gap (s) after each of the num_requests requests."""
+
+    def schedule(self, num_requests: int, rng: np.random.Generator) -> np.ndarray:
+        """Offsets from the benchmark start at which each request is due."""
+        if num_requests == 0:
+            return np.zeros(0)
+        gaps = self.inter_arrivals(num_requests, rng)
+        return np.concatenate(([0.0], np.cumsum(gaps[:-1])))
+
+
+class DeterministicArrival(ArrivalProcess):
+    def inter_arrivals(self, num_requests, rng):
+        return np.full(num_requests, 1.0 / self.qps)
+
+
+class PoissonArrival(ArrivalProcess):
+    def inter_arrivals(self, num_requests, rng):
+        return rng.exponential(1.0 / self.qps, num_requests)
+
+
+class GammaArrival(ArrivalProcess):
+    def __init__(self, qps: float, burstiness: float):
+        super().__init__(qps)
+        if burstiness <= 0:
+            raise ValueError("--burstiness must be positive")
+        self.burstiness = burstiness
+
+    def inter_arrivals(self, num_requests, rng):
+        # Mean gap stays 1/qps, the coefficient of variation is 1/sqrt(shape)
+        scale = 1.0 / (self.qps * self.burstiness)
+        return rng.gamma(self.burstiness, scale, num_requests)
+
+
+class ReplayArrival(ArrivalProcess):
+    def __init__(self, qps: float, arrival_file: Optional[str]):
+        super().__init__(qps)
+        if arrival_file is None:
+            raise ValueError("--arrival replay requires --arrival-file")
+        self.gaps = np.loadtxt(arrival_file, dtype=float, ndmin=1)
+        if len(self.gaps) == 0:
+            raise ValueError(f"No inter-arrival gaps found in {arrival_file}")
+
+    def inter_arrivals(self, num_requests, rng):
+        return np.resize(self.gaps, num_requests)
+
+
+ARRIVAL_PROCESSES = {
+    "deterministic": lambda args: DeterministicArrival(args.qps),
+    "poisson": lambda args: PoissonArrival(args.qps),
+    "gamma": lambda args: GammaArrival(args.qps, args.burstiness),
+    "replay": lambda args: ReplayArrival(args.qps, args.arrival_file),
+}
+
+
+def build_arrival_process(args: argparse.Namespace) -> ArrivalProcess:
+    return ARRIVAL_PROCESSES[args.arrival](args)
+
 # ---------------------------------------------------------------------------
 # Low‑level request handling
 # ---------------------------------------------------------------------------
 
+# Columns of the per-request records
+RECORD_COLUMNS = [
+    "prompt_tokens", "generation_tokens", "ttft", "generation_time",
+    "launch_time", "finish_time", "scheduled_time", "chunk_times", "error",
+]
+
+
 @dataclass
 class Response:
     body: str
@@ -64,23 +187,26 @@ class Response:
     generation_tokens: int
     launch_time: float
     finish_time: float
+    # Encoded arrival time and token count of each chunk, see ChunkTimer
+    chunk_times: str = ""
+    # The request failed: no tokens, and an empty body
+    error: bool = False
 
 
 class RequestExecutor:
-    """Thin wrapper over OpenAI async client that measures latency."""
+    """Thin wrapper over an async streaming transport that measures latency."""
 
-    def __init__(self, base_url: str, api_key: str, model: str):
-        # Ensure base_url ends with /v1 for vLLM
-        if not base_url.endswith('/v1'):
-            base_url = base_url.rstrip('/') + '/v1'
-        self.client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url)
+    def __init__(self, base_url: str, model: str, transport_args=None):
+        self.transport = build_transport(base_url, transport_args)
         self.model = model
         self.loop = AsyncLoopWrapper.GetOrStartLoop()
 
     async def _async_request(self, messages, max_tokens: int) -> Response:
         start = time.time()
         first_token: Optional[float] = None
+        chunk_timer = ChunkTimer()
         body = ""
+        usage = None
 
         try:
             # Check if we should use chat completions API
@@ -88,59 +214,52 @@ class RequestExecutor:
             
             if use_chat_completions:
                 # Use chat.completions API
-                stream = await self.client.chat.completions.create(
-                    messages=messages,
-                    model=self.model,
-                    temperature=0,
-                    stream=True,
-                    max_tokens=max_tokens,
-                    stream_options={"include_usage": True},
-                )
-                
-                async for chunk in stream:
-                    if not chunk.choices:
-                        continue
-                    delta = chunk.choices[0].delta.content
-                    if delta:
-                        if first_token is None:
-                            first_token = time.time()
-                        body += delta
+                endpoint = "chat"
+                payload = {"messages": messages}
             else:
                 # Use completions API
                 # Concatenate all messages with role labels
                 prompt = "\n".join([f"{msg['role'].upper()}: {msg['content']}" for msg in messages])
-                
-                stream = await self.client.completions.create(
-                    prompt=prompt,
-                    model=self.model,
-                    temperature=0,
-                    stream=True,
-                    max_tokens=max_tokens,
-                    stream_options={"include_usage": True},
-                )
-                
-                async for chunk in stream:
-                    if not chunk.choices:
-                        continue
-                    delta = chunk.choices[0].text
-                    if delta:
-                        if first_token is None:
-                            first_token = time.time()
-                        body += delta
-
-            usage = chunk.usage  # type: ignore[attr-defined]
+                endpoint = "completions"
+                payload = {"prompt": prompt}
+
+            payload.update(
+                model=self.model,
+                temperature=0,
+                max_tokens=max_tokens,
+                stream_options=STREAM_OPTIONS,
+            )
+            async for delta, chunk_usage in self.transport.stream(endpoint, payload):
+                chunk_timer.on_chunk(delta, chunk_usage)
+                if chunk_usage is not None:
+                    usage = chunk_usage
+                if delta:
+                    if first_token is None:
+                        first_token = time.time()
+                    body += delta
+
             return Response(
                 body=body,
                 ttft=(first_token or time.time()) - start,
                 generation_time=time.time() - (first_token or start),
-                prompt_tokens=usage.prompt_tokens,
-                generation_tokens=usage.completion_tokens,
+                prompt_tokens=usage["prompt_tokens"],
+                generation_tokens=usage["completion_tokens"],
                 launch_time=start,
                 finish_time=time.time(),
+                chunk_times=chunk_timer.encode(),
             )
         except Exception as e:
             logger.error(f"Error in request: {str(e)}")
-            raise
+            return Response(
+                body="",
+                ttft=0.0,
+                generation_time=0.0,
+                prompt_tokens=0,
+                generation_tokens=0,
+                launch_time=start,
+                finish_time=time.time(),
+                error=True,
+            )
 
     def launch_request(self, prompt: str, max_tokens: int, on_finish) -> None:
         messages = [{"role": "user", "content": prompt}]
@@ -153,39 +272,61 @@ class RequestExecutor:
 # ---------------------------------------------------------------------------
 
 class BenchmarkRunner:
-    """Dispatch prompts at desired QPS and collect latency metrics."""
+    """Dispatch prompts on a precomputed arrival schedule and collect latency metrics."""
 
-    def __init__(self, prompts: List[dict], executor: RequestExecutor, qps: float, time_limit: Optional[int] = None):
+    def __init__(self, prompts: List[dict], executor: RequestExecutor, qps: float,
+                 schedule: np.ndarray, time_limit: Optional[int] = None,
+                 live: Optional[LiveMetrics] = None,
+                 records_spool: Optional[RecordSpool] = None):
         self.prompts = prompts
         self.executor = executor
         self.qps = qps
+        self.schedule = schedule
         self.time_limit = time_limit
         self.results: List[Response] = []
-        self._next_idx = 0
+        self.scheduled_times: List[float] = []
         self.start_time = time.time()
+        self.live = live
+        self.records_spool = records_spool
 
-    def _on_finish(self, resp: Response):
+    def _on_finish(self, resp: Response, scheduled_time: float):
         self.results.append(resp)
-
-    def run(self) -> pd.DataFrame:
-        logger.info("Benchmark started: %d prompts at %.2f QPS", len(self.prompts), self.qps)
-
-        while self._next_idx < len(self.prompts):
+        self.scheduled_times.append(scheduled_time)
+        if self.records_spool is not None:
+            self.records_spool.write(dict(vars(resp), scheduled_time=scheduled_time))
+        if self.live is None:
+            return
+        if resp.error:
+            self.live.on_error()
+        else:
+            self.live.on_finish(resp.ttft, resp.finish_time - resp.launch_time, resp.chunk_times)
+
+    async def _dispatch(self):
+        for idx, offset in enumerate(self.schedule):
             # Check time limit
-            if self.time_limit is not None and time.time() - self.start_time > self.time_limit:
+            if self.time_limit is not None and offset > self.time_limit:
                 logger.info(f"Time limit of {self.time_limit} seconds reached, stopping benchmark")
                 break
 
-            scheduled = self.start_time + self._next_idx / self.qps
-            if time.time() < scheduled:
-                time.sleep(0.001)
-                continue
+            scheduled = self.start_time + offset
+            delay = scheduled - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
 
-            entry = self.prompts[self._next_idx]
+            entry = self.prompts[idx]
             prompt = str(self.qps) + " " + entry["input"] # To avoid cache hit cross run
             max_tokens = entry.get("output_length", 1)
-            self.executor.launch_request(prompt, max_tokens, self._on_finish)
-            self._next_idx += 1
+            if self.live is not None:
+                self.live.on_launch()
+            self.executor.launch_request(
+                prompt, max_tokens,
+                lambda resp, scheduled=scheduled: self._on_finish(resp, scheduled))
+
+    def run(self) -> pd.DataFrame:
+        logger.info("Benchmark started: %d prompts at %.2f QPS", len(self.prompts), self.qps)
+
+        self.start_time = time.time()
+        asyncio.run_coroutine_threadsafe(self._dispatch(), self.executor.loop).result()
 
         AsyncLoopWrapper.WaitLoop()  # wait for inflight requests
         logger.info("All requests completed")
@@ -197,6 +338,9 @@ class BenchmarkRunner:
             "generation_time": [r.generation_time for r in self.results],
             "launch_time": [r.launch_time for r in self.results],
             "finish_time": [r.finish_time for r in self.results],
+            "scheduled_time": self.scheduled_times,
+            "chunk_times": [r.chunk_times for r in self.results],
+            "error": [r.error for r in self.results],
         })
 
         # Ensure deterministic ordering for downstream scripts/visualisation
@@ -206,13 +350,34 @@ class BenchmarkRunner:
 # Summary helpers
 # ---------------------------------------------------------------------------
 
-def log_summary(df: pd.DataFrame):
+def log_summary(df: pd.DataFrame, sketches: LatencySketches):
+    if "error" in df.columns:
+        failed = df["error"].astype(bool)
+        if failed.any():
+            logger.warning("%d requests failed, left out of the figures below", failed.sum())
+        df = df[~failed]
     duration = df["finish_time"].max() - df["launch_time"].min()
     throughput = len(df) / duration if duration > 0 else 0
     logger.info("Completed %d requests in %.2fs (%.2f QPS)", len(df), duration, throughput)
     logger.info("Average TTFT: %.3fs", df["ttft"].mean())
     logger.info("Avg generation speed per req: %.1f tokens/s", (
         df["generation_tokens"] / df["generation_time"]).mean())
+    launch_skew = (df["launch_time"] - df["scheduled_time"]) * 1000
+    logger.info("Launch skew (actual - scheduled): p50 %.2fms, p99 %.2fms, max %.2fms",
+                launch_skew.quantile(0.5), launch_skew.quantile(0.99), launch_skew.max())
+    for name in LatencySketches.METRICS:
+        sketch = sketches[name]
+        if sketch.count > 0:
+            logger.info("%s: p50 %.2fms, p90 %.2fms, p95 %.2fms, p99 %.2fms", name.upper(),
+                        *(sketch.quantile(q) * 1000 for q in (0.5, 0.9, 0.95, 0.99)))
+    stats = chunk_time_stats(df["chunk_times"])
+    if stats is not None:
+        logger.info("Decode stalls (gap > %gx p50 ITL): %d (%.2f%% of gaps, %.2fs), "
+                    "p99.9 ITL %.2fms, max ITL %.2fms",
+                    stats["stall_factor"], stats["num_stalls"], stats["stall_share"] * 100,
+                    stats["stall_time"], stats["itl_p999"] * 1000, stats["itl_max"] * 1000)
+        logger.info("Coalesced chunks (more than one token): %.2f%%",
+                    stats["coalesced_share"] * 100)
 
 # ---------------------------------------------------------------------------
 # Entry point
@@ -230,18 +395,43 @@ def main():
         logger.info(f"Loaded {len(prompts)} ShareGPT entries")
 
         # Initialize executor
-        executor = RequestExecutor(args.base_url, "EMPTY", args.model)
+        executor = RequestExecutor(args.base_url, args.model, args)
+
+        # Precompute the arrival schedule. Every shard computes the global
+        # schedule and keeps its own slice of it, so together they replay it
+        rng = np.random.default_rng(args.seed)
+        schedule = build_arrival_process(args).schedule(len(prompts), rng)
+        prompts = prompts[args.shard_index::args.num_shards]
+        schedule = schedule[args.shard_index::args.num_shards]
+
+        if args.start_at is not None:
+            delay = args.start_at - time.time()
+            if delay < 0:
+                logger.warning(f"Missed the synchronized start by {-delay:.2f} secs")
+            else:
+                logger.info(f"Waiting {delay:.2f} secs for the synchronized start")
+                time.sleep(delay)
+
+        live = start_live_metrics(args, executor.loop, args.qps / args.num_shards)
+        if live is not None:
+            logger.info(f"Serving metrics on port {args.metrics_port}")
 
         # Run benchmark
-        runner = BenchmarkRunner(prompts, executor, args.qps, args.time)
+        records_spool = None
+        if args.stream_records:
+            records_spool = RecordSpool(records_path(args.output), RECORD_COLUMNS)
+        runner = BenchmarkRunner(prompts, executor, args.qps, schedule, args.time, live,
+                                 records_spool)
         df = runner.run()
         
         # Write results
         df.to_csv(args.output, index=False)
+        sketches = LatencySketches.from_frame(df)
+        sketches.save(sketch_path(args.output))
         logger.info(f"Results written to {args.output}")
 
         # Log summary
-        log_summary(df)
+        log_summary(df, sketches)
     finally:
         # Always stop the asyncio loop
         AsyncLoopWrapper.StopLoop()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+sharegpt_to_mooncake.py – Mooncake-format multi-turn trace from ShareGPT
+========================================================================
+
+Turns the conversations preprocessed by ``concat_input.py`` (cumulative
+``input``, ``input2``, ... and their ``output_length``s) into a Mooncake-format
+trace, so ``mooncake/mooncake-qa.py --multi-turn`` can replay them with their
+prefix reuse.
+
+Every turn's input is tokenized once, as the previous turn's tokens plus the
+text appended since, and cut into ``--block-size`` token blocks whose ids are
+chained hashes (numbered in order of first appearance). A follow-up turn
+therefore shares every full block of the turn before it, as in the published
+Mooncake traces.
+
+Sessions start according to ``--arrival`` at ``--session-rate`` sessions per
+second. Within a session, a turn is sent a think time after the previous
+answer, which itself takes ``output_length / --decode-speed`` seconds.
+
+    python3 sharegpt_to_mooncake.py --input modified_file.json --output sharegpt_trace.jsonl \\
+        --session-rate 0.5 --think-time 20 --think-time-dist lognormal
+"""
+
+import argparse
+import json
+import logging
+from typing import List
+
+import numpy as np
+
+from utils import chained_block_hashes, init_logger, load_tokenizer
+
+logger = init_logger(__name__, logging.INFO)
+
+# Block size of the published Mooncake traces, in tokens
+DEFAULT_BLOCK_SIZE = 512
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Synthesize a Mooncake-format multi-turn trace from ShareGPT conversations.")
+    parser.add_argument("--input", default="modified_file.json",
+                        help="Output of concat_input.py (default: %(default)s)")
+    parser.add_argument("--output", default="sharegpt_trace.jsonl",
+                        help="Mooncake-format trace to write (default: %(default)s)")
+    parser.add_argument("--tokenizer", default="meta-llama/Llama-3.1-8B-Instruct",
+                        help="Tokenizer of the served model (default: %(default)s)")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE,
+                        help="Tokens per hash block (default: %(default)s)")
+    parser.add_argument("--limit", type=int, default=None,
+                        help="Number of conversations to use (default: all)")
+    parser.add_argument("--session-rate", type=float, default=1.0,
+                        help="New sessions per second (default: %(default)s)")
+    parser.add_argument("--arrival", choices=["deterministic", "poisson", "gamma"],
+                        default="poisson",
+                        help="Session arrival process (default: %(default)s)")
+    parser.add_argument("--burstiness", type=float, default=1.0,
+                        help="Gamma shape factor for --arrival gamma: 1 is "
+                             "Poisson, <1 is burstier (default: %(default)s)")
+    parser.add_argument("--think-time", type=float, default=10.0,
+                        help="Mean seconds between an answer and the next "
+                             "turn (default: %(default)s)")
+    parser.add_argument("--think-time-dist", choices=["fixed", "exponential", "lognormal"],
+                        default="exponential",
+                        help="Distribution of the think time (default: %(default)s)")
+    parser.add_argument("--think-time-sigma", type=float, default=1.0,
+                        help="Log-space standard deviation of --think-time-dist "
+                             "lognormal (default: %(default)s)")
+    parser.add_argument("--decode-speed", type=float, default=None,
+                        help="Tokens per second an answer takes to generate, "
+                             "added before the think time (default: none)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed (default: %(default)s)")
+    args = parser.parse_args()
+    if args.session_rate <= 0:
+        parser.error("--session-rate must be positive")
+    if args.burstiness <= 0:
+        parser.error("--burstiness must be positive")
+    return args
+
+
+def session_starts(num_sessions: int, args: argparse.Namespace,
+                   rng: np.random.Generator) -> np.ndarray:
+    """Start time (s) of each session"""
+    mean_gap = 1.0 / args.session_rate
+    if args.arrival == "deterministic":
+        gaps = np.full(num_sessions, mean_gap)
+    elif args.arrival == "poisson":
+        gaps = rng.exponential(mean_gap, num_sessions)
+    else:
+        # Mean gap stays 1/rate, the coefficient of variation is 1/sqrt(shape)
+        gaps = rng.gamma(args.burstiness, mean_gap / args.burstiness, num_sessions)
+    return np.concatenate(([0.0], np.cumsum(gaps[:-1])))
+
+
+def think_time(args: argparse.Namespace, rng: np.random.Generator) -> float:
+    if args.think_time_dist == "fixed":
+        return args.think_time
+    if args.think_time_dist == "exponential":
+        return rng.exponential(args.think_time)
+    # Mean of the lognormal is exp(mu + sigma^2 / 2)
+    sigma = args.think_time_sigma
+    return rng.lognormal(np.log(args.think_time) - sigma ** 2 / 2, sigma)
+
+
+def conversation_turns(entry: dict) -> List[tuple]:
+    """(input text, output length) of every turn of a concat_input.py entry"""
+    turns = []
+    while True:
+        suffix = "" if not turns else str(len(turns) + 1)
+        if f"input{suffix}" not in entry:
+            return turns
+        turns.append((entry[f"input{suffix}"], entry.get(f"output_length{suffix}", 20)))
+
+
+def main():
+    args = parse_args()
+    rng = np.random.default_rng(args.seed)
+    tokenizer = load_tokenizer(args.tokenizer)
+    with open(args.input, "r") as f:
+        conversations = json.load(f)[:args.limit]
+    conversations = [turns for turns in map(conversation_turns, conversations) if turns]
+    starts = session_starts(len(conversations), args, rng)
+
+    # Block hash -> trace hash id, numbered by first appearance
+    hash_ids = {}
+    records = []
+    block_accesses = 0
+    for start, turns in zip(starts, conversations):
+        now = start
+        text = ""
+        token_ids = []
+        for turn_input, output_length in turns:
+            # Follow-ups extend the previous input, so only the new text is
+            # tokenized and the shared prefix keeps the same tokens
+            if token_ids and turn_input.startswith(text):
+                token_ids = token_ids + tokenizer.encode(
+                    turn_input[len(text):], add_special_tokens=False)
+            else:
+                token_ids = tokenizer.encode(turn_input)
+            text = turn_input
+            hashes = chained_block_hashes(token_ids, args.block_size)
+            block_accesses += len(hashes)
+            records.append({
+                "timestamp": int(round(now * 1000)),
+                "input_length": len(token_ids),
+                "output_length": int(output_length),
+                "hash_ids": [hash_ids.setdefault(h, len(hash_ids)) for h in hashes],
+            })
+            if args.decode_speed:
+                now += output_length / args.decode_speed
+            now += think_time(args, rng)
+
+    records.sort(key=lambda record: record["timestamp"])
+    with open(args.output, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+    duration = records[-1]["timestamp"] / 1000 if records else 0.0
+    logger.info(
+        f"Wrote {len(records)} requests of {len(conversations)} sessions over "
+        f"{duration:.1f}s ({len(records) / max(duration, 1e-9):.3f} reqs/s) to {args.output}"
+    )
+    logger.info(
+        f"{len(hash_ids)} distinct blocks, {1 - len(hash_ids) / max(block_accesses, 1):.2%} "
+        f"of the {block_accesses} block accesses are reuses"
+    )
+
+
+if __name__ == "__main__":
+    main()
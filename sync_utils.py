@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+sync_utils.py – keep the benchmarks' copies of utils.py identical
+=================================================================
+
+Every benchmark directory runs as a standalone script directory with its own
+``utils.py``. ``synthetic-multi-round-qa/utils.py`` is the one to edit; this
+script copies it over the others (``distributed/`` imports it directly):
+
+    python3 sync_utils.py            # copy the canonical utils.py everywhere
+    python3 sync_utils.py --check    # exit 1 if a copy differs
+"""
+
+import argparse
+import filecmp
+import os
+import shutil
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+CANONICAL = os.path.join(REPO_ROOT, "synthetic-multi-round-qa", "utils.py")
+COPIES = [
+    os.path.join(REPO_ROOT, directory, "utils.py")
+    for directory in ("agentic", "mooncake", "sharegpt")
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Copy synthetic-multi-round-qa/utils.py to the other benchmarks.")
+    parser.add_argument("--check", action="store_true",
+                        help="Only report the copies that differ, and exit 1 if any does")
+    args = parser.parse_args()
+
+    stale = [path for path in COPIES if not filecmp.cmp(CANONICAL, path, shallow=False)]
+    if args.check:
+        for path in stale:
+            print(f"{os.path.relpath(path, REPO_ROOT)} differs from "
+                  f"{os.path.relpath(CANONICAL, REPO_ROOT)}")
+        sys.exit(1 if stale else 0)
+    for path in stale:
+        shutil.copyfile(CANONICAL, path)
+        print(f"Updated {os.path.relpath(path, REPO_ROOT)}")
+
+
+if __name__ == "__main__":
+    main()
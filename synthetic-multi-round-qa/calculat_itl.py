@@ -1,15 +1,29 @@
+import argparse
+
 import pandas as pd
 
-# Replace 'data.csv' with your CSV file path
-df = pd.read_csv('stack_output_1.1.csv')
+from utils import chunk_time_stats, print_chunk_time_summary
+
+parser = argparse.ArgumentParser(description="Inter-token latency of a benchmark output CSV")
+parser.add_argument("filename", nargs="?", default="stack_output_1.1.csv",
+                    help="Benchmark output CSV (default: %(default)s)")
+args = parser.parse_args()
+
+df = pd.read_csv(args.filename)
+
+if "chunk_times" in df.columns and chunk_time_stats(df["chunk_times"]) is not None:
+    # Distributions from the per-chunk timestamps recorded by the benchmark
+    print_chunk_time_summary(df["chunk_times"])
+else:
+    # Older CSVs only have the total generation time of each request
 
-# Optionally, filter out rows where generation_tokens are zero to avoid division by zero errors
-df = df[df['generation_tokens'] != 0]
+    # Optionally, filter out rows where generation_tokens are zero to avoid division by zero errors
+    df = df[df['generation_tokens'] != 0]
 
-# Calculate the ratio: generation_time / generation_tokens for each row
-df['ratio'] = df['generation_time'] / df['generation_tokens']
+    # Calculate the ratio: generation_time / generation_tokens for each row
+    df['ratio'] = df['generation_time'] / df['generation_tokens']
 
-# Calculate the average of these ratios
-average_ratio = df['ratio'].mean()
+    # Calculate the average of these ratios
+    average_ratio = df['ratio'].mean()
 
-print("Average generation_time / generation_tokens:", average_ratio)
+    print("Average generation_time / generation_tokens:", average_ratio)
@@ -1,17 +1,42 @@
 import argparse
 import asyncio
+import heapq
+import itertools
 import json
 import logging
+import multiprocessing
+import queue
 import time
 from dataclasses import dataclass
 from typing import Optional, List, Dict
 import random
 import os
 
-import openai
+import numpy as np
 import pandas as pd
 
-from utils import AsyncLoopWrapper, init_logger
+from utils import (
+    STREAM_OPTIONS,
+    AsyncLoopWrapper,
+    ChunkTimer,
+    LatencySketches,
+    RecordSpool,
+    ResultStore,
+    WindowedMetrics,
+    TokenPromptCache,
+    add_metrics_arguments,
+    add_record_stream_arguments,
+    add_token_prompt_arguments,
+    add_transport_arguments,
+    build_token_prompts,
+    build_transport,
+    init_logger,
+    print_chunk_time_summary,
+    print_latency_summary,
+    records_path,
+    sketch_path,
+    start_live_metrics,
+)
 
 logger = init_logger(__name__, logging.INFO)
 
@@ -86,12 +111,14 @@ class ChatHistory:
     ):
         self.history = []
 
-    def on_user_query(self, query: str):
-        if len(self.history) == 0:
-            self.history.append({"role": "user", "content": query})
-        else:
+    def on_user_query(self, query: str, token_ids: Optional[List[int]] = None):
+        """token_ids: the query as token IDs, for TokenPromptCache"""
+        if len(self.history) > 0:
             assert self.history[-1]["role"] == "assistant", "Expect system response"
-            self.history.append({"role": "user", "content": query})
+        message = {"role": "user", "content": query}
+        if token_ids is not None:
+            message["token_ids"] = token_ids
+        self.history.append(message)
 
     def on_system_response(self, response: str):
         assert len(self.history) > 0, "Expect user query"
@@ -114,27 +141,50 @@ class Response:
     generation_tokens: int
     launch_time: float
     finish_time: float
+    # Encoded arrival time and token count of each chunk, see ChunkTimer
+    chunk_times: str = ""
+    # The request failed: no tokens, and an empty body
+    error: bool = False
+
+
+# Per-request result columns, in the order of the output CSV
+RESULT_COLUMNS = {
+    "prompt_tokens": np.int64,
+    "generation_tokens": np.int64,
+    "ttft": np.float64,
+    "generation_time": np.float64,
+    "user_id": np.int64,
+    "question_id": np.int64,
+    "launch_time": np.float64,
+    "finish_time": np.float64,
+    "scheduled_time": np.float64,
+    "chunk_times": object,
+    "error": np.bool_,
+}
 
 
 class RequestExecutor:
 
-    def __init__(self, base_url: str, model: str):
-        # Ensure base_url ends with /v1
-        if not base_url.endswith('/v1'):
-            base_url = base_url.rstrip('/') + '/v1'
-        
-        # For vLLM server, we don't need an API key, but the client requires one
-        self.client = openai.AsyncOpenAI(
-            api_key="EMPTY",  # Dummy API key for vLLM server
-            base_url=base_url
-        )
+    def __init__(
+        self,
+        base_url: str,
+        model: str,
+        transport_args=None,
+        token_prompts: Optional[TokenPromptCache] = None,
+    ):
+        """
+        token_prompts: send the prompts as token IDs to the completions API
+        """
+        self.transport = build_transport(base_url, transport_args)
         self.model = model
-        logging.info(f"Initialized OpenAI client with base_url={base_url} and model={model}")
+        self.token_prompts = token_prompts
+        logging.info(f"Initialized {type(self.transport).__name__} with base_url={base_url} and model={model}")
         self.loop = AsyncLoopWrapper.GetOrStartLoop()
         self.request_history = []
 
     async def _async_launch_request(self, messages: List[Dict[str, str]],  max_tokens: int, 
                                     extra_headers: Optional[Dict[str, str]] = None):
+        start_time = time.time()
         try:
             logging.info(f"Sending request to model {self.model} with messages: {messages}")
             
@@ -142,87 +192,63 @@ class RequestExecutor:
             words = ""
             tokens_out = 0
             tokens_prefill = 0
-            start_time = time.time()
+            usage = None
             first_token_time = None
+            chunk_timer = ChunkTimer()
 
             # Check if we should use chat completions API
             use_chat_completions = os.environ.get("USE_CHAT_COMPLETIONS", "False").lower() == "true"
             
-            if use_chat_completions:
+            if self.token_prompts is not None:
+                # Token IDs on the completions API, not tokenized by the server
+                endpoint = "completions"
+                payload = {"model": self.model, "prompt": self.token_prompts.prompt(messages)}
+            elif use_chat_completions:
                 # Use chat.completions API
-                response = await self.client.chat.completions.create(
-                    model=self.model,
-                    messages=messages,
-                    stream=True,
-                    max_tokens=max_tokens,
-                    temperature=0.0,
-                    stream_options={"include_usage": True},
-                    extra_headers=extra_headers,
-                )
-
-                # Process the streaming response
-                async for chunk in response:
-                    if not chunk.choices:
-                        continue
-                        
-                    # Handle content
-                    if chunk.choices[0].delta.content is not None:
-                        if first_token_time is None and chunk.choices[0].delta.content != "":
-                            first_token_time = time.time()
-                        words += chunk.choices[0].delta.content
+                endpoint = "chat"
+                payload = {"model": self.model, "messages": messages}
             else:
                 # Use completions API
                 # Convert messages to a prompt string
                 prompt = "\n".join([f"{msg['role'].upper()}: {msg['content']}" for msg in messages]) + "\nASSISTANT:"
-                
-                response = await self.client.completions.create(
-                    model=self.model,
-                    prompt=prompt,
-                    stream=True,
+                endpoint = "completions"
+                payload = {"model": self.model, "prompt": prompt}
+
+            # Process the streaming response
+            async for text, chunk_usage in self.transport.stream(
+                endpoint,
+                dict(
+                    payload,
                     max_tokens=max_tokens,
                     temperature=0.0,
-                    stream_options={"include_usage": True},
-                    extra_headers=extra_headers,
-                )
-                
-                # Process the streaming response
-                async for chunk in response:
-                    if not chunk.choices:
-                        continue
-                        
-                    # Handle content
-                    if chunk.choices[0].text:
-                        if first_token_time is None:
-                            first_token_time = time.time()
-                        words += chunk.choices[0].text
+                    stream_options=STREAM_OPTIONS,
+                ),
+                extra_headers=extra_headers,
+            ):
+                chunk_timer.on_chunk(text, chunk_usage)
+                if chunk_usage is not None:
+                    usage = chunk_usage
+
+                # Handle content
+                if text:
+                    if first_token_time is None:
+                        first_token_time = time.time()
+                    words += text
             
             # Handle token counts if available
-            if hasattr(chunk, 'usage') and chunk.usage is not None:
-                tokens_out = chunk.usage.completion_tokens
-                tokens_prefill = chunk.usage.prompt_tokens
+            if usage is not None:
+                tokens_out = usage["completion_tokens"]
+                tokens_prefill = usage["prompt_tokens"]
 
             # If we didn't get token counts from streaming, try to get them from the final response
             if tokens_out == 0 or tokens_prefill == 0:
                 print("No token counts from streaming, getting final response")
                 print(f"{tokens_out}, {tokens_prefill}")
                 try:
-                    if use_chat_completions:
-                        final_response = await self.client.chat.completions.create(
-                            model=self.model,
-                            messages=messages,
-                            stream=False,
-                        )
-                    else:
-                        prompt = "\n".join([f"{msg['role'].upper()}: {msg['content']}" for msg in messages]) + "\nASSISTANT:"
-                        final_response = await self.client.completions.create(
-                            model=self.model,
-                            prompt=prompt,
-                            stream=False,
-                        )
-                        
-                    if hasattr(final_response, 'usage') and final_response.usage is not None:
-                        tokens_out = final_response.usage.completion_tokens
-                        tokens_prefill = final_response.usage.prompt_tokens
+                    final_response = await self.transport.complete(endpoint, payload)
+                    if final_response.get("usage") is not None:
+                        tokens_out = final_response["usage"]["completion_tokens"]
+                        tokens_prefill = final_response["usage"]["prompt_tokens"]
                 except Exception as e:
                     logging.warning(f"Failed to get token counts from final response: {e}")
 
@@ -238,12 +264,23 @@ class RequestExecutor:
                 generation_tokens=tokens_out,
                 launch_time=start_time,
                 finish_time=time.time(),
+                chunk_times=chunk_timer.encode(),
             )
 
         except Exception as e:
             logging.error(f"Error in _async_launch_request: {str(e)}")
             logging.error(f"Request details - model: {self.model}, messages: {messages}")
-            raise
+            # Still a finished request, so that its user goes on
+            return Response(
+                body="",
+                ttft=0.0,
+                generation_time=0.0,
+                prompt_tokens=0,
+                generation_tokens=0,
+                launch_time=start_time,
+                finish_time=time.time(),
+                error=True,
+            )
 
     def launch_request(
         self,
@@ -265,8 +302,18 @@ class RequestExecutor:
 
 class UserSession:
 
-    def __init__(self, user_config: UserConfig, use_sharegpt=False, sharegpt_data=None):
+    def __init__(
+        self,
+        user_config: UserConfig,
+        store: ResultStore,
+        metrics: WindowedMetrics,
+        use_sharegpt=False,
+        sharegpt_data=None,
+    ):
         self.user_config = user_config
+        # Shared by all the sessions of the manager
+        self.store = store
+        self.metrics = metrics
         self.last_request_time = None
         self.chat_history = ChatHistory()
         self.question_id = 0
@@ -281,22 +328,45 @@ class UserSession:
         self.has_unfinished_request = False
         self.last_unfinished_log = 0
 
-        self.prompt_lengths = []
-        self.generation_lengths = []
-        self.ttfts = []
-        self.generation_times = []
-        self.launch_times = []
-        self.finish_times = []
+        self.num_results = 0
+
+        # Target launch time of the in-flight request, and of a request that
+        # became due while the previous one was still running
+        self.inflight_scheduled_time = None
+        self.overdue_time = None
+
+        # Callable[[UserSession], None] invoked after each finished request
+        self.finish_listener = None
 
         self.finished = False
 
     def _update_result(self, response: Response):
-        self.prompt_lengths.append(response.prompt_tokens)
-        self.generation_lengths.append(response.generation_tokens)
-        self.ttfts.append(response.ttft)
-        self.generation_times.append(response.generation_time)
-        self.launch_times.append(response.launch_time)
-        self.finish_times.append(response.finish_time)
+        self.num_results += 1
+        self.store.append(
+            prompt_tokens=response.prompt_tokens,
+            generation_tokens=response.generation_tokens,
+            ttft=response.ttft,
+            generation_time=response.generation_time,
+            user_id=self.user_config.user_id,
+            question_id=self.num_results,
+            launch_time=response.launch_time,
+            finish_time=response.finish_time,
+            scheduled_time=self.inflight_scheduled_time,
+            chunk_times=response.chunk_times,
+            error=response.error,
+        )
+        if response.error:
+            self.metrics.on_error()
+            return
+        self.metrics.on_finish(
+            response.prompt_tokens,
+            response.generation_tokens,
+            response.ttft,
+            response.generation_time,
+            response.finish_time - response.launch_time,
+            response.chunk_times,
+            launch_skew=response.launch_time - self.inflight_scheduled_time,
+        )
 
     def _build_system_prompt(self):
 
@@ -312,6 +382,18 @@ class UserSession:
         )
         return system_prompt
 
+    def _build_system_prompt_ids(self, token_prompts: TokenPromptCache) -> List[int]:
+        """
+        Token IDs of the system prompt, with exactly the configured lengths
+        of shared and user-specific tokens
+        """
+        return token_prompts.block(
+            "Hi, here's some system prompt:", self.user_config.system_prompt_len
+        ) + token_prompts.block(
+            f" For user {self.user_config.user_id}, here are some other context:",
+            self.user_config.user_info_len,
+        )
+
     def _build_new_question(self):
         self.question_id += 1
         return (
@@ -319,7 +401,12 @@ class UserSession:
             + "a new long story with a happy ending?"
         )
 
-    def _launch_new_request(self, timestamp: float, request_executor: RequestExecutor):
+    def _launch_new_request(
+        self,
+        timestamp: float,
+        request_executor: RequestExecutor,
+        scheduled_time: Optional[float] = None,
+    ):
         if self.use_sharegpt:
             if self.start_with_gpt:
                 prompt = self.sharegpt_data["conversations"][2 * self.question_id + 1][
@@ -332,9 +419,15 @@ class UserSession:
             self.question_id += 1
         else:
             prompt = self._build_new_question()
+        token_prompts = request_executor.token_prompts
+        token_ids = None
         if len(self.chat_history) == 0:
+            if token_prompts is not None:
+                token_ids = self._build_system_prompt_ids(token_prompts) + token_prompts.encode(
+                    prompt
+                )
             prompt = self._build_system_prompt() + prompt
-        self.chat_history.on_user_query(prompt)
+        self.chat_history.on_user_query(prompt, token_ids)
         logger.debug(
             f"User {self.user_config.user_id} issues request {self.question_id}"
         )
@@ -357,7 +450,11 @@ class UserSession:
             extra_headers={"x-user-id": str(self.user_config.user_id)},
         )
         self.has_unfinished_request = True
+        self.metrics.on_launch()
         self.last_request_time = timestamp
+        self.inflight_scheduled_time = (
+            scheduled_time if scheduled_time is not None else timestamp
+        )
 
     def _on_request_finished(self, response: Response):
         self.chat_history.on_system_response(response.body)
@@ -368,6 +465,8 @@ class UserSession:
             f"generation tokens: {response.generation_tokens}"
         )
         self._update_result(response)
+        if self.finish_listener is not None:
+            self.finish_listener(self)
 
     def set_internal_state(self, offset: float, timestamp: float):
         """Tell the session is the 'offset' seconds after the start"""
@@ -387,58 +486,51 @@ class UserSession:
             f"last_request_time: {self.last_request_time}"
         )
 
-    def step(self, timestamp: float, request_executor: RequestExecutor):
-        if (
-            self.question_id >= self.user_config.num_rounds
-            and not self.has_unfinished_request
-        ):
-            self.finished = True
-            return
+    def is_done(self) -> bool:
+        """Whether all the rounds of this session have been issued"""
+        return self.question_id >= self.user_config.num_rounds
 
+    def next_request_time(self) -> Optional[float]:
+        """Target launch time of the next request (None means right away)"""
         if self.last_request_time is None:
-            self._launch_new_request(timestamp, request_executor)
-            return
+            return None
+        return self.last_request_time + self.user_config.gap_between_requests
 
-        if timestamp - self.last_request_time > self.user_config.gap_between_requests:
-            if self.has_unfinished_request:
-                if timestamp - self.last_unfinished_log > 10:
-                    logger.warning(
-                        f"User {self.user_config.user_id} has an unfinished "
-                        "request and unable to fit the QPS requirement."
-                    )
-                    self.last_unfinished_log = timestamp
-                return
 
-            self._launch_new_request(timestamp, request_executor)
-            return
-
-    def summary(self) -> pd.DataFrame:
-        df = pd.DataFrame()
-        df["prompt_tokens"] = self.prompt_lengths
-        df["generation_tokens"] = self.generation_lengths
-        df["ttft"] = self.ttfts
-        df["generation_time"] = self.generation_times
-        df["user_id"] = self.user_config.user_id
-        df["question_id"] = range(1, len(self.prompt_lengths) + 1)
-        df["launch_time"] = self.launch_times
-        df["finish_time"] = self.finish_times
-        return df
+def shard_num_users(num_users: int, shard_index: int, num_shards: int) -> int:
+    """Number of concurrent users owned by one shard of the workload"""
+    return num_users // num_shards + (1 if shard_index < num_users % num_shards else 0)
 
 
 class UserSessionManager:
 
     def __init__(
-        self, workload_config: WorkloadConfig, init_user_id=0, use_sharegpt=False
+        self,
+        workload_config: WorkloadConfig,
+        init_user_id=0,
+        use_sharegpt=False,
+        shard_index=0,
+        num_shards=1,
+        records_spool: Optional[RecordSpool] = None,
     ):
         self.workload_config = workload_config
         self.sessions = []
 
+        # A shard owns every num_shards-th user of the global workload, so
+        # the shards together reproduce the single-process ramp and QPS
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.max_users = shard_num_users(workload_config.num_users, shard_index, num_shards)
+        self.qps = workload_config.qps * self.max_users / workload_config.num_users
+
         gap_between_requests_per_user = workload_config.num_users / workload_config.qps
         session_alive_time = gap_between_requests_per_user * (
             workload_config.num_rounds - 1
         )
         self.gap_between_users = session_alive_time / (workload_config.num_users + 0)
         self.ramp_up_time = workload_config.num_users * self.gap_between_users
+        self.first_join_delay = shard_index * self.gap_between_users
+        self.join_interval = num_shards * self.gap_between_users
 
         logger.info(
             f"Gap between users: {self.gap_between_users} secs.\n"
@@ -446,9 +538,15 @@ class UserSessionManager:
             f"Expected length of user session: {session_alive_time} secs."
         )
 
-        self.user_id = init_user_id
+        # User ids of a shard are init_user_id + shard_index + 1 + k * num_shards
+        self.user_id = init_user_id + shard_index + 1 - num_shards
         self.last_user_join = 0
-        self.session_summaries = []
+        self.store = ResultStore(
+            RESULT_COLUMNS,
+            capacity=self.max_users * workload_config.num_rounds,
+            spool=records_spool,
+        )
+        self.metrics = WindowedMetrics()
         self.start_time = None
 
         self.need_ramp_up = True
@@ -468,7 +566,7 @@ class UserSessionManager:
         logger.info(f"There are {len(self.sharegpt_data)} users satisfying ")
 
     def _ramp_up(self, timestamp: float, ramp_up_time: float):
-        for i in range(self.workload_config.num_users):
+        for i in range(self.shard_index, self.workload_config.num_users, self.num_shards):
             new_session = self._create_user_session()
             offset = ramp_up_time - i * self.gap_between_users
             if offset < 0:
@@ -477,14 +575,20 @@ class UserSessionManager:
         self.need_ramp_up = False
 
     def _create_user_session(self):
-        self.user_id += 1
+        self.user_id += self.num_shards
         user_config = UserConfig.new_user_config(self.user_id, self.workload_config)
         if self.use_sharegpt:
             user_session = UserSession(
-                user_config, self.use_sharegpt, self.sharegpt_data[self.user_id]
+                user_config,
+                self.store,
+                self.metrics,
+                self.use_sharegpt,
+                self.sharegpt_data[self.user_id],
             )
         else:
-            user_session = UserSession(user_config, self.use_sharegpt)
+            user_session = UserSession(
+                user_config, self.store, self.metrics, self.use_sharegpt
+            )
         self.sessions.append(user_session)
         return user_session
 
@@ -495,78 +599,53 @@ class UserSessionManager:
                 f"Removing {len(sessions_to_remove)} finished sessions, now "
                 f"active users: {len(self.sessions) - len(sessions_to_remove)}"
             )
-            for session in sessions_to_remove:
-                self.session_summaries.append(session.summary())
         self.sessions = [s for s in self.sessions if not s.finished]
 
-    def step(self, timestamp: float, executor: RequestExecutor):
+    def start(self, timestamp: float):
+        self.start_time = timestamp
+        self.metrics.start(timestamp)
         if self.need_ramp_up:
             self._ramp_up(timestamp, self.ramp_up_time)
 
-        if self.start_time is None:
-            self.start_time = timestamp
-        
-        # New user session only joins when meets time interval and active user count is less than configured
-        if timestamp - self.last_user_join > self.gap_between_users and len(self.sessions) < self.workload_config.num_users:
-            new_session = self._create_user_session()
-            if new_session is not None:
-                self.last_user_join = timestamp
-                logger.info(
-                    f"Joined a new user {self.user_id}, "
-                    f"now active users: {len(self.sessions)}"
-                )
-
-        for session in self.sessions:
-            session.step(timestamp, executor)
+    def join_new_user(self, timestamp: float) -> Optional[UserSession]:
+        # New user session only joins when active user count is less than configured
+        if len(self.sessions) >= self.max_users:
+            return None
+        new_session = self._create_user_session()
+        self.last_user_join = timestamp
+        logger.info(
+            f"Joined a new user {self.user_id}, "
+            f"now active users: {len(self.sessions)}"
+        )
+        return new_session
 
+    def finish_session(self, session: UserSession):
+        session.finished = True
         self._remove_finished_sessions()
 
     @staticmethod
-    def ProcessSummary(
-        df: pd.DataFrame,
-        start_time: Optional[float] = None,
-        end_time: Optional[float] = None,
-        pending_queries: int = 0,
-        qps: Optional[int] = None,
-    ):
-        if start_time and end_time:
-            launched_queries = len(
-                df.query(f"{start_time} <= launch_time <= {end_time}")
-            )
-            df = df.query(f"{start_time} <= finish_time <= {end_time}")
-        else:
-            launched_queries = len(df)
-
-        logger.debug(
-            f"Launched queries: {launched_queries}, "
-            f"pending queries: {pending_queries}, "
-            f"finished queries: {len(df)}"
-        )
-
+    def PrintSummary(summary: dict, qps: Optional[float] = None):
+        """
+        Print a performance summary block, from the fields computed by
+        ProcessSummary or by WindowedMetrics.take_window
+        """
         if qps is None:
             qps = 0.0
-
-        if start_time is None:
-            start_time = df["launch_time"].min()
-        if end_time is None:
-            end_time = df["finish_time"].max()
+        start_time = summary["start_time"]
+        end_time = summary["end_time"]
         total_time = end_time - start_time
 
-        total_requests = launched_queries + pending_queries
-        _qps = total_requests / total_time
-
-        total_finished_requests = len(df)
-        finished_qps = total_finished_requests / total_time
+        logger.debug(
+            f"Launched queries: {summary['launched_queries']}, "
+            f"pending queries: {summary['pending_queries']}, "
+            f"finished queries: {summary['finished_queries']}"
+        )
 
-        total_prompt_tokens = df["prompt_tokens"].sum()
-        total_generation_tokens = df["generation_tokens"].sum()
-        average_prefill_speed = total_prompt_tokens / total_time
-        average_generation_speed = total_generation_tokens / total_time
-        average_generation_speed_per_request = (
-            df["generation_tokens"] / df["generation_time"]
-        ).mean()
-        average_ttft = df["ttft"].mean()
-        logger.info("Calculating performance summary")
+        finished_qps = summary["finished_queries"] / total_time
+        average_prefill_speed = summary["prompt_tokens"] / total_time
+        average_generation_speed = summary["generation_tokens"] / total_time
+        average_generation_speed_per_request = summary["average_generation_speed_per_request"]
+        average_ttft = summary["average_ttft"]
         print("\n")
         print("==================== Performance summary ======================")
         print(f"  \033[33mQPS: \033[32m{qps:.4f} reqs/s\033[0m\n")
@@ -576,7 +655,10 @@ class UserSessionManager:
             f"\033[32m{finished_qps:.4f} reqs/s\033[0m\n"
         )
 
-        print(f"  \033[33mRequests on-the-fly: {pending_queries}\033[0m\n")
+        print(f"  \033[33mRequests on-the-fly: {summary['pending_queries']}\033[0m\n")
+
+        if summary.get("failed_queries"):
+            print(f"  \033[33mFailed requests: \033[31m{summary['failed_queries']}\033[0m\n")
 
         print(
             "  \033[33mInput tokens per second: "
@@ -596,30 +678,242 @@ class UserSessionManager:
 
         print(f"  \033[33mAverage TTFT: \033[32m{average_ttft:.4f}s\033[0m\n")
 
+        if summary.get("launch_skew") is not None:
+            launch_skew = ", ".join(
+                f"{name} {value * 1000:.2f}ms" for name, value in summary["launch_skew"].items()
+            )
+            print(
+                "  \033[33mLaunch skew (actual - scheduled): "
+                f"\033[32m{launch_skew}\033[0m\n"
+            )
+
+        if summary.get("sketches") is not None:
+            print_latency_summary(summary["sketches"])
+
+        if summary.get("chunk_times") is not None:
+            print_chunk_time_summary(summary["chunk_times"], distributions=False)
+
         print(f"Time range: {start_time} - {end_time} ({total_time:.2f}s)")
 
         print("===============================================================")
         print("\n")
-        return df
+
+    @staticmethod
+    def ProcessSummary(
+        df: pd.DataFrame,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+        pending_queries: int = 0,
+        qps: Optional[int] = None,
+        sketches: Optional[LatencySketches] = None,
+    ):
+        """
+        sketches: latency sketches of the requests, computed from df when
+        not given
+        """
+        if start_time and end_time:
+            launched_queries = int(
+                ((df["launch_time"] >= start_time) & (df["launch_time"] <= end_time)).sum()
+            )
+            df = df[(df["finish_time"] >= start_time) & (df["finish_time"] <= end_time)]
+        else:
+            launched_queries = len(df)
+
+        if start_time is None:
+            start_time = df["launch_time"].min()
+        if end_time is None:
+            end_time = df["finish_time"].max()
+
+        # Failed requests are in the CSV, not in the performance figures
+        failed = (
+            df["error"].astype(bool) if "error" in df.columns
+            else pd.Series(False, index=df.index)
+        )
+        records, df = df, df[~failed]
+
+        logger.info("Calculating performance summary")
+        summary = {
+            "start_time": start_time,
+            "end_time": end_time,
+            "launched_queries": launched_queries,
+            "finished_queries": len(df),
+            "failed_queries": int(failed.sum()),
+            "pending_queries": pending_queries,
+            "prompt_tokens": df["prompt_tokens"].sum(),
+            "generation_tokens": df["generation_tokens"].sum(),
+            "average_ttft": df["ttft"].mean(),
+            "average_generation_speed_per_request": (
+                df["generation_tokens"] / df["generation_time"]
+            ).mean(),
+            "launch_skew": None,
+            "sketches": sketches if sketches is not None else LatencySketches.from_frame(df),
+            "chunk_times": df["chunk_times"] if "chunk_times" in df.columns else None,
+        }
+        if "scheduled_time" in df.columns and len(df) > 0:
+            launch_skew = df["launch_time"] - df["scheduled_time"]
+            summary["launch_skew"] = {
+                "p50": launch_skew.quantile(0.5),
+                "p99": launch_skew.quantile(0.99),
+                "max": launch_skew.max(),
+            }
+        UserSessionManager.PrintSummary(summary, qps)
+        return records
+
+    def results(self) -> pd.DataFrame:
+        """Per-request results of all the finished and active sessions"""
+        return self.store.frame()
+
+    def log_window(self, timestamp: float):
+        """Print the summary of the requests finished since the previous call"""
+        window = self.metrics.take_window(timestamp)
+        if window is not None:
+            UserSessionManager.PrintSummary(window, self.qps)
 
     def summary(self, start_time: float, end_time: float) -> pd.DataFrame:
-        if len(self.session_summaries) == 0 and len(self.sessions) == 0:
+        """Summary computed from the full history of the run"""
+        if len(self.store) == 0:
             return pd.DataFrame()
 
-        df = pd.concat(
-            [s for s in self.session_summaries] + [s.summary() for s in self.sessions]
-        )
-        pending_queries = len([s for s in self.sessions if s.has_unfinished_request])
+        df = self.results()
+        pending_queries = self.metrics.in_flight
         start_time = max(self.start_time, start_time)
         end_time = min(end_time, df["finish_time"].max())
-        qps = self.workload_config.qps
+        qps = self.qps
 
         df = UserSessionManager.ProcessSummary(
-            df, start_time, end_time, pending_queries, qps
+            df, start_time, end_time, pending_queries, qps, self.metrics.sketches
         )
         return df
 
 
+class SessionScheduler:
+    """
+    Event-driven driver of a UserSessionManager.
+
+    All the pending launches (one per session, plus the next user join) are
+    kept in a heap keyed on their target time. A single timer on the executor's
+    event loop is armed for the earliest entry, so each request goes out at
+    its target instant and a wakeup only touches the sessions that are due.
+    """
+
+    def __init__(self, manager: UserSessionManager, executor: RequestExecutor):
+        self.manager = manager
+        self.executor = executor
+        self.loop = executor.loop
+
+        # (due time, tie breaker, session or None for a user join)
+        self.heap = []
+        self.counter = itertools.count()
+        self.timer = None
+        self.timer_due = None
+
+        self.join_pending = False
+        self.stopped = False
+        self.last_overdue_log = 0
+
+    def _run_in_loop(self, func, *args):
+        async def _call():
+            func(*args)
+
+        asyncio.run_coroutine_threadsafe(_call(), self.loop).result()
+
+    def start(self, timestamp: float):
+        self._run_in_loop(self._start, timestamp)
+
+    def stop(self):
+        """Stop launching new requests; in-flight ones keep running"""
+        self._run_in_loop(self._stop)
+
+    def _start(self, timestamp: float):
+        self.manager.start(timestamp)
+        for session in list(self.manager.sessions):
+            self._schedule(session, timestamp)
+        self._push(timestamp + self.manager.first_join_delay, None)
+        self._arm()
+
+    def _stop(self):
+        self.stopped = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _push(self, due: float, session: Optional[UserSession]):
+        heapq.heappush(self.heap, (due, next(self.counter), session))
+
+    def _schedule(self, session: UserSession, now: float):
+        session.finish_listener = self._on_request_finished
+        if session.is_done():
+            self._finish(session)
+            return
+        due = session.next_request_time()
+        self._push(now if due is None else due, session)
+
+    def _arm(self):
+        if self.stopped or len(self.heap) == 0:
+            return
+        due = self.heap[0][0]
+        if self.timer is not None:
+            if self.timer_due <= due:
+                return
+            self.timer.cancel()
+        self.timer_due = due
+        self.timer = self.loop.call_later(max(0.0, due - time.time()), self._on_timer)
+
+    def _on_timer(self):
+        self.timer = None
+        now = time.time()
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            due, _, session = heapq.heappop(self.heap)
+            if session is None:
+                self._join(due)
+            else:
+                self._on_session_due(session, due)
+        self._arm()
+
+    def _join(self, timestamp: float):
+        session = self.manager.join_new_user(timestamp)
+        if session is None:
+            # Retried as soon as an active session finishes
+            self.join_pending = True
+            return
+        self.join_pending = False
+        self._schedule(session, timestamp)
+        self._push(timestamp + self.manager.join_interval, None)
+
+    def _on_session_due(self, session: UserSession, due: float):
+        if session.has_unfinished_request:
+            session.overdue_time = due
+            if due - self.last_overdue_log > 10:
+                logger.warning(
+                    f"User {session.user_config.user_id} has an unfinished "
+                    "request and unable to fit the QPS requirement."
+                )
+                self.last_overdue_log = due
+            return
+        self._launch(session, due, due)
+
+    def _launch(self, session: UserSession, timestamp: float, scheduled_time: float):
+        session._launch_new_request(timestamp, self.executor, scheduled_time)
+        if not session.is_done():
+            self._push(session.next_request_time(), session)
+
+    def _on_request_finished(self, session: UserSession):
+        if self.stopped:
+            return
+        now = time.time()
+        if session.overdue_time is not None:
+            scheduled_time, session.overdue_time = session.overdue_time, None
+            self._launch(session, now, scheduled_time)
+        elif session.is_done():
+            self._finish(session)
+        self._arm()
+
+    def _finish(self, session: UserSession):
+        self.manager.finish_session(session)
+        if self.join_pending:
+            self._join(time.time())
+
+
 def warmup_engine(executor):
     logger.info("Warming up the engine")
     for i in range(10):
@@ -704,6 +998,35 @@ def parse_arguments() -> WorkloadConfig:
     parser.add_argument(
         "--sharegpt", action="store_true", help="Whether to use ShareGPT dataset"
     )
+    add_transport_arguments(parser)
+    add_token_prompt_arguments(parser)
+    add_metrics_arguments(parser)
+    add_record_stream_arguments(parser)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of load generator processes the users are sharded across",
+    )
+    parser.add_argument(
+        "--num-shards",
+        type=int,
+        default=1,
+        help="Number of load generator hosts the users are sharded across",
+    )
+    parser.add_argument(
+        "--shard-index",
+        type=int,
+        default=0,
+        help="Index of this host's shard, in [0, num-shards)",
+    )
+    parser.add_argument(
+        "--start-at",
+        type=float,
+        default=None,
+        help="Wall-clock time (epoch seconds) to start the benchmark at, "
+        "after the warm-up. Used to synchronize several hosts",
+    )
     args = parser.parse_args()
     return args
 
@@ -727,21 +1050,8 @@ def process_output(filename):
     UserSessionManager.ProcessSummary(pd.read_csv(filename), pending_queries=0)
 
 
-def main():
-    args = parse_process_summary()
-    if args.process_summary:
-        process_output(args.process_summary)
-        return
-
-    args = parse_arguments()
-    step_interval = 0.1
-
-    executor = RequestExecutor(
-        base_url=args.base_url, model=args.model
-    )
-
-    warmup_engine(executor)
-    workload_config = WorkloadConfig(
+def build_workload_config(args) -> WorkloadConfig:
+    return WorkloadConfig(
         num_users=args.num_users,
         system_prompt_len=args.shared_system_prompt,
         user_info_len=args.user_history_prompt,
@@ -752,34 +1062,215 @@ def main():
         enable_user_id=args.request_with_user_id,
     )
 
-    manager = UserSessionManager(
-        workload_config, init_user_id=args.init_user_id, use_sharegpt=args.sharegpt
-    )
 
-    num_steps = 0
-    start_time = time.time()
+def wait_for_start(start_at: Optional[float]) -> float:
+    """Sleep until the synchronized start time, if any, and return the start time"""
+    if start_at is None:
+        return time.time()
+    delay = start_at - time.time()
+    if delay < 0:
+        logger.warning(f"Missed the synchronized start by {-delay:.2f} secs")
+        return time.time()
+    logger.info(f"Waiting {delay:.2f} secs for the synchronized start")
+    time.sleep(delay)
+    return start_at
+
+
+def run_benchmark(
+    args,
+    manager: UserSessionManager,
+    executor: RequestExecutor,
+    start_time: float,
+    worker_index: int = 0,
+):
+    """
+    Drive the sessions until the time limit, logging periodic summaries.
+    With --metrics-port, worker worker_index serves its metrics on
+    metrics_port + worker_index
+    """
+    live = start_live_metrics(args, executor.loop, manager.qps, port_offset=worker_index)
+    if live is not None:
+        live.active_sessions = lambda: len(manager.sessions)
+        manager.metrics.live = live
+        logger.info(f"Serving metrics on port {args.metrics_port + worker_index}")
+    scheduler = SessionScheduler(manager, executor)
+    scheduler.start(start_time)
     last_summary_time = start_time
     try:
         while True:
-            num_steps += 1
-            manager.step(time.time(), executor)
-            time.sleep(step_interval)
+            next_wakeup = last_summary_time + args.log_interval
+            if args.time is not None:
+                next_wakeup = min(next_wakeup, start_time + args.time)
+            time.sleep(max(0.0, next_wakeup - time.time()))
 
-            if time.time() - last_summary_time > args.log_interval:
-                manager.summary(last_summary_time, time.time())
+            if time.time() - last_summary_time >= args.log_interval:
                 last_summary_time = time.time()
+                manager.log_window(last_summary_time)
 
-            if args.time is not None and time.time() - start_time > args.time:
+            if args.time is not None and time.time() - start_time >= args.time:
                 break
 
     except KeyboardInterrupt:
         logger.info("Interrupted, waiting for the final result")
 
+    scheduler.stop()
     AsyncLoopWrapper.StopLoop()
 
-    logger.info(f"Finished benchmarking, dumping summary to {args.output}")
+
+def run_worker(args, shard_index, num_shards, ready_queue, start_event, start_at, result_queue):
+    """
+    Entry point of one load generator process in --workers mode. With
+    --num-shards, each host's workers split that host's shard further
+    """
+    executor = RequestExecutor(
+        base_url=args.base_url,
+        model=args.model,
+        transport_args=args,
+        token_prompts=build_token_prompts(args),
+    )
+    records_spool = None
+    if args.stream_records:
+        # run_sharded already wrote the header
+        records_spool = RecordSpool(records_path(args.output), RESULT_COLUMNS, append=True)
+    manager = UserSessionManager(
+        build_workload_config(args),
+        init_user_id=args.init_user_id,
+        use_sharegpt=args.sharegpt,
+        shard_index=shard_index,
+        num_shards=num_shards,
+        records_spool=records_spool,
+    )
+    ready_queue.put(shard_index)
+    start_event.wait()
+    start_time = start_at.value
+    time.sleep(max(0.0, start_time - time.time()))
+    logger.info(f"Worker {shard_index}/{num_shards} started with {manager.max_users} users")
+
+    run_benchmark(
+        args, manager, executor, start_time, shard_index - args.shard_index * args.workers
+    )
+    result_queue.put((shard_index, manager.results(), manager.metrics.sketches.to_dict()))
+
+
+def run_sharded(args, executor: RequestExecutor):
+    """
+    Shard the users across args.workers processes and merge their results
+    and latency sketches
+    """
+    num_shards = args.num_shards * args.workers
+    if args.stream_records:
+        # The workers append to one spool, which only gets the header here
+        RecordSpool(records_path(args.output), RESULT_COLUMNS).close()
+    context = multiprocessing.get_context("spawn")
+    ready_queue = context.Queue()
+    result_queue = context.Queue()
+    start_event = context.Event()
+    start_at = context.Value("d", 0.0)
+    workers = [
+        context.Process(
+            target=run_worker,
+            args=(
+                args,
+                args.shard_index * args.workers + i,
+                num_shards,
+                ready_queue,
+                start_event,
+                start_at,
+                result_queue,
+            ),
+        )
+        for i in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    warmup_engine(executor)
+    AsyncLoopWrapper.StopLoop()
+
+    for _ in workers:
+        ready_queue.get()
+    if args.start_at is not None:
+        start_at.value = wait_for_start(args.start_at)
+    else:
+        # Leave the workers a moment to get from the event to their loops
+        start_at.value = time.time() + 0.5
+    start_event.set()
+    logger.info(f"Started {args.workers} workers")
+
+    results = []
+    while len(results) < len(workers):
+        try:
+            results.append(result_queue.get(timeout=1))
+        except queue.Empty:
+            failed = [w for w in workers if not w.is_alive() and w.exitcode != 0]
+            if len(failed) > 0:
+                raise RuntimeError(f"{len(failed)} workers exited without results")
+        except KeyboardInterrupt:
+            logger.info("Interrupted, waiting for the workers' results")
+    for worker in workers:
+        worker.join()
+
+    results = sorted(results, key=lambda r: r[0])
+    df = pd.concat([df for _, df, _ in results])
+    df = df.sort_values("launch_time").reset_index(drop=True)
+    sketches = LatencySketches()
+    for _, _, worker_sketches in results:
+        sketches.merge(LatencySketches.from_dict(worker_sketches))
+    if len(df) == 0:
+        return df, sketches
+    num_users = sum(
+        shard_num_users(args.num_users, i, num_shards)
+        for i in range(args.shard_index * args.workers, (args.shard_index + 1) * args.workers)
+    )
+    qps = args.qps * num_users / args.num_users
+    df = UserSessionManager.ProcessSummary(
+        df, start_at.value, min(time.time(), df["finish_time"].max()), 0, qps, sketches
+    )
+    return df, sketches
+
+
+def save_results(summary: pd.DataFrame, sketches: LatencySketches, output: str):
+    logger.info(f"Finished benchmarking, dumping summary to {output}")
+    summary.to_csv(output, index=False)
+    sketches.save(sketch_path(output))
+
+
+def main():
+    args = parse_process_summary()
+    if args.process_summary:
+        process_output(args.process_summary)
+        return
+
+    args = parse_arguments()
+
+    executor = RequestExecutor(
+        base_url=args.base_url,
+        model=args.model,
+        transport_args=args,
+        token_prompts=build_token_prompts(args),
+    )
+
+    if args.workers > 1:
+        summary, sketches = run_sharded(args, executor)
+        save_results(summary, sketches, args.output)
+        return
+
+    warmup_engine(executor)
+    records_spool = None
+    if args.stream_records:
+        records_spool = RecordSpool(records_path(args.output), RESULT_COLUMNS)
+    manager = UserSessionManager(
+        build_workload_config(args),
+        init_user_id=args.init_user_id,
+        use_sharegpt=args.sharegpt,
+        shard_index=args.shard_index,
+        num_shards=args.num_shards,
+        records_spool=records_spool,
+    )
+    run_benchmark(args, manager, executor, wait_for_start(args.start_at))
+
     summary = manager.summary(0, time.time())
-    summary.to_csv(args.output, index=False)
+    save_results(summary, manager.metrics.sketches, args.output)
 
 
 if __name__ == "__main__":
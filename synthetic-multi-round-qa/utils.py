@@ -1,7 +1,19 @@
 import asyncio
+import bisect
+import csv
+import hashlib
+import json
 import logging
+import math
+import os
+import re
 import threading
+import time
+from collections import OrderedDict
 from logging import Logger
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
 
 
 def build_format(color):
@@ -118,3 +130,1145 @@ class AsyncLoopWrapper:
         if cls._loop is None:
             cls.StartLoop()
         return cls._loop
+
+
+class ResultStore:
+    """
+    Growable columnar store of per-request results, shared by all the
+    sessions of a run. Every column is a NumPy array that doubles in size
+    when full, and frame() views the filled rows without copying them.
+    """
+
+    def __init__(self, columns: Dict[str, type], capacity: int = 1024,
+                 spool: Optional["RecordSpool"] = None):
+        """
+        columns: column name -> NumPy dtype (object for strings)
+        capacity: rows to preallocate
+        spool: also written every row as it is appended
+        """
+        self._arrays = {
+            name: np.empty(max(capacity, 1), dtype=dtype) for name, dtype in columns.items()
+        }
+        self._size = 0
+        self._spool = spool
+        # Rows are appended on the event loop thread while the summaries
+        # read them from the main thread
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _grow(self):
+        for name, array in self._arrays.items():
+            grown = np.empty(2 * len(array), dtype=array.dtype)
+            grown[: len(array)] = array
+            self._arrays[name] = grown
+
+    def append(self, **row):
+        """Append one row, with a value for every column"""
+        with self._lock:
+            if self._size == len(next(iter(self._arrays.values()))):
+                self._grow()
+            for name, array in self._arrays.items():
+                array[self._size] = row[name]
+            self._size += 1
+            if self._spool is not None:
+                self._spool.write(row)
+
+    def columns(self) -> Dict[str, np.ndarray]:
+        """Views of the filled part of every column"""
+        with self._lock:
+            return {name: array[: self._size] for name, array in self._arrays.items()}
+
+    def frame(self):
+        """DataFrame over the stored rows, sharing the column arrays"""
+        import pandas as pd
+
+        return pd.DataFrame(self.columns(), copy=False)
+
+
+class RecordSpool:
+    """
+    CSV file every per-request record is appended to as soon as it is stored,
+    so the records of a running benchmark can be streamed (see
+    distributed/agent.py) and those of a crashed or interrupted run are kept.
+    Several processes can append to one spool: only the one opening it with
+    append=False writes the header, and every row is flushed in one write.
+    """
+
+    def __init__(self, path: str, columns: Iterable[str], append: bool = False):
+        self.columns = list(columns)
+        self._file = open(path, "a" if append else "w", newline="")
+        self._writer = csv.writer(self._file)
+        self._lock = threading.Lock()
+        if not append:
+            self._writer.writerow(self.columns)
+            self._file.flush()
+
+    def write(self, row: dict):
+        with self._lock:
+            self._writer.writerow([row[name] for name in self.columns])
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def records_path(output: str) -> str:
+    """Path of the records streamed next to a benchmark output CSV"""
+    root, _ = os.path.splitext(output)
+    return root + ".records.csv"
+
+
+def add_record_stream_arguments(parser):
+    parser.add_argument(
+        "--stream-records",
+        action="store_true",
+        help="Also append the record of every finished request to "
+        "<output>.records.csv as it finishes",
+    )
+
+
+class LatencySketch:
+    """
+    Mergeable quantile sketch of latencies in seconds. Values are counted in
+    log-spaced buckets (as in DDSketch), so every quantile is within
+    relative_accuracy of the exact one, the size only grows with the range
+    of the values, and merging two sketches adds their bucket counts, which
+    is exact and order-independent.
+    """
+
+    # Values below this many seconds are counted as zero
+    MIN_VALUE = 1e-9
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.buckets: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value: float):
+        if value <= self.MIN_VALUE:
+            self.zero_count += 1
+        else:
+            index = math.ceil(math.log(value) / self._log_gamma)
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "LatencySketch"):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different relative accuracies")
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return max(self.min, 0.0)
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if rank < seen:
+                value = 2 * self._gamma ** index / (self._gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "buckets": {str(index): count for index, count in self.buckets.items()},
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "min": self.min if self.count > 0 else None,
+            "max": self.max if self.count > 0 else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LatencySketch":
+        sketch = cls(data["relative_accuracy"])
+        sketch.buckets = {int(index): count for index, count in data["buckets"].items()}
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        if sketch.count > 0:
+            sketch.min = data["min"]
+            sketch.max = data["max"]
+        return sketch
+
+
+class LatencySketches:
+    """
+    One LatencySketch per latency metric of a benchmark: TTFT, TPOT and
+    end-to-end latency per request, and ITL per chunk
+    """
+
+    METRICS = ("ttft", "tpot", "itl", "e2e")
+
+    def __init__(self):
+        self.sketches = {name: LatencySketch() for name in self.METRICS}
+
+    def __getitem__(self, name: str) -> LatencySketch:
+        return self.sketches[name]
+
+    def add_request(
+        self,
+        ttft: float,
+        e2e_latency: float,
+        generation_tokens: int,
+        generation_time: float,
+        chunk_times: str = "",
+    ):
+        self.add_decoded_request(
+            ttft, e2e_latency, generation_tokens, generation_time,
+            *decode_chunk_times(chunk_times),
+        )
+
+    def add_decoded_request(
+        self,
+        ttft: float,
+        e2e_latency: float,
+        generation_tokens: int,
+        generation_time: float,
+        deltas: List[float],
+        tokens: List[int],
+    ):
+        """add_request with the chunk times already decoded"""
+        self.sketches["ttft"].add(ttft)
+        self.sketches["e2e"].add(e2e_latency)
+        for itl in deltas[1:]:
+            self.sketches["itl"].add(itl)
+        if sum(tokens[1:]) > 0:
+            self.sketches["tpot"].add(sum(deltas[1:]) / sum(tokens[1:]))
+        elif len(deltas) == 0 and generation_tokens > 1 and generation_time > 0:
+            # No chunk times recorded
+            self.sketches["tpot"].add(generation_time / (generation_tokens - 1))
+
+    @classmethod
+    def from_frame(cls, df) -> "LatencySketches":
+        """
+        Sketches of the per-request results of a benchmark output DataFrame.
+        Failed requests (flagged in an "error" column) have no latencies and
+        are skipped.
+        """
+        sketches = cls()
+        if "error" in df.columns:
+            df = df[~df["error"].astype(bool)]
+        if "chunk_times" in df.columns:
+            chunk_times = df["chunk_times"]
+        else:
+            chunk_times = [""] * len(df)
+        for ttft, launch_time, finish_time, generation_tokens, generation_time, chunks in zip(
+            df["ttft"], df["launch_time"], df["finish_time"],
+            df["generation_tokens"], df["generation_time"], chunk_times,
+        ):
+            sketches.add_request(
+                ttft, finish_time - launch_time, generation_tokens, generation_time, chunks
+            )
+        return sketches
+
+    def merge(self, other: "LatencySketches"):
+        for name in self.METRICS:
+            self.sketches[name].merge(other.sketches[name])
+
+    def to_dict(self) -> dict:
+        return {name: sketch.to_dict() for name, sketch in self.sketches.items()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LatencySketches":
+        sketches = cls()
+        for name in cls.METRICS:
+            sketches.sketches[name] = LatencySketch.from_dict(data[name])
+        return sketches
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path: str) -> "LatencySketches":
+        with open(path, "r") as f:
+            return cls.from_dict(json.load(f))
+
+
+def sketch_path(output: str) -> str:
+    """Path of the latency sketches saved next to a benchmark output CSV"""
+    root, _ = os.path.splitext(output)
+    return root + ".sketch.json"
+
+
+def print_latency_summary(sketches: LatencySketches):
+    """Print the latency percentile lines of a performance summary block"""
+    names = {"ttft": "TTFT", "tpot": "TPOT", "itl": "ITL", "e2e": "E2E latency"}
+    for name in LatencySketches.METRICS:
+        sketch = sketches[name]
+        if sketch.count == 0:
+            continue
+        percentiles = ", ".join(
+            f"p{round(q * 100)} {sketch.quantile(q) * 1000:.2f}ms"
+            for q in (0.5, 0.9, 0.95, 0.99)
+        )
+        print(f"  \033[33m{names[name]}: \033[32m{percentiles}\033[0m\n")
+
+
+class WindowedMetrics:
+    """
+    Running counters of the launched and finished requests, updated in O(1)
+    per request, that feed the periodic performance summaries without going
+    back over the results of the whole run. take_window() returns the
+    counters of the requests that finished since the previous call and
+    starts a new window. Latency sketches are kept for the window and for
+    the whole run.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.sketches = LatencySketches()
+        self._window_start = None
+        self._reset()
+        # Forwarded the launches and finishes when the metrics are exported
+        self.live: Optional[LiveMetrics] = None
+
+    def _reset(self):
+        self._launched = 0
+        self._finished = 0
+        self._prompt_tokens = 0
+        self._generation_tokens = 0
+        self._ttft_sum = 0.0
+        self._speed_sum = 0.0
+        self._speed_count = 0
+        self._skew_sum = 0.0
+        self._skew_max = None
+        self._skew_count = 0
+        self._sketches = LatencySketches()
+
+    def start(self, timestamp: float):
+        with self._lock:
+            self._window_start = timestamp
+
+    def on_launch(self):
+        if self.live is not None:
+            self.live.on_launch()
+        with self._lock:
+            self._launched += 1
+            self.in_flight += 1
+
+    def on_finish(
+        self,
+        prompt_tokens: int,
+        generation_tokens: int,
+        ttft: float,
+        generation_time: float,
+        e2e_latency: float,
+        chunk_times: str = "",
+        launch_skew: Optional[float] = None,
+    ):
+        """launch_skew: actual - scheduled launch time, when there is a schedule"""
+        if self.live is not None:
+            self.live.on_finish(ttft, e2e_latency, chunk_times)
+        request = (ttft, e2e_latency, generation_tokens, generation_time,
+                   *decode_chunk_times(chunk_times))
+        with self._lock:
+            self._sketches.add_decoded_request(*request)
+            self.sketches.add_decoded_request(*request)
+            self.in_flight -= 1
+            self._finished += 1
+            self._prompt_tokens += prompt_tokens
+            self._generation_tokens += generation_tokens
+            self._ttft_sum += ttft
+            if generation_time > 0:
+                self._speed_sum += generation_tokens / generation_time
+                self._speed_count += 1
+            if launch_skew is not None:
+                self._skew_sum += launch_skew
+                self._skew_count += 1
+                if self._skew_max is None or launch_skew > self._skew_max:
+                    self._skew_max = launch_skew
+
+    def on_error(self):
+        """A launched request failed: it leaves the in-flight count, with no latency"""
+        if self.live is not None:
+            self.live.on_error()
+        with self._lock:
+            self.in_flight -= 1
+
+    def take_window(self, timestamp: float) -> Optional[dict]:
+        """Counters since the previous window, None if nothing finished in it"""
+        with self._lock:
+            window = None
+            if self._finished > 0:
+                window = {
+                    "start_time": self._window_start,
+                    "end_time": timestamp,
+                    "launched_queries": self._launched,
+                    "finished_queries": self._finished,
+                    "pending_queries": self.in_flight,
+                    "prompt_tokens": self._prompt_tokens,
+                    "generation_tokens": self._generation_tokens,
+                    "average_ttft": self._ttft_sum / self._finished,
+                    "average_generation_speed_per_request": (
+                        self._speed_sum / self._speed_count if self._speed_count > 0 else 0.0
+                    ),
+                    "launch_skew": None,
+                    "sketches": self._sketches,
+                }
+                if self._skew_count > 0:
+                    window["launch_skew"] = {
+                        "mean": self._skew_sum / self._skew_count,
+                        "max": self._skew_max,
+                    }
+            self._window_start = timestamp
+            self._reset()
+            return window
+
+
+class LiveMetrics:
+    """
+    Counters and histograms of a running benchmark, exposed in the
+    OpenMetrics text format by serve_metrics(). They are updated without
+    locks: every field has a single writer (launches are counted by the
+    thread that dispatches requests, finishes by the event loop thread), and
+    a scrape only reads them.
+    """
+
+    TTFT_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    ITL_BUCKETS = (0.005, 0.01, 0.02, 0.04, 0.08, 0.16, 0.32, 0.64, 1.28)
+    LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+    def __init__(self, target_qps: Optional[float] = None):
+        self.target_qps = target_qps
+        self.start_time = time.time()
+        self.launched = 0
+        self.finished = 0
+        self.failed = 0
+        # Callable[[], int] returning the number of active sessions
+        self.active_sessions = None
+        self.ttft = self._new_histogram(self.TTFT_BUCKETS)
+        self.itl = self._new_histogram(self.ITL_BUCKETS)
+        self.e2e_sum = 0.0
+        self.loop_lag = self._new_histogram(self.LOOP_LAG_BUCKETS)
+        self.loop_lag_last = 0.0
+
+    @staticmethod
+    def _new_histogram(bounds: Tuple[float, ...]) -> dict:
+        # Per-bucket (non-cumulative) counts, the last bucket is +Inf
+        return {"bounds": bounds, "counts": [0] * (len(bounds) + 1), "sum": 0.0}
+
+    @staticmethod
+    def _observe(histogram: dict, value: float):
+        index = bisect.bisect_left(histogram["bounds"], value)
+        histogram["counts"][index] += 1
+        histogram["sum"] += value
+
+    def on_launch(self):
+        self.launched += 1
+
+    def on_finish(self, ttft: float, e2e_latency: float, chunk_times: str = ""):
+        self._observe(self.ttft, ttft)
+        deltas, _ = decode_chunk_times(chunk_times)
+        for itl in deltas[1:]:
+            self._observe(self.itl, itl)
+        self.e2e_sum += e2e_latency
+        self.finished += 1
+
+    def on_error(self):
+        self.failed += 1
+
+    def start_loop_lag_probe(self, loop: asyncio.AbstractEventLoop, interval: float = 0.1):
+        """Measure how late a timer of the event loop fires, every interval"""
+
+        def probe(expected: float):
+            now = time.perf_counter()
+            self.loop_lag_last = max(now - expected, 0.0)
+            self._observe(self.loop_lag, self.loop_lag_last)
+            loop.call_later(interval, probe, now + interval)
+
+        loop.call_soon_threadsafe(
+            lambda: loop.call_later(interval, probe, time.perf_counter() + interval)
+        )
+
+    @staticmethod
+    def _render_histogram(lines: List[str], name: str, help_text: str, histogram: dict):
+        lines.append(f"# TYPE {name} histogram")
+        lines.append(f"# UNIT {name} seconds")
+        lines.append(f"# HELP {name} {help_text}")
+        cumulative = 0
+        counts = list(histogram["counts"])
+        for bound, count in zip(histogram["bounds"], counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{name}_count {cumulative}")
+        lines.append(f"{name}_sum {histogram['sum']}")
+
+    def render(self) -> str:
+        launched, finished, failed = self.launched, self.finished, self.failed
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        lines = [
+            "# TYPE lmbench_requests_launched counter",
+            "# HELP lmbench_requests_launched Requests sent to the serving engine.",
+            f"lmbench_requests_launched_total {launched}",
+            "# TYPE lmbench_requests_finished counter",
+            "# HELP lmbench_requests_finished Requests whose response completed.",
+            f"lmbench_requests_finished_total {finished}",
+            "# TYPE lmbench_requests_failed counter",
+            "# HELP lmbench_requests_failed Requests that ended with an error.",
+            f"lmbench_requests_failed_total {failed}",
+            "# TYPE lmbench_requests_in_flight gauge",
+            "# HELP lmbench_requests_in_flight Requests sent and not completed yet.",
+            f"lmbench_requests_in_flight {max(launched - finished - failed, 0)}",
+            "# TYPE lmbench_achieved_qps gauge",
+            "# HELP lmbench_achieved_qps Requests launched per second since the start.",
+            f"lmbench_achieved_qps {launched / elapsed}",
+        ]
+        if self.target_qps is not None:
+            lines += [
+                "# TYPE lmbench_target_qps gauge",
+                "# HELP lmbench_target_qps Configured request rate.",
+                f"lmbench_target_qps {self.target_qps}",
+            ]
+        if self.active_sessions is not None:
+            lines += [
+                "# TYPE lmbench_active_sessions gauge",
+                "# HELP lmbench_active_sessions User sessions currently running.",
+                f"lmbench_active_sessions {self.active_sessions()}",
+            ]
+        self._render_histogram(lines, "lmbench_ttft_seconds", "Time to first token.", self.ttft)
+        self._render_histogram(lines, "lmbench_itl_seconds", "Gap between two streamed chunks.", self.itl)
+        lines += [
+            "# TYPE lmbench_e2e_latency_seconds summary",
+            "# UNIT lmbench_e2e_latency_seconds seconds",
+            "# HELP lmbench_e2e_latency_seconds End-to-end request latency.",
+            f"lmbench_e2e_latency_seconds_count {finished}",
+            f"lmbench_e2e_latency_seconds_sum {self.e2e_sum}",
+            "# TYPE lmbench_event_loop_lag_seconds gauge",
+            "# UNIT lmbench_event_loop_lag_seconds seconds",
+            "# HELP lmbench_event_loop_lag_seconds Delay of the last event loop probe timer.",
+            f"lmbench_event_loop_lag_seconds {self.loop_lag_last}",
+        ]
+        self._render_histogram(
+            lines, "lmbench_event_loop_lag_distribution_seconds",
+            "Delays of the event loop probe timers.", self.loop_lag,
+        )
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+def serve_metrics(live: LiveMetrics, port: int, host: str = "0.0.0.0"):
+    """Serve live.render() at /metrics from a daemon thread"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            data = live.render().encode()
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8"
+            )
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="Serve live OpenMetrics/Prometheus metrics at "
+        "http://<metrics-host>:<metrics-port>/metrics (default: disabled)",
+    )
+    parser.add_argument(
+        "--metrics-host",
+        type=str,
+        default="0.0.0.0",
+        help="Address of the metrics endpoint",
+    )
+
+
+def start_live_metrics(
+    args, loop: asyncio.AbstractEventLoop, target_qps: Optional[float] = None, port_offset: int = 0
+) -> Optional[LiveMetrics]:
+    """
+    Start the metrics endpoint selected by the arguments registered with
+    add_metrics_arguments, None when it is disabled
+    """
+    if args.metrics_port is None:
+        return None
+    live = LiveMetrics(target_qps)
+    live.start_loop_lag_probe(loop)
+    serve_metrics(live, args.metrics_port + port_offset, args.metrics_host)
+    return live
+
+
+def normalize_base_url(base_url: str) -> str:
+    # Ensure base_url ends with /v1
+    if not base_url.endswith("/v1"):
+        base_url = base_url.rstrip("/") + "/v1"
+    return base_url
+
+
+# Ask vLLM to report the cumulative usage on every chunk, which tells how
+# many tokens each chunk carried
+STREAM_OPTIONS = {"include_usage": True}
+
+
+def with_continuous_usage(payload: dict) -> dict:
+    """
+    payload with continuous_usage_stats added to its stream_options, which
+    makes vLLM report the usage with every chunk. Other servers may reject
+    it, so it is only sent with --continuous-usage-stats
+    """
+    if "stream_options" not in payload:
+        return payload
+    return dict(payload, stream_options=dict(payload["stream_options"], continuous_usage_stats=True))
+
+
+class ChunkTimer:
+    """
+    Records when each streamed chunk arrived and how many tokens it carried.
+    The token count of a chunk comes from the cumulative usage reported with
+    --continuous-usage-stats; without it every chunk counts as one token.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.times: List[float] = []
+        self.tokens: List[int] = []
+        self._usage_tokens = 0
+        self._counted_tokens = 0
+
+    def on_chunk(self, text: Optional[str], usage: Optional[Dict[str, int]]):
+        now = time.perf_counter()
+        if usage is not None and usage.get("completion_tokens") is not None:
+            self._usage_tokens = usage["completion_tokens"]
+        else:
+            usage = None
+        if not text:
+            return
+        if usage is not None:
+            tokens = max(self._usage_tokens - self._counted_tokens, 0)
+        else:
+            tokens = 1
+        self._counted_tokens += tokens
+        self.times.append(now)
+        self.tokens.append(tokens)
+
+    def encode(self) -> str:
+        """
+        Space-separated microseconds since the previous chunk (the launch for
+        the first one), with ":<tokens>" appended when a chunk did not carry
+        exactly one token, e.g. "48210 10032 19877:2"
+        """
+        fields = []
+        previous = self.start
+        for timestamp, tokens in zip(self.times, self.tokens):
+            delta = round((timestamp - previous) * 1e6)
+            previous = timestamp
+            fields.append(str(delta) if tokens == 1 else f"{delta}:{tokens}")
+        return " ".join(fields)
+
+
+def decode_chunk_times(encoded) -> Tuple[List[float], List[int]]:
+    """Inverse of ChunkTimer.encode: (seconds since the previous chunk, tokens)"""
+    deltas, tokens = [], []
+    if not isinstance(encoded, str):
+        # Missing values read back from a CSV
+        return deltas, tokens
+    for field in encoded.split():
+        delta, _, count = field.partition(":")
+        deltas.append(int(delta) / 1e6)
+        tokens.append(int(count) if count else 1)
+    return deltas, tokens
+
+
+def chunk_time_stats(encoded_values: Iterable, stall_factor: float = 5.0) -> Optional[dict]:
+    """
+    Inter-token latency distributions from the encoded chunk times of many
+    requests. The ITL is the gap between two consecutive chunks of a request,
+    the TPOT is the decode time of a request divided by its tokens after the
+    first chunk, and a stall is a gap longer than stall_factor times the
+    median ITL.
+    """
+    itls, tpots = [], []
+    num_chunks = num_coalesced = 0
+    for encoded in encoded_values:
+        deltas, tokens = decode_chunk_times(encoded)
+        if len(deltas) == 0:
+            continue
+        num_chunks += len(tokens)
+        num_coalesced += sum(1 for t in tokens if t > 1)
+        itls.extend(deltas[1:])
+        decode_tokens = sum(tokens[1:])
+        if decode_tokens > 0:
+            tpots.append(sum(deltas[1:]) / decode_tokens)
+    if len(itls) == 0:
+        return None
+
+    itls = np.asarray(itls)
+    tpots = np.asarray(tpots)
+    itl_p50 = np.percentile(itls, 50)
+    stalls = itls[itls > stall_factor * itl_p50]
+    return {
+        "itl_p50": itl_p50,
+        "itl_p90": np.percentile(itls, 90),
+        "itl_p99": np.percentile(itls, 99),
+        "itl_p999": np.percentile(itls, 99.9),
+        "itl_max": itls.max(),
+        "tpot_mean": tpots.mean() if len(tpots) > 0 else 0.0,
+        "tpot_p99": np.percentile(tpots, 99) if len(tpots) > 0 else 0.0,
+        "stall_factor": stall_factor,
+        "num_stalls": len(stalls),
+        "stall_share": len(stalls) / len(itls),
+        "stall_time": stalls.sum(),
+        "coalesced_share": num_coalesced / num_chunks,
+    }
+
+
+def print_chunk_time_summary(encoded_values: Iterable, distributions: bool = True):
+    """
+    Print the ITL lines of a performance summary block. Without
+    distributions, only the stall and coalescing lines are printed (when
+    the ITL and TPOT percentiles come from print_latency_summary)
+    """
+    stats = chunk_time_stats(encoded_values)
+    if stats is None:
+        return
+    if distributions:
+        print(
+            "  \033[33mITL (per chunk): "
+            f"\033[32mp50 {stats['itl_p50'] * 1000:.2f}ms, "
+            f"p90 {stats['itl_p90'] * 1000:.2f}ms, "
+            f"p99 {stats['itl_p99'] * 1000:.2f}ms\033[0m\n"
+        )
+        print(
+            "  \033[33mTPOT: "
+            f"\033[32mmean {stats['tpot_mean'] * 1000:.2f}ms, "
+            f"p99 {stats['tpot_p99'] * 1000:.2f}ms\033[0m\n"
+        )
+    print(
+        f"  \033[33mDecode stalls (gap > {stats['stall_factor']:g}x p50 ITL): "
+        f"\033[32m{stats['num_stalls']} ({stats['stall_share'] * 100:.2f}% of gaps, "
+        f"{stats['stall_time']:.2f}s), p99.9 ITL {stats['itl_p999'] * 1000:.2f}ms, "
+        f"max ITL {stats['itl_max'] * 1000:.2f}ms\033[0m\n"
+    )
+    print(
+        "  \033[33mCoalesced chunks (more than one token): "
+        f"\033[32m{stats['coalesced_share'] * 100:.2f}%\033[0m\n"
+    )
+
+
+# (text of the chunk or None, usage dict of the chunk or None)
+StreamChunk = Tuple[Optional[str], Optional[Dict[str, int]]]
+
+
+class OpenAITransport:
+    """Streams completions through the openai SDK client"""
+
+    def __init__(self, base_url: str, continuous_usage_stats: bool = False):
+        import openai
+
+        self.continuous_usage_stats = continuous_usage_stats
+        # For vLLM server, we don't need an API key, but the client requires one
+        self.client = openai.AsyncOpenAI(
+            api_key="EMPTY",  # Dummy API key for vLLM server
+            base_url=normalize_base_url(base_url),
+        )
+
+    @staticmethod
+    def _usage(usage) -> Optional[Dict[str, int]]:
+        if usage is None:
+            return None
+        return {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens,
+        }
+
+    async def stream(
+        self,
+        endpoint: str,
+        payload: dict,
+        extra_headers: Optional[Dict[str, str]] = None,
+        extra_body: Optional[dict] = None,
+    ) -> AsyncIterator[StreamChunk]:
+        """
+        endpoint: "chat" or "completions"
+        payload: the request body, without "stream"
+        """
+        if self.continuous_usage_stats:
+            payload = with_continuous_usage(payload)
+        if endpoint == "chat":
+            response = await self.client.chat.completions.create(
+                stream=True, extra_headers=extra_headers, extra_body=extra_body, **payload
+            )
+            async for chunk in response:
+                text = chunk.choices[0].delta.content if chunk.choices else None
+                yield text, self._usage(getattr(chunk, "usage", None))
+        else:
+            response = await self.client.completions.create(
+                stream=True, extra_headers=extra_headers, extra_body=extra_body, **payload
+            )
+            async for chunk in response:
+                text = chunk.choices[0].text if chunk.choices else None
+                yield text, self._usage(getattr(chunk, "usage", None))
+
+    async def complete(
+        self,
+        endpoint: str,
+        payload: dict,
+        extra_headers: Optional[Dict[str, str]] = None,
+        extra_body: Optional[dict] = None,
+    ) -> dict:
+        """Non-streaming request, returns the response body"""
+        if endpoint == "chat":
+            create = self.client.chat.completions.create
+        else:
+            create = self.client.completions.create
+        response = await create(
+            stream=False, extra_headers=extra_headers, extra_body=extra_body, **payload
+        )
+        return response.model_dump()
+
+
+LINE_END = re.compile(rb"\r\n|\r|\n")
+
+
+def pop_lines(buffer: bytearray, final: bool = False) -> List[bytes]:
+    """
+    Remove the complete lines (ended by CRLF, LF or CR) from the start of
+    buffer and return them without their ends. A CR at the very end stays
+    until the next bytes show whether an LF follows, unless final, which
+    also returns the unterminated rest
+    """
+    lines = []
+    start = 0
+    for match in LINE_END.finditer(buffer):
+        if match.end() == len(buffer) and match.group() == b"\r" and not final:
+            break
+        lines.append(bytes(buffer[start:match.start()]))
+        start = match.end()
+    del buffer[:start]
+    if final and buffer:
+        lines.append(bytes(buffer))
+        buffer.clear()
+    return lines
+
+
+class HTTPTransport:
+    """
+    Streams completions over a pooled httpx client and parses the
+    server-sent events directly, without building SDK objects per chunk
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        max_connections: int = 1000,
+        keepalive_expiry: float = 60.0,
+        http2: bool = False,
+        continuous_usage_stats: bool = False,
+    ):
+        import httpx
+
+        self.continuous_usage_stats = continuous_usage_stats
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        try:
+            self.client = httpx.AsyncClient(
+                base_url=normalize_base_url(base_url),
+                headers={"Authorization": "Bearer EMPTY"},
+                limits=limits,
+                timeout=httpx.Timeout(None, connect=30.0),
+                http2=http2,
+            )
+        except ImportError as e:
+            raise ImportError(
+                "HTTP/2 needs the h2 package, install it with `pip install httpx[http2]`"
+            ) from e
+
+    @staticmethod
+    def _path(endpoint: str) -> str:
+        return "chat/completions" if endpoint == "chat" else "completions"
+
+    @staticmethod
+    def _body(payload: dict, extra_body: Optional[dict], stream: bool) -> dict:
+        body = dict(payload, stream=stream)
+        if extra_body:
+            body.update(extra_body)
+        return body
+
+    async def stream(
+        self,
+        endpoint: str,
+        payload: dict,
+        extra_headers: Optional[Dict[str, str]] = None,
+        extra_body: Optional[dict] = None,
+    ) -> AsyncIterator[StreamChunk]:
+        """Same contract as OpenAITransport.stream"""
+        chat = endpoint == "chat"
+        if self.continuous_usage_stats:
+            payload = with_continuous_usage(payload)
+        body = self._body(payload, extra_body, stream=True)
+        async with self.client.stream(
+            "POST", self._path(endpoint), json=body, headers=extra_headers
+        ) as response:
+            if response.status_code != 200:
+                error = await response.aread()
+                raise RuntimeError(
+                    f"HTTP {response.status_code} from the server: {error[:500]!r}"
+                )
+            buffer = bytearray()
+            # data lines of the event being received
+            data = []
+            async for received in response.aiter_bytes():
+                buffer += received
+                for chunk in self._events(buffer, data):
+                    if chunk is None:
+                        return
+                    yield self._chunk(chunk, chat)
+            # A server may close the stream without a blank line after the
+            # last event
+            for chunk in self._events(buffer, data, final=True):
+                if chunk is None:
+                    return
+                yield self._chunk(chunk, chat)
+
+    @staticmethod
+    def _events(buffer: bytearray, data: List[bytes], final: bool = False):
+        """
+        Parse the complete events of buffer, removing them from it: the JSON
+        of every event, or None for [DONE]. A line is ended by CRLF, LF or
+        CR and an event by a blank line, as in the SSE spec
+        """
+        for line in pop_lines(buffer, final):
+            if line.startswith(b"data:"):
+                data.append(line[5:].strip())
+            elif not line and data:
+                event = b"\n".join(data)
+                data.clear()
+                yield None if event == b"[DONE]" else json.loads(event)
+        if final and data:
+            event = b"\n".join(data)
+            data.clear()
+            yield None if event == b"[DONE]" else json.loads(event)
+
+    @staticmethod
+    def _chunk(chunk: dict, chat: bool) -> StreamChunk:
+        choices = chunk.get("choices")
+        text = None
+        if choices:
+            if chat:
+                text = choices[0].get("delta", {}).get("content")
+            else:
+                text = choices[0].get("text")
+        return text, chunk.get("usage")
+
+    async def complete(
+        self,
+        endpoint: str,
+        payload: dict,
+        extra_headers: Optional[Dict[str, str]] = None,
+        extra_body: Optional[dict] = None,
+    ) -> dict:
+        """Same contract as OpenAITransport.complete"""
+        response = await self.client.post(
+            self._path(endpoint),
+            json=self._body(payload, extra_body, stream=False),
+            headers=extra_headers,
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+def build_transport(base_url: str, args=None):
+    """
+    Create the transport selected by the arguments registered with
+    add_transport_arguments (the openai SDK client by default)
+    """
+    if args is None:
+        return OpenAITransport(base_url)
+    if args.transport == "openai":
+        return OpenAITransport(base_url, args.continuous_usage_stats)
+    return HTTPTransport(
+        base_url,
+        max_connections=args.max_connections,
+        keepalive_expiry=args.keepalive_expiry,
+        http2=args.http2,
+        continuous_usage_stats=args.continuous_usage_stats,
+    )
+
+
+def add_transport_arguments(parser):
+    parser.add_argument(
+        "--transport",
+        choices=["openai", "http"],
+        default="openai",
+        help="Client used to send requests: the openai SDK, or a pooled "
+        "raw-HTTP client that parses the event stream directly",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=1000,
+        help="Max connections per host of the http transport",
+    )
+    parser.add_argument(
+        "--keepalive-expiry",
+        type=float,
+        default=60.0,
+        help="Seconds an idle connection of the http transport is kept alive",
+    )
+    parser.add_argument(
+        "--http2",
+        action="store_true",
+        help="Use HTTP/2 in the http transport (needs the h2 package)",
+    )
+    parser.add_argument(
+        "--continuous-usage-stats",
+        action="store_true",
+        help="Ask the server for the token usage with every streamed chunk "
+        "(a vLLM extension), so chunks carrying several tokens are counted "
+        "exactly in ITL/TPOT",
+    )
+
+
+def load_tokenizer(name: str):
+    """
+    HuggingFace tokenizer of the served model, needs the transformers package
+    """
+    try:
+        from transformers import AutoTokenizer
+    except ImportError as e:
+        raise ImportError(
+            "Tokenizing prompts needs the transformers package (pip install transformers)"
+        ) from e
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    return AutoTokenizer.from_pretrained(name, trust_remote_code=True)
+
+
+class TokenPromptCache:
+    """
+    Builds prompts as token ID lists for the completions API, so their length
+    is exact and the server does not tokenize them.
+
+    The IDs of the repeated prompt pieces (shared system prompt, user
+    context, trace hash blocks) are kept in a bounded LRU cache. The messages
+    of a chat history keep their token IDs in a "token_ids" field, set by the
+    caller or encoded here the first time the message is sent.
+    """
+
+    def __init__(self, tokenizer, filler: str = " hi", max_blocks: int = 100_000):
+        self.tokenizer = tokenizer
+        self.filler_id = self.encode(filler)[-1]
+        bos_token_id = getattr(tokenizer, "bos_token_id", None)
+        self.prefix = [bos_token_id] if bos_token_id is not None else []
+        self.max_blocks = max_blocks
+        # (head, num_tokens) -> token IDs, least recently used first
+        self.blocks = OrderedDict()
+
+    def encode(self, text: str) -> List[int]:
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def block(self, head: str, num_tokens: int, cache: bool = True) -> List[int]:
+        """
+        Exactly num_tokens token IDs: the tokens of head followed by fillers.
+        With cache=False the block is built without touching the cache, for
+        heads that are only used once and would evict the repeated blocks.
+        """
+        if not cache:
+            return self._build_block(head, num_tokens)
+        key = (head, num_tokens)
+        token_ids = self.blocks.get(key)
+        if token_ids is not None:
+            self.blocks.move_to_end(key)
+            return token_ids
+        token_ids = self._build_block(head, num_tokens)
+        self.blocks[key] = token_ids
+        if len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
+        return token_ids
+
+    def _build_block(self, head: str, num_tokens: int) -> List[int]:
+        token_ids = self.encode(head)[:num_tokens]
+        token_ids += [self.filler_id] * (num_tokens - len(token_ids))
+        return token_ids
+
+    def prompt(self, messages: List[Dict]) -> List[int]:
+        """Token IDs of the concatenated messages"""
+        token_ids = list(self.prefix)
+        for message in messages:
+            message_ids = message.get("token_ids")
+            if message_ids is None:
+                message_ids = message["token_ids"] = self.encode(message["content"])
+            token_ids.extend(message_ids)
+        return token_ids
+
+
+def add_token_prompt_arguments(parser):
+    parser.add_argument(
+        "--token-ids",
+        action="store_true",
+        help="Send prompts as token ID arrays to the completions API, with "
+        "exact lengths and no server-side tokenization (needs transformers)",
+    )
+    parser.add_argument(
+        "--tokenizer",
+        type=str,
+        default=None,
+        help="HuggingFace tokenizer of the served model (default: --model "
+        "with --token-ids)",
+    )
+
+
+def build_token_prompts(args) -> Optional[TokenPromptCache]:
+    """
+    TokenPromptCache selected by the arguments registered with
+    add_token_prompt_arguments, None without --token-ids
+    """
+    if not args.token_ids:
+        return None
+    return TokenPromptCache(load_tokenizer(args.tokenizer or args.model))
+
+
+def chained_block_hashes(token_ids: List[int], block_size: int) -> List[bytes]:
+    """
+    Hash of every block_size-token block of a prompt, chained over the blocks
+    before it: two prompts get the same k-th hash exactly when their first k
+    blocks are equal, like the hash_ids of Mooncake traces
+    """
+    hashes = []
+    previous = b""
+    for start in range(0, len(token_ids), block_size):
+        block = token_ids[start:start + block_size]
+        digest = hashlib.blake2b(previous, digest_size=16)
+        digest.update(",".join(map(str, block)).encode())
+        previous = digest.digest()
+        hashes.append(previous)
+    return hashes